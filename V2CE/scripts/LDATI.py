@@ -1,5 +1,7 @@
+import time
 import logging
-from typing import List, Tuple
+from collections import namedtuple
+from typing import Tuple
 
 import numpy
 import torch
@@ -7,9 +9,20 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
 
+try:
+    from .profiler import profiled
+    from .event_io import EVENT_DTYPE
+except ImportError:
+    # Run as a script
+    from profiler import profiled
+    from event_io import EVENT_DTYPE
+
 logger = logging.getLogger(__name__)
 
-# @tic_toc
+# Number of events copied at once to the output of pick_and_sort
+_FILL_BLOCK_SIZE = 65536
+
+@profiled('ldati.slope')
 def calculate_statistical_linear_params_for_stage2(y):
     """
     Calculate the statistical linear parameters for stage 2
@@ -21,39 +34,60 @@ def calculate_statistical_linear_params_for_stage2(y):
     """
     B, L, H, W = y.shape
 
-    # Padding the input
-    y_padded = F.pad(y, (0, 0, 0, 0, 1, 1), mode='reflect')
-    device = y.device
-    
-    # Create convolution kernels
-    ones_kernel = torch.ones((1, 1, 3), device=device)
-    xy_kernel = torch.tensor([-1.0, 0.0, 1.0], device=device).repeat(1, 1, 1)
-
-    # Reshape padded tensor
-    y_padded_reshaped = torch.einsum('bkhw->bhwk', y_padded).reshape(B * H * W, 1, L + 2)
-
-    # Compute sum_y
-    sum_y = F.conv1d(y_padded_reshaped, ones_kernel, padding=0).view(B, H, W, L).permute(0, 3, 1, 2)
+    # Least squares slope over the 3-tap window [i-1, i, i+1] with x = [-1, 0, 1], so sum_x = 0 and
+    # sum_xy = y[i+1] - y[i-1]. With reflect padding, sum_xy of the first and last bins is 0.
+    sum_xy = torch.zeros_like(y)
+    sum_xy[:, 1:-1] = y[:, 2:] - y[:, :-2]
 
-    # Compute sum_xy
-    sum_xy = F.conv1d(y_padded_reshaped, xy_kernel, padding=0).view(B, H, W, L).permute(0, 3, 1, 2)
-
-    sum_x = 0
     sum_x2 = 2
     N = 3
     # Using the least squares formula to calculate the slope m and the intercept b
-    k = (N * sum_xy - sum_x * sum_y) / (N * sum_x2 - sum_x ** 2)
-
-    logger.debug(f"Slope k's shape: {k.shape}")
-    logger.debug(f"nonzero k: {torch.sum(k>0)}")
-    logger.debug(f"max raw k: {torch.max(k)}")
-    logger.debug(f"min raw k: {torch.min(k)}")
+    k = (N * sum_xy) / (N * sum_x2)
+
+    # The reductions sync the device, only run them when they are logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Slope k's shape: {k.shape}")
+        logger.debug(f"nonzero k: {torch.sum(k>0)}")
+        logger.debug(f"max raw k: {torch.max(k)}")
+        logger.debug(f"min raw k: {torch.min(k)}")
     return k
 
-def y_relocate_adapt(y):
+def frame_generators(seed, frame_idx, num_frames, device='cpu'):
+    """ The random generators of consecutive frames, each seeded from (seed, frame index) only
+    The sampling of a frame does not depend on the other frames of its batch, so the frames can be
+    sampled in any order, in batches of any size, and in any number of processes.
+    Args:
+        seed: the global seed
+        frame_idx: the index of the first frame
+        num_frames: the number of frames
+        device: the device of the generators. CPU and CUDA generators draw different numbers
+    Returns:
+        generators: a list of `num_frames` torch.Generator
+    """
+    generators = []
+    for i in range(frame_idx, frame_idx + num_frames):
+        frame_seed = int(numpy.random.SeedSequence([seed, i]).generate_state(1, dtype=numpy.uint64)[0])
+        generators.append(torch.Generator(device=device).manual_seed(frame_seed))
+    return generators
+
+def _rand_rows(shape, generators, device, dtype=torch.float):
+    """ Uniform samples of shape (B, ...), row b drawn from generators[b], or from the global RNG if generators is None """
+    if generators is None:
+        return torch.rand(shape, device=device, dtype=dtype)
+    assert len(generators) == shape[0], 'One generator per row is needed'
+    return torch.stack([torch.rand(shape[1:], generator=g, device=device, dtype=dtype) for g in generators])
+
+def y_relocate_adapt(y, generators=None):
+    """
+    Args:
+        y: input tensor of shape (B, C, H, W)
+        generators: a generator per row of y (see `frame_generators`), None to draw from the global RNG
+    """
     B, C, H, W = y.shape
     new_y = torch.zeros((B, C-1, H, W), device=y.device, dtype=int)
-    rand_y = torch.rand((B, C-1, H, W), device=y.device, dtype=float)
+    rand_y = _rand_rows((B, C-1, H, W), generators, y.device, dtype=float)
+    # Bernoulli samples of the values within (0, 1), as uniform samples below the value
+    rand_bernoulli = _rand_rows((B, C-1, H, W), generators, y.device, dtype=y.dtype) if generators is not None else None
     tendency = torch.zeros((B, C-1, H, W), device=y.device, dtype=float)
     
     from_left_until = C-1
@@ -64,7 +98,10 @@ def y_relocate_adapt(y):
         _new_y_slice = yslice - debt 
 
         within_one_mask = (yslice>0)&(yslice<1)
-        new_y[:,i,:,:][within_one_mask] = torch.bernoulli(yslice[within_one_mask])
+        if rand_bernoulli is None:
+            new_y[:,i,:,:][within_one_mask] = torch.bernoulli(yslice[within_one_mask])
+        else:
+            new_y[:,i,:,:][within_one_mask] = (rand_bernoulli[:,i,:,:][within_one_mask] < yslice[within_one_mask]).to(new_y.dtype)
         tendency[:,i,:,:][within_one_mask] = rand_y[:,i,:,:][within_one_mask]
 
         new_y_slice = torch.ceil(_new_y_slice-1e-6) 
@@ -73,10 +110,11 @@ def y_relocate_adapt(y):
         tendency[:,i,:,:] = debt
     
     new_y[:,-1,:,:] += (y[:,-1,:,:]-debt).int()
-    print("ratio",torch.sum(new_y)/torch.sum(y))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"ratio: {torch.sum(new_y)/torch.sum(y)}")
     return new_y, tendency
 
-# @tic_toc
+@profiled('ldati.relocate')
 def y_relocate(y, bidirectional=False, erase_beginning=False):
     B, C, H, W = y.shape
     new_y = torch.zeros((B, C-1, H, W), device=y.device, dtype=int)
@@ -122,8 +160,113 @@ def y_relocate(y, bidirectional=False, erase_beginning=False):
         new_y[:,i,:,:] = torch.ceil(yslice+bless-debt) 
     return new_y, tendency
 
-# @tic_toc
-def sample_voxel_statistical(y, t0=0, fps=30, pooling_type='none', pooling_kernel_size=3, additional_events_strategy='slope', bidirectional=False):
+def _stage2_kernel(y: Tensor, time_base: Tensor, fps: float, with_slope: bool = True):
+    """ Relocate the events of every voxel, and compute the timestamp of the relocated event and the slope
+    of the event density, in a single pass over the time bins of each pixel
+    Args:
+        y: stage 1 voxels of shape (N, C+1, H, W)
+        time_base: starting timestamp of each of the C time bins in seconds, shape (C,)
+        fps: frames per second
+        with_slope: whether to compute the slope parameters from the relocated event numbers
+    Returns:
+        num_events: relocated event number of each voxel, shape (N, C, H, W)
+        ts: timestamp of the relocated event of each voxel in microseconds, shape (N, C, H, W)
+        k, b: slope and intercept of the linear event density of each voxel, shape (N, C, H, W), or None
+    """
+    C = y.shape[1] - 1
+    voxel_step = 1 / fps / C
+
+    # Same relocation as `y_relocate`, the debt carried to the next bin is the tendency of the event
+    debt = torch.zeros_like(y[:, 0])
+    num_events, ts = [], []
+    for i in range(C):
+        _new_y_slice = y[:, i] - debt
+        new_y_slice = torch.ceil(_new_y_slice - 1e-6)
+        debt = new_y_slice - _new_y_slice
+        num_events.append(new_y_slice.to(torch.long))
+        ts.append(((debt.double() / fps / C + time_base[i]) * 1e6).to(torch.long))
+    num_events[-1] = num_events[-1] + (y[:, -1] - debt).int()
+
+    if not with_slope:
+        return torch.stack(num_events, dim=1), torch.stack(ts, dim=1), None, None
+
+    # Slope of the 3-tap least squares fit, divided by the event number so that the area under the density is 1
+    k = []
+    for i in range(C):
+        y_i = num_events[i].float()
+        if i == 0 or i == C - 1:
+            k_i = torch.zeros_like(y_i)
+        else:
+            k_i = (num_events[i + 1] - num_events[i - 1]).float() / 2 / (voxel_step ** 2) / (y_i + 1e-8)
+        k.append(k_i)
+    k = torch.stack(k, dim=1)
+    b = 1 / voxel_step - voxel_step * k / 2
+    return torch.stack(num_events, dim=1), torch.stack(ts, dim=1), k, b
+
+def _additional_ts_kernel(k: Tensor, b: Tensor, u: Tensor, time_base: Tensor, fps: float, C: int):
+    """ Sample the additional event timestamps from the linear event density by inverting its CDF
+    Args:
+        k, b: slope and intercept of the voxel of each additional event, shape (N,)
+        u: uniform samples, shape (N,)
+        time_base: starting timestamp of the time bin of each additional event in seconds, shape (N,)
+        fps: frames per second
+        C: number of time bins
+    Returns:
+        additional_ts: timestamps in microseconds, shape (N,)
+    """
+    additional_ts = (-b + torch.sqrt((b ** 2 + 2 * k * u))) / k
+    additional_ts = torch.where(k == 0, u / fps / C, additional_ts)
+    return ((additional_ts + time_base) * 1e6).to(torch.long)
+
+# Additional events stored as a CSR layout: the events of voxel i are values[offsets[i]:offsets[i+1]],
+# and voxel_index holds the flat voxel index of every event
+RaggedTimestamps = namedtuple("RaggedTimestamps", ["values", "offsets", "voxel_index"])
+
+def ragged_layout(num_additional: Tensor) -> Tuple[Tensor, Tensor]:
+    """ Build the CSR layout of the additional events
+    Args:
+        num_additional(N): number of additional events of each voxel
+    Returns:
+        offsets(N+1): the first event of each voxel in the flat buffer, the last entry is the event total
+        voxel_index(total): flat voxel index of each event
+    """
+    offsets = F.pad(torch.cumsum(num_additional, dim=0), (1, 0))
+    total = int(offsets[-1])
+    voxel_index = torch.repeat_interleave(num_additional, output_size=total)
+    return offsets, voxel_index
+
+_compiled_kernels = {}
+
+def _get_kernel(kernel, compile_kernel=False):
+    """ Return the kernel, compiled with torch.compile if requested and supported on this host
+    torch.compile is lazy, compiler errors (e.g. no C++ toolchain) are raised by the first call,
+    so the kernel falls back to eager mode if either the wrapping or the first call fails.
+    """
+    if not compile_kernel:
+        return kernel
+    if kernel not in _compiled_kernels:
+        try:
+            compiled = torch.compile(kernel, dynamic=True)
+        except Exception as e:
+            logger.warning(f"torch.compile is not available ({e}), running {kernel.__name__} eagerly")
+            _compiled_kernels[kernel] = kernel
+            return kernel
+
+        def first_call(*args, **kwargs):
+            try:
+                outputs = compiled(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"Failed to compile {kernel.__name__} ({e}), running it eagerly")
+                _compiled_kernels[kernel] = kernel
+                return kernel(*args, **kwargs)
+            _compiled_kernels[kernel] = compiled
+            return outputs
+        _compiled_kernels[kernel] = first_call
+    return _compiled_kernels[kernel]
+
+@profiled('ldati')
+def sample_voxel_statistical(y, t0=0, fps=30, pooling_type='none', pooling_kernel_size=3, additional_events_strategy='slope', bidirectional=False,
+                             compile_kernel=False, seed=None, frame_idx=0, time_offsets=None, sink=None):
     """ Sample voxel from y, and add noise to it
     Args:
         y: input tensor of shape (B, P, C, H, W), where P=2, C=10
@@ -131,6 +274,14 @@ def sample_voxel_statistical(y, t0=0, fps=30, pooling_type='none', pooling_kerne
         t0: The starting timestamp of the event sequence
         fps: Frames per second
         time_bins: Number of time bins
+        compile_kernel: Whether to compile the per-pixel stage 2 kernels with torch.compile
+        seed: the global seed of the per-frame generators (see `frame_generators`), so the events of a frame
+            only depend on (seed, frame index) and its voxels. None to draw from the global torch RNG
+        frame_idx: the index of the first frame of y, with `seed`
+        time_offsets: the timestamp offset of each frame in microseconds, added to its events, see `pick_and_sort`
+        sink: the buffer the events are written to, see `pick_and_sort`
+    Returns:
+        a list of B structured arrays of EVENT_DTYPE, the event stream of each frame
     """
     assert pooling_type in ['avg', 'weighted', 'none']
     assert additional_events_strategy in ['none', 'random', 'slope']
@@ -144,35 +295,23 @@ def sample_voxel_statistical(y, t0=0, fps=30, pooling_type='none', pooling_kerne
     y = y.reshape(B * P, C, H, W).float()
     frame_step = 1 / fps
     voxel_step = 1 / fps / (C-1)
-    #print("before",torch.sum(y))
-    # Reloaate y based on the generation method of event voxel
-    y, y_tendency = y_relocate(y, bidirectional=bidirectional)
-    #print("after",torch.sum(y))
-    logger.debug(f"None-zero y_tendency: {torch.sum(y_tendency>0)}")
-    logger.debug(f"None-zero y: {torch.sum(y>0)}")
-    C = C-1
-
-    # Adapt the y_tendency whose unit is a unit voxel time to actual time in seconds
-    ts = y_tendency / fps / C
+    # Starting timestamp of each time bin
+    time_base = torch.arange(0, frame_step, voxel_step, device=device) + t0
 
-    # Reshape the timestamps and y to get ready for pick&sort
-    ts = ts.reshape(B, P, C, H, W)  # (B, P, C, H, W)
-    y = y.reshape(B, P, C, H, W) # (B, P, C, H, W)
-
-    # Add the starting timestamp of each voxel to the timestamps
-    ts += torch.arange(0, frame_step, voxel_step, device=device).reshape(1, 1, C, 1, 1) + t0
-    ts *= 1e6
-    ts = ts.to(torch.long)
+    # Relocate y based on the generation method of event voxel, and get the timestamp of each relocated event.
+    # The slope of the event density is computed in the same pass unless the event numbers are pooled first.
+    with_slope = additional_events_strategy == 'slope' and pooling_type == 'none'
+    if not bidirectional:
+        y, ts, k, b = _get_kernel(_stage2_kernel, compile_kernel)(y, time_base, fps, with_slope)
+    else:
+        y, y_tendency = y_relocate(y, bidirectional=bidirectional)
+        ts = ((y_tendency / fps / (C-1) + time_base.reshape(1, C-1, 1, 1)) * 1e6).to(torch.long)
+        k = b = None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"None-zero y: {torch.sum(y>0)}")
+    C = C-1
 
-    ######## DEAL WITH ADDITIONAL EVENTS WHERE THE VOXEL VALUE IS LARGER THAN 1 ########
-    # Generate uniformly distributed timestamps
-    max_event_num_per_voxel = torch.max(y)
-    additional_ts_shape = torch.Size(list(y.shape) + [max_event_num_per_voxel])  # (B*P, C, H, W, max_event_num_per_voxel-1)
-    raw_additional_ts = torch.rand(additional_ts_shape, device=device)
-
-    if additional_events_strategy == 'random':
-        additional_ts = raw_additional_ts
-    elif additional_events_strategy == 'slope':
+    if additional_events_strategy == 'slope' and k is None:
         # Do a avg pooling on xy axis of y
         if pooling_type == 'weighted':
             pooling_kernel = torch.tensor([[1, 2, 1], [2, 4, 2], [1, 2, 1]], device=device, dtype=torch.float) / 16
@@ -186,140 +325,175 @@ def sample_voxel_statistical(y, t0=0, fps=30, pooling_type='none', pooling_kerne
         # Calculate slope for slope distribution, divide by y so the area under is 1
         y_pooled = y_pooled.reshape(B * P, C, H, W)
         k = calculate_statistical_linear_params_for_stage2(y_pooled) / (voxel_step**2) / (y_pooled+1e-8)
-        
         b = 1 / voxel_step - voxel_step * k / 2
-        b = b.unsqueeze(-1).repeat(1, 1, 1, 1, max_event_num_per_voxel)
-        k = k.unsqueeze(-1).repeat(1, 1, 1, 1, max_event_num_per_voxel)
-        
-        raw_additional_ts = raw_additional_ts.reshape(B*P, C, H, W, max_event_num_per_voxel)
-        additional_ts = (-b + torch.sqrt((b ** 2 + 2 * k * raw_additional_ts))) / k
-        additional_ts = torch.where(k==0, raw_additional_ts / fps / C, additional_ts)
-        if additional_ts.numel() > 0:
-            logger.debug(f"max of additional_ts: {torch.max(additional_ts)}")
-            logger.debug(f"min of additional_ts: {torch.min(additional_ts)}")
-        logger.debug(f"max of raw_additional_ts: {torch.max(raw_additional_ts)}")
-        logger.debug(f"min of raw_additional_ts: {torch.min(raw_additional_ts)}")
-        logger.debug(f"max of k: {torch.max(k)}")
-        logger.debug(f"min of k: {torch.min(k)}")
-        logger.debug(f"max of b: {torch.max(b)}")
-        logger.debug(f"min of b: {torch.min(b)}")
+
+    ######## DEAL WITH ADDITIONAL EVENTS WHERE THE VOXEL VALUE IS LARGER THAN 1 ########
+    # Only voxels with more than one event get additional events, so the timestamps are generated
+    # in a flat buffer sized to the actual event total instead of padding every voxel to the maximum
+    if additional_events_strategy != 'none':
+        # The relocation can leave a count of -1 after a near-zero bin, such voxels have no events
+        num_additional = torch.where(y > 1, y, 0).reshape(-1)
+        offsets, voxel_index = ragged_layout(num_additional)
+        # Generate uniformly distributed timestamps
+        if seed is None:
+            raw_additional_ts = torch.rand(voxel_index.shape, device=device)
+        else:
+            # The events of each frame are a contiguous run of the buffer, drawn from the generator of the frame
+            frame_offsets = offsets[::P * C * H * W].tolist()
+            generators = frame_generators(seed, frame_idx, B, device=device)
+            raw_additional_ts = torch.cat([torch.rand(end - start, generator=g, device=device)
+                                           for g, start, end in zip(generators, frame_offsets[:-1], frame_offsets[1:])])
+        event_time_base = time_base[voxel_index // (H * W) % C]
+
+        if additional_events_strategy == 'random':
+            values = ((raw_additional_ts + event_time_base) * 1e6).to(torch.long)
+        else:
+            values = _get_kernel(_additional_ts_kernel, compile_kernel)(
+                k.reshape(-1)[voxel_index], b.reshape(-1)[voxel_index], raw_additional_ts, event_time_base, fps, C)
+            if logger.isEnabledFor(logging.DEBUG) and values.numel() > 0:
+                logger.debug(f"max of additional_ts: {torch.max(values)}")
+                logger.debug(f"min of additional_ts: {torch.min(values)}")
+                logger.debug(f"max of k: {torch.max(k)}")
+                logger.debug(f"min of k: {torch.min(k)}")
+        del raw_additional_ts, event_time_base
+        additional_ts = RaggedTimestamps(values, offsets, voxel_index)
     else:
-        additional_ts = torch.zeros_like(raw_additional_ts)
-        
-    additional_ts = additional_ts.reshape(B, P, C, H, W, max_event_num_per_voxel) 
-    additional_ts += torch.arange(0, frame_step, voxel_step, device=device).reshape(1, 1, C, 1, 1, 1) + t0
-    additional_ts *= 1e6
-    additional_ts = additional_ts.to(torch.long)
-
-    return pick_and_sort(ts, y, additional_ts, additional_events_strategy=additional_events_strategy)
-
-# @tic_toc
-def pick_elements(ts: Tensor, num_elements: Tensor, additional_ts:Tensor, additional_events_strategy='none') -> Tuple[Tensor, Tensor, Tensor]:
-    """ Pick the first `num_elements` events from `ts`, and add their x and y index
-    Args:
-        ts(H,W): the exact location of the last event within the voxel
-        num_elements(H,W): event number at each pixel 
-        additional_ts(H,W,max_event_num_per_voxel): timestamps of additional events (where the voxel value is larger than 1)
-    """
-    H, W = num_elements.shape
-    device = ts.device
+        additional_ts = None
 
-    # if a voxel in num_elements has a value which is larger than 0 and smaller than 1, select it
-    selection = (num_elements == 1) #(num_elements > 0) & (num_elements <= 1)
-    # Create the row and column indices for events generated
-    x_index = torch.arange(W, device=device, dtype=torch.int16).expand(H, W)
-    y_index = torch.arange(H, device=device, dtype=torch.int16).unsqueeze(1).expand(H, W)
-    ts_selected = ts[selection]
-    x_index_selected = x_index[selection]
-    y_index_selected = y_index[selection]
-    
-    num_elements = torch.where((num_elements==1), torch.zeros_like(num_elements), num_elements)
-    
-    max_event_num_per_voxel = additional_ts.shape[-1]
-    selection_additional = torch.arange(additional_ts.shape[-1], device=device).unsqueeze(0).unsqueeze(1) < num_elements.unsqueeze(2)
+    # Reshape the timestamps and y to get ready for pick&sort
+    ts = ts.reshape(B, P, C, H, W)  # (B, P, C, H, W)
+    y = y.reshape(B, P, C, H, W) # (B, P, C, H, W)
 
-    if additional_events_strategy != 'none':
-        ts_selected = torch.cat((ts_selected, additional_ts[selection_additional]))
-        x_index_selected = torch.cat((x_index_selected, x_index.unsqueeze(-1).expand(H, W, max_event_num_per_voxel)[selection_additional]))
-        y_index_selected = torch.cat((y_index_selected, y_index.unsqueeze(-1).expand(H, W, max_event_num_per_voxel)[selection_additional]))
-    return ts_selected, x_index_selected, y_index_selected
+    return pick_and_sort(ts, y, additional_ts, additional_events_strategy=additional_events_strategy, time_offsets=time_offsets, sink=sink)
 
-# @tic_toc
-def pick_and_sort(ts, num_elements, additional_ts=None, additional_events_strategy='none'):
+@profiled('ldati.pick_elements')
+def pick_elements(ts: Tensor, num_elements: Tensor, additional_ts, additional_events_strategy='none') -> Tuple[Tensor, Tensor]:
+    """ Pick the events of every voxel at once, and return the flat index of the voxel each event comes from
+    Args:
+        ts(...): the exact location of the last event within the voxel
+        num_elements(...): event number at each voxel
+        additional_ts: timestamps of additional events (where the voxel value is larger than 1), either a
+            RaggedTimestamps, or a dense tensor of shape (..., max_event_num_per_voxel)
+    Returns:
+        ts_selected(N): timestamps of the picked events
+        voxel_index(N): flat index of the voxel (in `num_elements`) of each picked event
+    """
+    num_elements = num_elements.reshape(-1)
+
+    # Voxels with exactly one event keep the timestamp in `ts`
+    selection = (num_elements == 1)
+    voxel_index = torch.nonzero(selection).squeeze(1)
+    ts_selected = ts.reshape(-1)[voxel_index]
+
+    if additional_events_strategy != 'none' and isinstance(additional_ts, RaggedTimestamps):
+        # The ragged buffer holds exactly the events of the voxels with more than one event
+        ts_selected = torch.cat((ts_selected, additional_ts.values))
+        voxel_index = torch.cat((voxel_index, additional_ts.voxel_index))
+    elif additional_events_strategy != 'none':
+        # Voxels with more events take the first `num_elements` timestamps of `additional_ts`
+        max_event_num_per_voxel = additional_ts.shape[-1]
+        num_additional = torch.where(selection, torch.zeros_like(num_elements), num_elements)
+        selection_additional = torch.arange(max_event_num_per_voxel, device=ts.device).unsqueeze(0) < num_additional.unsqueeze(1)
+        additional_index = torch.nonzero(selection_additional.reshape(-1)).squeeze(1)
+        ts_selected = torch.cat((ts_selected, additional_ts.reshape(-1)[additional_index]))
+        voxel_index = torch.cat((voxel_index, additional_index // max_event_num_per_voxel))
+    return ts_selected, voxel_index
+
+@profiled('ldati.pick_and_sort')
+def pick_and_sort(ts, num_elements, additional_ts=None, additional_events_strategy='none', time_offsets=None, sink=None):
     """ Pick the first `num_elements` events from `ts`, and add their x and y index, output as dvs events
+    All the events of the block are gathered at once, and sorted by frame, time bin and timestamp with a single sort.
     Args:
         ts(B,P,C,H,W): timestamp of the last event within the voxel
         num_elements(B,P,C,H,W): number of element to keep in each 1-d array of timestamps of the voxel
-        additional_ts(B,P,C,H,W): timestamps of additional events (where the voxel value is larger than 1)
+        additional_ts: timestamps of additional events (where the voxel value is larger than 1), a RaggedTimestamps
+            over the flat voxel index of (B,P,C,H,W), or a dense tensor of shape (B,P,C,H,W,max_event_num_per_voxel)
+        time_offsets: the timestamp offset of each frame in microseconds, a sequence of B integers, None for no offset
+        sink: where the events are written, an object whose `reserve(num_events)` returns a structured array of
+            EVENT_DTYPE with room for them (see `EventBuffer`), None to allocate a new array
+    Returns:
+        result_all: a list of B structured arrays of EVENT_DTYPE [('timestamp', '<i8'), ('x', '<i2'), ('y', '<i2'), ('polarity', 'i1')],
+            consecutive views of a single array
     """
     B, P, C, H, W = ts.shape
     device = ts.device
-    
-    num_elements = torch.swapaxes(num_elements, 1, 2)
-    ts = torch.swapaxes(ts, 1, 2) # (B, C, P, H, W)
-    if additional_ts is not None:
-        additional_ts = torch.swapaxes(additional_ts, 1, 2)
-    else:
+
+    if additional_ts is None and additional_events_strategy != 'none':
         additional_ts = torch.zeros(ts.shape+(1,), device=device, dtype=ts.dtype)
 
     logger.debug(f"ts.shape: {ts.shape}")
     logger.debug(f"y.shape: {num_elements.shape}")
 
-    # these two tensors need to be sliced B times, convert into tuple for faster accessing
-    ts_by_batch = tuple(ts)
-    selection_by_batch = tuple(num_elements)
-    additional_ts_by_batch = tuple(additional_ts)
-
-    result_all = []
-    # Iterate through each batch
-    for batch_idx in range(B): # B
-        # four arrays store the four columns of output in this batch
-        ts_all, row_all, column_all, p_all = [], [], [], []
-
-        ts_by_voxel = tuple(ts_by_batch[batch_idx]) # (C, P, H, W)
-        selection_by_voxel = tuple(selection_by_batch[batch_idx])
-        additional_ts_by_voxel = tuple(additional_ts_by_batch[batch_idx]) 
-
-        # Iterate through each channel
-        for channel_index in range(C): # C
-            ts_channel = ts_by_voxel[channel_index] # (P, H, W)
-            selection_channel = selection_by_voxel[channel_index] # (P, H, W)
-            additional_ts_channel = additional_ts_by_voxel[channel_index] # (P, H, W)
-
-            # process negative events
-            ts_n, row_n, column_n = pick_elements(ts_channel[1], selection_channel[1], additional_ts_channel[1], additional_events_strategy=additional_events_strategy)
-
-            # process positive events
-            ts_p, row_p, column_p = pick_elements(ts_channel[0], selection_channel[0], additional_ts_channel[0], additional_events_strategy=additional_events_strategy)
-
-            # stack them together, sort them
-            ts_np = torch.hstack((ts_n, ts_p))
-            sorting = ts_np.argsort()
-
-            ts_all.append(ts_np[sorting])
-            row_all.append(torch.hstack((row_n, row_p))[sorting])
-            column_all.append(torch.hstack((column_n, column_p))[sorting])
-            p_all.append(torch.hstack((torch.zeros((ts_n.shape[0]), device=device, dtype=torch.int8),
-                                       torch.ones((ts_p.shape[0]), device=device, dtype=torch.int8)))[sorting])
-            
-        ts_all, row_all, column_all, p_all = [torch.hstack(x).cpu() for x in [ts_all, row_all, column_all, p_all]]
-        
-        # convert to numpy recarray
-        result_all.append(numpy.core.records.fromarrays([ts_all, row_all, column_all, p_all], names=['timestamp', 'x', 'y', 'polarity']))
-        # [('timestamp', '<i8'), ('x', '<i2'), ('y', '<i2'), ('polarity', 'i1')]
-    return result_all
-
-
-def timer(func):
-    start = torch.cuda.Event(enable_timing=True)
-    end = torch.cuda.Event(enable_timing=True)
-    torch.cuda.synchronize()
-    start.record()
+    ts_all, voxel_index = pick_elements(ts, num_elements, additional_ts, additional_events_strategy=additional_events_strategy)
+
+    # Sort by (batch, channel, timestamp, polarity) with one stable sort on a packed int64 key,
+    # negative events come first when timestamps are equal. The (batch, channel) prefix and the
+    # polarity of each (batch, polarity, channel) plane are looked up from small tables.
+    ts_min = ts_all.min() if ts_all.numel() > 0 else torch.zeros((), dtype=torch.long, device=device)
+    ts_offset = ts_all - ts_min
+    ts_bits = max(int(ts_offset.max()).bit_length() if ts_all.numel() > 0 else 0, 1)
+    key_bits = (B * C).bit_length() + ts_bits + 1
+    assert key_bits < 63, 'Timestamp range too large to pack the sorting key'
+    # Narrow integers make the sort, the gathers and the divisions noticeably cheaper
+    key_dtype = torch.int32 if key_bits < 31 else torch.long
+    if ts.numel() < 2 ** 31:
+        voxel_index = voxel_index.to(torch.int32)
+
+    plane_index = voxel_index // (H * W)
+    planes = torch.arange(B * P * C, device=device, dtype=key_dtype)
+    plane_prefix = (planes // (P * C) * C + planes % C) << (ts_bits + 1)
+    plane_polarity = 1 - planes // C % P  # P=0 holds the positive events
+    key = plane_prefix[plane_index] | (ts_offset.to(key_dtype) << 1) | plane_polarity[plane_index]
+    key, sorting = torch.sort(key, stable=True)
+
+    # Unpack the sorted key, and recover the pixel coordinates from the sorted voxel index
+    ts_all = ((key >> 1) & ((1 << ts_bits) - 1)).to(torch.long)
+    p_all = (key & 1).to(torch.int8)
+    pixel_index = voxel_index[sorting] % (H * W)
+    x_all = (pixel_index % W).to(torch.int16)
+    y_all = (pixel_index // W).to(torch.int16)
+
+    # Each frame is a contiguous run of the sorted key
+    frame_starts = (torch.arange(B + 1, device=device, dtype=key_dtype) * C) << (ts_bits + 1)
+    bounds = torch.searchsorted(key, frame_starts).tolist()
+    ts_all, x_all, y_all, p_all = [x.cpu().numpy() for x in [ts_all, x_all, y_all, p_all]]
+
+    # Fill one structured array, by blocks of rows small enough for the four columns to be written while they are
+    # in cache. The minimum and the offset of the frame are added to the timestamps as they are copied.
+    events = numpy.empty(len(ts_all), dtype=EVENT_DTYPE) if sink is None else sink.reserve(len(ts_all))
+    timestamps, xs, ys, ps = [events[name] for name in EVENT_DTYPE.names]
+    ts_min = int(ts_min)
+    for batch_idx in range(B):
+        start, end = bounds[batch_idx], bounds[batch_idx + 1]
+        frame_offset = ts_min + (0 if time_offsets is None else int(time_offsets[batch_idx]))
+        for block_start in range(start, end, _FILL_BLOCK_SIZE):
+            block = slice(block_start, min(block_start + _FILL_BLOCK_SIZE, end))
+            numpy.add(ts_all[block], frame_offset, out=timestamps[block])
+            xs[block] = x_all[block]
+            ys[block] = y_all[block]
+            ps[block] = p_all[block]
+    # The events of each frame are a view of the array
+    return [events[bounds[batch_idx]:bounds[batch_idx + 1]] for batch_idx in range(B)]
+
+
+def timer(func, device=None):
+    """ Time a function in milliseconds, waiting for the queued CUDA kernels of `device` when it is a GPU
+    Args:
+        func: the function to time, called without arguments
+        device: the device the function runs on (default: cuda if available, else cpu)
+    Returns:
+        elapsed: the run time in milliseconds
+        res: the result of the function
+    """
+    device = torch.device(('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
     res = func()
-    end.record()
-    # Waits for everything to finish running
-    torch.cuda.synchronize()
-    return start.elapsed_time(end), res
+    if device.type == 'cuda':
+        # Waits for everything to finish running
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) * 1e3, res
 
 
 if __name__ == "__main__":
@@ -327,25 +501,25 @@ if __name__ == "__main__":
     torch.random.manual_seed(42)
     logging.basicConfig(level=logging.DEBUG)
     B, P, C, H, W = 1, 2, 10, 260, 346
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     runtime, res = timer(
-        lambda: sample_voxel_statistical(torch.rand((B, P, C, H, W), device='cuda', dtype=torch.float)))
+        lambda: sample_voxel_statistical(torch.rand((B, P, C, H, W), device=device, dtype=torch.float)), device)
 
     total = 0
     for i in range(B):
         total += res[i].shape[0]
     print(runtime / total)
     print(runtime)
-    print(torch.cuda.max_memory_allocated(device='cuda') / 1024 ** 3)
-    print(torch.cuda.max_memory_allocated(device='cuda') / total)
+    if device.type == 'cuda':
+        print(torch.cuda.max_memory_allocated(device=device) / 1024 ** 3)
+        print(torch.cuda.max_memory_allocated(device=device) / total)
     print(len(res), res[0].shape)
     print(res)
-    y = torch.randint(0, 10, (B, P, C, H, W), device='cuda', dtype=torch.int16)
 
     runtime, res = timer(
-        lambda: sample_voxel_statistical(torch.randint(0, 10, (B, P, C, H, W), device='cuda', dtype=torch.int16)))
+        lambda: sample_voxel_statistical(torch.randint(0, 10, (B, P, C, H, W), device=device, dtype=torch.int16)), device)
     total = 0
     for i in range(B):
         total += res[i].shape[0]
     print(runtime / total)
-
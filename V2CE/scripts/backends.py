@@ -0,0 +1,157 @@
+"""
+Graph exports of a frozen V2ce3d (TorchScript and ONNX), and the backends running it: eager PyTorch,
+torch.compile, a TorchScript graph, or an ONNX graph in onnxruntime.
+"""
+import os
+import logging
+import tempfile
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('eager', 'compile', 'torchscript', 'onnxruntime')
+
+ONNX_INPUT_NAME = 'image_units'
+ONNX_OUTPUT_NAME = 'voxels'
+
+
+@torch.no_grad()
+def export_torchscript(model, example_inputs, path=None):
+    """ Trace a frozen V2ce3d into a frozen TorchScript graph
+    The sizes of the upsampling layers are traced from the shapes of the inputs, so the graph runs
+    on inputs of any batch size, height and width.
+    Args:
+        model: the frozen V2ce3d model, see `freeze_v2ce3d`
+        example_inputs: the image units to trace with. Shape: (B, L, 2, H, W)
+        path: the path to save the graph to, None to only return it
+    Returns:
+        traced: the TorchScript module
+    """
+    traced = torch.jit.freeze(torch.jit.trace(model.eval(), example_inputs, check_trace=False))
+    if path is not None:
+        torch.jit.save(traced, path)
+    return traced
+
+
+@torch.no_grad()
+def export_onnx(model, example_inputs, path, dynamic_width=True, opset_version=17):
+    """ Export a frozen V2ce3d to an ONNX graph
+    Args:
+        model: the frozen V2ce3d model, see `freeze_v2ce3d`
+        example_inputs: the image units to export with. Shape: (B, L, 2, H, W)
+        path: the path of the .onnx file
+        dynamic_width: whether the graph accepts any batch size, height and width, otherwise only
+            the shape of `example_inputs`
+        opset_version: the ONNX opset
+    """
+    dynamic_axes = None
+    if dynamic_width:
+        dynamic_axes = {ONNX_INPUT_NAME: {0: 'batch', 3: 'height', 4: 'width'},
+                        ONNX_OUTPUT_NAME: {0: 'batch', 3: 'height', 4: 'width'}}
+    torch.onnx.export(model.eval(), (example_inputs,), path, input_names=[ONNX_INPUT_NAME], output_names=[ONNX_OUTPUT_NAME],
+                      dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+
+
+class OnnxRuntimeModel:
+    """Runs an ONNX graph of V2ce3d in onnxruntime, with the interface of the torch model."""
+
+    def __init__(self, path, device='cpu', num_threads=None):
+        """
+        Args:
+            path: the path of the .onnx file, see `export_onnx`
+            device: the device of the inputs and the outputs, onnxruntime runs on CUDA for a CUDA device
+            num_threads: the number of intra-op threads (default: the torch CPU threads)
+        """
+        import onnxruntime
+        self.device = torch.device(device)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads() if num_threads is None else num_threads
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if self.device.type == 'cuda' else ['CPUExecutionProvider']
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=providers)
+
+    def __call__(self, inputs):
+        outputs = self.session.run([ONNX_OUTPUT_NAME], {ONNX_INPUT_NAME: inputs.detach().float().contiguous().cpu().numpy()})[0]
+        return torch.from_numpy(outputs).to(self.device)
+
+
+class BackendModel(nn.Module):
+    """Runs a frozen V2ce3d with a backend, falling back to eager PyTorch when the backend fails.
+
+    The backend is built on the first forward, from the inputs of that forward. Its outputs on
+    these inputs are checked against the eager model, and the eager model is used instead if they
+    do not match, or if the backend cannot be built. The eager model stays available as `model`
+    (and `UNet`, for TiledInference).
+    """
+
+    def __init__(self, model, backend='eager', path=None, atol=1e-4, rtol=1e-4):
+        """
+        Args:
+            model: the frozen V2ce3d model, prepared by the runtime
+            backend: one of BACKENDS
+            path: a graph exported by tools/export_model.py (.pt TorchScript or .onnx), None to export it on the fly
+            atol, rtol: the tolerances of the parity check
+        """
+        super().__init__()
+        assert backend in BACKENDS, f'Invalid backend {backend}'
+        self.model = model
+        self.backend = backend
+        self.path = path
+        self.atol = atol
+        self.rtol = rtol
+        self.parity_error = None
+        self._graph = None
+
+    @property
+    def UNet(self):
+        return self.model.UNet
+
+    def __repr__(self):
+        return f'BackendModel(backend={self.backend}, path={self.path})'
+
+    def __getstate__(self):
+        # The graph is built again in the process the model is sent to
+        state = self.__dict__.copy()
+        state['_graph'] = None
+        return state
+
+    def _build(self, inputs):
+        if self.backend == 'compile':
+            return torch.compile(self.model)
+        if self.backend == 'torchscript':
+            if self.path is not None:
+                return torch.jit.load(self.path, map_location=inputs.device)
+            return export_torchscript(self.model, inputs)
+        if self.backend == 'onnxruntime':
+            path = self.path
+            if path is None:
+                path = os.path.join(tempfile.mkdtemp(prefix='v2ce-onnx-'), 'v2ce_3d.onnx')
+                export_onnx(self.model, inputs, path, dynamic_width=True)
+            return OnnxRuntimeModel(path, device=inputs.device)
+        return self.model
+
+    @torch.no_grad()
+    def _build_checked(self, inputs):
+        if self.backend == 'eager':
+            return self.model
+        try:
+            graph = self._build(inputs)
+            outputs = graph(inputs)
+            reference = self.model(inputs)
+            self.parity_error = (outputs.float() - reference.float()).abs().max().item()
+            if not torch.allclose(outputs.float(), reference.float(), atol=self.atol, rtol=self.rtol):
+                logger.warning(f'The {self.backend} backend does not match the eager model (max abs error '
+                               f'{self.parity_error:.3e}), running it eagerly')
+                return self.model
+        except Exception as e:
+            logger.warning(f'Failed to run the {self.backend} backend, running it eagerly: {e}')
+            return self.model
+        logger.info(f'Running the {self.backend} backend, max abs error to the eager model {self.parity_error:.3e}')
+        return graph
+
+    def forward(self, inputs):
+        if self._graph is None:
+            # Not registered as a submodule, the graph is not part of the state of the model
+            object.__setattr__(self, '_graph', self._build_checked(inputs))
+        return self._graph(inputs)
@@ -0,0 +1,141 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Request:
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class DynamicBatcher:
+    """Merges the inputs submitted by concurrent clients into batches, run on a single worker thread.
+
+    The first waiting input opens a batch, which is closed when it holds `max_batch_size` inputs or
+    when the first input has waited `max_delay` seconds, whichever comes first. The inputs of a
+    batch are stacked by shape, so clients sending frames of different sizes share the worker but
+    not the forwards.
+    """
+
+    def __init__(self, infer_fn, max_batch_size=8, max_delay=0.02, name='dynamic-batcher'):
+        """
+        Args:
+            infer_fn: the function inferring a batch, mapping stacked inputs (B, ...) to outputs (B, ...)
+            max_batch_size: the maximum number of inputs in a batch
+            max_delay: the maximum time in seconds the first input of a batch waits for others
+            name: the name of the worker thread
+        """
+        assert max_batch_size > 0
+        self.infer_fn = infer_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+        # Statistics
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = {}
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+        self.infer_time = 0.
+
+    def submit(self, inputs):
+        """ Queue an input for the next batches
+        Args:
+            inputs: a tensor, stacked with the inputs of the same shape
+        Returns:
+            future: the future of the output of the input
+        """
+        request = _Request(inputs)
+        self._queue.put(request)
+        return request.future
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return None, True
+        batch = [first]
+        deadline = first.arrival + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request is _STOP:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            # Drop the inputs whose client gave up waiting
+            batch = [request for request in batch or [] if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.perf_counter()
+            groups = {}
+            for request in batch:
+                groups.setdefault(tuple(request.inputs.shape), []).append(request)
+            for requests in groups.values():
+                try:
+                    outputs = self.infer_fn(torch.stack([request.inputs for request in requests]))
+                except Exception as e:
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, output in zip(requests, outputs):
+                    request.future.set_result(output)
+
+            with self._lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                wait_time = max(start - request.arrival for request in batch)
+                self.wait_time += sum(start - request.arrival for request in batch)
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+                self.infer_time += time.perf_counter() - start
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        """ Return the batching statistics
+        Returns:
+            a dict with the queue depth, the number of requests and batches, the histogram of the
+            batch sizes, and the mean waiting and inference times in seconds
+        """
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / max(self.batches, 1),
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'mean_wait_s': self.wait_time / max(self.requests, 1),
+                'max_wait_s': self.max_wait_time,
+                'mean_infer_s': self.infer_time / max(self.batches, 1),
+            }
+
+    def close(self):
+        """ Infer the queued inputs and stop the worker thread """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
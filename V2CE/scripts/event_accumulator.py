@@ -0,0 +1,234 @@
+"""
+Accumulate event streams back into dense representations: event frames, time surfaces and voxel grids in the
+(2, 10, H, W) layout of the stage 1 voxels, e.g. to compare the events of a conversion with its voxels.
+
+The events are structured arrays of EVENT_DTYPE. Every accumulation is a single scatter over the flat output
+index of the events (`np.bincount`, `np.maximum.at`), or its torch equivalent on `device` when it is set, the
+result is then a tensor.
+As in the voxels, the first channel holds the positive events (polarity 1) and the second the negative ones.
+"""
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+INTERPOLATIONS = ('bilinear', 'nearest')
+
+
+def slice_events(events, t0=None, t1=None):
+    """ The events in the time window [t0, t1), by a binary search
+    Args:
+        events: a structured array of EVENT_DTYPE, sorted by timestamp
+        t0, t1: the time window in microseconds, None for no bound
+    Returns:
+        events: a view of the events in the window
+    """
+    timestamps = events['timestamp']
+    start = 0 if t0 is None else int(np.searchsorted(timestamps, t0, side='left'))
+    end = len(events) if t1 is None else int(np.searchsorted(timestamps, t1, side='left'))
+    return events[start:end]
+
+
+def _columns(events, size, device=None):
+    """ The timestamps, the y and x coordinates and the channel (0 for the positive events) of the events, as
+    arrays of an integer type indexing an output of `size` elements (int32 when it fits), or as int64 tensors
+    on `device` """
+    events = np.asarray(events)
+    columns = [events['y'], events['x'], events['polarity']]
+    if device is None:
+        index_dtype = np.int32 if size < 2 ** 31 else np.int64
+        timestamps = events['timestamp'].astype(np.int64, copy=False)
+        y, x, polarity = [c.astype(index_dtype) for c in columns]
+    else:
+        timestamps, y, x, polarity = [torch.from_numpy(np.ascontiguousarray(c)).to(device=device, dtype=torch.long)
+                                      for c in [events['timestamp']] + columns]
+    return timestamps, y, x, 1 - polarity
+
+
+def _floor(values, like):
+    """ The floor of non-negative float values, as integers of the type of `like` """
+    if isinstance(values, torch.Tensor):
+        return torch.floor(values).to(like.dtype)
+    return values.astype(like.dtype)
+
+
+def _clip(values, low, high):
+    """ Clip integer values in place """
+    if isinstance(values, torch.Tensor):
+        return values.clamp_(low, high)
+    return np.clip(values, low, high, out=values)
+
+
+def _relative_time(timestamps, t0, scale):
+    """ (timestamps - t0) * scale as float32, the differences of the timestamps are exact """
+    relative = timestamps - t0
+    relative = relative.float() if isinstance(relative, torch.Tensor) else relative.astype(np.float32)
+    relative *= scale
+    return relative
+
+
+def _zeros(size, device=None):
+    return np.zeros(size, dtype=np.float32) if device is None else torch.zeros(size, device=device)
+
+
+def _bincount(index, size, weights=None):
+    """ Sum the weights (or count the events) of every flat index of an output of `size` elements, as float32 """
+    if isinstance(index, torch.Tensor):
+        return torch.bincount(index, weights=weights, minlength=size).float()
+    return np.bincount(index, weights=weights, minlength=size).astype(np.float32)
+
+
+def _time_window(events, t0, t1):
+    timestamps = events['timestamp']
+    t0 = int(timestamps.min()) if t0 is None else int(t0)
+    t1 = int(timestamps.max()) + 1 if t1 is None else int(t1)
+    assert t1 > t0, f'Empty time window [{t0}, {t1})'
+    return t0, t1
+
+
+def _in_window(events, t0, t1):
+    """ The events in [t0, t1), without copying them when they all are """
+    timestamps = events['timestamp']
+    if len(events) == 0 or (timestamps.min() >= t0 and timestamps.max() < t1):
+        return events
+    return events[(timestamps >= t0) & (timestamps < t1)]
+
+
+def event_frames(events, height, width, t0=None, t1=None, num_frames=1, device=None):
+    """ Count the events of each pixel and polarity in consecutive time windows
+    Args:
+        events: a structured array of EVENT_DTYPE
+        height, width: the size of the frames
+        t0, t1: the time span [t0, t1) of the frames in microseconds, None for the span of the events
+        num_frames: the number of frames, each covering (t1 - t0) / num_frames
+        device: the torch device to accumulate on, None to accumulate with numpy
+    Returns:
+        frames: the event counts, float32. Shape: (num_frames, 2, height, width)
+    """
+    if len(events) == 0 and (t0 is None or t1 is None):
+        return _zeros(num_frames * 2 * height * width, device).reshape(num_frames, 2, height, width)
+    t0, t1 = _time_window(events, t0, t1)
+    size = num_frames * 2 * height * width
+    timestamps, y, x, channel = _columns(_in_window(events, t0, t1), size, device)
+    # The time of the last events may round up to the end of the window
+    frame = _clip(_floor(_relative_time(timestamps, t0, num_frames / (t1 - t0)), like=y), 0, num_frames - 1)
+    index = ((frame * 2 + channel) * height + y) * width + x
+    return _bincount(index, size).reshape(num_frames, 2, height, width)
+
+
+def time_surface(events, height, width, t_ref=None, tau=None, device=None):
+    """ The time of the last event of each pixel and polarity, decayed exponentially when `tau` is set
+    Args:
+        events: a structured array of EVENT_DTYPE
+        height, width: the size of the surface
+        t_ref: the time the surface is computed at in microseconds, the later events are ignored. None for the
+            time of the last event
+        tau: the decay time constant in microseconds, None for the timestamps of the last events
+    Returns:
+        surface: with `tau`, exp(-(t_ref - t_last) / tau) as float32, 0 where there was no event. Otherwise the
+            timestamps of the last events as int64, -1 where there was no event. Shape: (2, height, width)
+    """
+    if t_ref is not None:
+        events = _in_window(events, np.iinfo(np.int64).min, int(t_ref) + 1)
+    timestamps, y, x, channel = _columns(events, 2 * height * width, device)
+    index = (channel * height + y) * width + x
+    if isinstance(index, torch.Tensor):
+        last = torch.full((2 * height * width,), -1, dtype=torch.long, device=index.device)
+        last.scatter_reduce_(0, index, timestamps, reduce='amax')
+    else:
+        last = np.full(2 * height * width, -1, dtype=np.int64)
+        np.maximum.at(last, index, timestamps)
+    last = last.reshape(2, height, width)
+    if tau is None:
+        return last
+    if t_ref is None:
+        t_ref = int(last.max())
+    if isinstance(last, torch.Tensor):
+        return torch.where(last >= 0, torch.exp((last - t_ref).double() / tau), 0).float()
+    return np.where(last >= 0, np.exp((last - t_ref) / tau), 0).astype(np.float32)
+
+
+def _accumulate_voxels(plane, position, pixel_index, num_planes, num_bins, num_pixels, interpolation):
+    """ Accumulate events into voxel grids
+    Args:
+        plane: the index of the (frame, channel) plane of each event
+        position: the position of each event in [0, 1] of the time window of its plane, float32
+        pixel_index: the flat pixel index of each event
+        num_planes, num_bins, num_pixels: the size of the output
+        interpolation: bilinear or nearest, see `voxel_grid`
+    Returns:
+        voxels: float32. Shape: (num_planes * num_bins * num_pixels,)
+    """
+    assert interpolation in INTERPOLATIONS, f'Invalid interpolation {interpolation}'
+    size = num_planes * num_bins * num_pixels
+    position = position * (num_bins - 1)
+    if interpolation == 'nearest':
+        position += 0.5
+        return _bincount((plane * num_bins + _floor(position, like=plane)) * num_pixels + pixel_index, size)
+    # The bins are sampled at the start and at the end of the window, every event is shared between the two
+    # bins around it. An event at the end of the window falls in the last bin, with a weight of 1
+    left = _clip(_floor(position, like=plane), 0, num_bins - 2)
+    right_weight = position - left
+    index = (plane * num_bins + left) * num_pixels + pixel_index
+    # A single count over both bins, the output can be much larger than the events
+    concatenate = torch.cat if isinstance(index, torch.Tensor) else np.concatenate
+    return _bincount(concatenate((index, index + num_pixels)), size, weights=concatenate((1 - right_weight, right_weight)))
+
+
+def voxel_grid(events, height, width, t0=None, t1=None, num_bins=10, interpolation='bilinear', device=None):
+    """ Accumulate the events of a time window into a voxel grid
+    Args:
+        events: a structured array of EVENT_DTYPE
+        height, width: the size of the grid
+        t0, t1: the time window [t0, t1] in microseconds, None for the span of the events. With bilinear
+            interpolation, the first bin is at t0 and the last one at t1
+        num_bins: the number of time bins
+        interpolation: bilinear to share every event between the two bins around it, like the stage 1 voxels,
+            or nearest to count it in the nearest bin
+        device: the torch device to accumulate on, None to accumulate with numpy
+    Returns:
+        voxels: float32. Shape: (2, num_bins, height, width)
+    """
+    if len(events) == 0 and (t0 is None or t1 is None):
+        return _zeros(2 * num_bins * height * width, device).reshape(2, num_bins, height, width)
+    t0, t1 = _time_window(events, t0, None if t1 is None else int(t1) + 1)
+    timestamps, y, x, channel = _columns(_in_window(events, t0, t1), 2 * num_bins * height * width, device)
+    position = _relative_time(timestamps, t0, 1 / max(t1 - 1 - t0, 1))
+    voxels = _accumulate_voxels(channel, position, y * width + x, 2, num_bins, height * width, interpolation)
+    return voxels.reshape(2, num_bins, height, width)
+
+
+def frame_voxel_grids(events, height, width, num_frames, fps=30, start_frame=0, num_bins=10, interpolation='bilinear', device=None):
+    """ Accumulate the events of consecutive video frames into their voxel grids, the inverse of stage 2
+    The frame n of the video spans 1 / fps from its start at int(n / fps * 1e6) microseconds, like the events
+    written by v2ce.py.
+    Args:
+        events: a structured array of EVENT_DTYPE, the events out of the frames are ignored
+        height, width: the size of the grids
+        num_frames: the number of frames
+        fps: the FPS of the video
+        start_frame: the index of the first frame
+        num_bins: the number of time bins of each frame
+        interpolation: bilinear or nearest, see `voxel_grid`
+        device: the torch device to accumulate on, None to accumulate with numpy
+    Returns:
+        voxels: float32. Shape: (num_frames, 2, num_bins, height, width)
+    """
+    frame_starts = np.array([int((start_frame + i) * 1 / fps * 1e6) for i in range(num_frames + 1)], dtype=np.int64)
+    frame_duration = 1 / fps * 1e6
+    # The last frame spans a full frame duration, like the others
+    events = _in_window(events, frame_starts[0], frame_starts[-2] + int(np.ceil(frame_duration)) + 1)
+    timestamps, y, x, channel = _columns(events, num_frames * 2 * num_bins * height * width, device)
+    if isinstance(timestamps, torch.Tensor):
+        starts = torch.from_numpy(frame_starts).to(timestamps.device)
+        frame = torch.searchsorted(starts[:-1], timestamps, right=True) - 1
+        position = ((timestamps - starts[frame]).float() / frame_duration).clamp(max=1)
+    else:
+        frame = (np.searchsorted(frame_starts[:-1], timestamps, side='right') - 1).astype(y.dtype)
+        position = (timestamps - frame_starts[frame]).astype(np.float32)
+        position /= frame_duration
+        np.minimum(position, 1, out=position)
+    voxels = _accumulate_voxels(frame * 2 + channel, position, y * width + x, num_frames * 2, num_bins, height * width, interpolation)
+    return voxels.reshape(num_frames, 2, num_bins, height, width)
@@ -0,0 +1,175 @@
+import logging
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class QuantileSketch:
+    """Mergeable histogram of positive values, with log-spaced bins, to estimate quantiles in a single pass.
+
+    Every value is counted in the bin [gamma^i, gamma^(i+1)), so the estimated quantile is within
+    `relative_accuracy` of a value of the data. Sketches with the same parameters can be merged,
+    e.g. to combine the statistics of shards converted separately.
+    """
+
+    def __init__(self, relative_accuracy=0.005, min_value=1e-4, max_value=1e4):
+        """
+        Args:
+            relative_accuracy: the relative error of the estimated quantiles
+            min_value: values below are counted in the first bin
+            max_value: values above are counted in the last bin
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self._num_bins = int(np.ceil(np.log(max_value / min_value) / self._log_gamma)) + 1
+        self.counts = np.zeros(self._num_bins, dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def add(self, values):
+        """ Count the positive values, the others are ignored """
+        values = np.asarray(values).ravel()
+        values = values[values > 0]
+        if len(values) == 0:
+            return
+        index = np.floor(np.log(np.clip(values, self.min_value, self.max_value) / self.min_value) / self._log_gamma)
+        self.counts += np.bincount(index.astype(np.int64), minlength=self._num_bins)[:self._num_bins]
+
+    def merge(self, other):
+        assert (self.relative_accuracy, self.min_value, self.max_value) == \
+               (other.relative_accuracy, other.min_value, other.max_value), 'Cannot merge sketches with different bins'
+        self.counts += other.counts
+        return self
+
+    def quantile(self, percentile):
+        """ Estimate a percentile of the counted values
+        Args:
+            percentile: the percentile, in [0, 100]
+        Returns:
+            value: the estimated percentile, None if no value was counted
+        """
+        total = self.count
+        if total == 0:
+            return None
+        rank = percentile / 100 * (total - 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank, side='right'))
+        # The geometric center of the bin is within the relative accuracy of any value of the bin
+        return float(self.min_value * np.exp((index + 0.5) * self._log_gamma))
+
+
+def voxels_to_event_frames(voxels, keep_polarity=True):
+    """ Sum the voxels over the time bins into RGB event frames
+    Args:
+        voxels: the voxels. Shape: (N, 2, 10, H, W)
+        keep_polarity: put the two polarities in the red and green channels, otherwise sum them in all channels
+    Returns:
+        event_frames: the float32 event frames. Shape: (N, H, W, 3)
+    """
+    N, P, L, H, W = voxels.shape
+    event_frames = np.zeros((N, H, W, 3), dtype=np.float32)
+    if keep_polarity:
+        summed = voxels.sum(axis=2, dtype=np.float32)  # (N, P, H, W)
+        event_frames[..., 0] = summed[:, 0]
+        event_frames[..., 1] = summed[:, 1]
+    else:
+        event_frames[...] = voxels.sum(axis=(1, 2), dtype=np.float32)[..., np.newaxis]
+    return event_frames
+
+
+class EventFrameVideoWriter:
+    """Writes the event frame video of the voxels as they are predicted.
+
+    The event frames are normalized by an upper bound, the smaller of `ceil` and the
+    `upper_bound_percentile` percentile of the nonzero event frame values. The percentile is
+    estimated with a QuantileSketch over the first `warmup_frames` frames, which are buffered
+    until then. The bound is then fixed, so every frame is written once, as uint8, and the
+    clip is never materialized. The sketch keeps counting the rest of the clip, and the
+    percentile of the whole clip is logged on close.
+    """
+
+    def __init__(self, path, fps, ceil=10, upper_bound_percentile=98, keep_polarity=True,
+                 upper_bound=None, warmup_frames=150):
+        """
+        Args:
+            path: the path of the video
+            fps: the FPS of the video
+            ceil: the ceiling of the event frame value
+            upper_bound_percentile: the percentile of the nonzero event frame values used as the upper bound
+            keep_polarity: whether to keep the polarity of the events in the colors
+            upper_bound: a preset upper bound, skipping the estimation and the warmup buffer
+            warmup_frames: the number of frames the upper bound is estimated on, None to buffer the
+                whole clip (the frames are then only written on close)
+        """
+        self.path = str(path)
+        self.fps = fps
+        self.ceil = ceil
+        self.upper_bound_percentile = upper_bound_percentile
+        self.keep_polarity = keep_polarity
+        self.upper_bound = upper_bound
+        self.warmup_frames = warmup_frames
+        self.sketch = QuantileSketch()
+        self.num_frames = 0
+        self._pending = []
+        self._pending_num = 0
+        self._video = None
+
+    def write(self, voxels):
+        """ Append the event frames of a batch of voxels
+        Args:
+            voxels: the voxels. Shape: (N, 2, 10, H, W)
+        """
+        event_frames = voxels_to_event_frames(voxels, self.keep_polarity)
+        self.sketch.add(event_frames[..., :2] if self.keep_polarity else event_frames[..., 0])
+        if self.upper_bound is not None:
+            self._write_frames(event_frames)
+            return
+        self._pending.append(event_frames)
+        self._pending_num += len(event_frames)
+        if self.warmup_frames is not None and self._pending_num >= self.warmup_frames:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if self.upper_bound is None:
+            percentile = self.sketch.quantile(self.upper_bound_percentile)
+            self.upper_bound = self.ceil if percentile is None else min(percentile, self.ceil)
+            logger.info(f'Upper bound of the event frame value during video writing: {self.upper_bound:.4g} '
+                        f'(estimated on {self._pending_num} frames)')
+        for event_frames in self._pending:
+            self._write_frames(event_frames)
+        self._pending = []
+        self._pending_num = 0
+
+    def _write_frames(self, event_frames):
+        N, H, W, _ = event_frames.shape
+        if self._video is None:
+            self._video = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (W, H))
+        # Clip and scale in place, the RGB channels are written in the BGR order of OpenCV
+        np.clip(event_frames, 0, self.upper_bound, out=event_frames)
+        event_frames *= 255 / self.upper_bound
+        frames = event_frames.astype(np.uint8)[..., ::-1]
+        for frame in frames:
+            self._video.write(np.ascontiguousarray(frame))
+        self.num_frames += N
+
+    def close(self):
+        if self._pending_num > 0:
+            self._flush_pending()
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+            percentile = self.sketch.quantile(self.upper_bound_percentile)
+            if percentile is not None:
+                logger.debug(f'{self.upper_bound_percentile}th percentile of the whole clip: {percentile:.4g}')
+            logger.info(f'Event frame video written to {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,608 @@
+import os
+import zlib
+import logging
+import zipfile
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+logger = logging.getLogger(__name__)
+
+EVENT_DTYPE = np.dtype([('timestamp', '<i8'), ('x', '<i2'), ('y', '<i2'), ('polarity', 'i1')])
+
+# Room for the largest header (any int64 row count), the header is rewritten in place when the writer is closed
+_HEADER_SIZE = 256
+
+
+def _npy_header(dtype, num_rows):
+    """ Build a fixed-size .npy (version 1.0) header for a 1-d array """
+    header = repr({'descr': npy_format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (num_rows,)})
+    magic = npy_format.magic(1, 0)
+    # The header is followed by the 2-byte header length and ends with a newline
+    header = header.ljust(_HEADER_SIZE - len(magic) - 2 - 1) + '\n'
+    assert len(header) == _HEADER_SIZE - len(magic) - 2, 'Event dtype too large for the .npy header'
+    return magic + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+class EventBuffer:
+    """A preallocated array of events, reused by successive stage 2 calls instead of allocating their output.
+
+    The array returned by `reserve` is only valid until the next call, its events must be consumed
+    (e.g. written) before that.
+    """
+
+    def __init__(self, capacity=0, dtype=EVENT_DTYPE):
+        """
+        Args:
+            capacity: the number of events preallocated, grown as needed
+            dtype: the structured dtype of the events
+        """
+        self.dtype = np.dtype(dtype)
+        self._array = np.empty(capacity, dtype=self.dtype)
+
+    @property
+    def capacity(self):
+        return len(self._array)
+
+    def reserve(self, num_events):
+        """ The first `num_events` rows of the buffer, grown by at least half its capacity when it is too small """
+        if num_events > len(self._array):
+            self._array = np.empty(max(num_events, len(self._array) * 3 // 2), dtype=self.dtype)
+        return self._array[:num_events]
+
+
+class NpzEventWriter:
+    """Appends event batches to a .npz file without keeping the event stream in memory.
+
+    The events are streamed to a temporary .npy file next to the output, whose header is patched
+    with the final event count on `close`, and then stored in the .npz archive under `key`.
+    The result is the same file `np.savez(path, **{key: event_stream})` writes.
+    """
+
+    def __init__(self, path, key='event_stream', dtype=EVENT_DTYPE):
+        """
+        Args:
+            path: the path of the .npz file
+            key: the name of the array in the archive
+            dtype: the structured dtype of the events
+        """
+        self.path = str(path)
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.num_events = 0
+        self._tmp_path = self.path + '.tmp.npy'
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(_npy_header(self.dtype, 0))
+
+    def write(self, events):
+        """ Append a batch of events
+        Args:
+            events: a structured array (or recarray) with the fields of `dtype`
+        """
+        assert self._file is not None, 'The writer is closed'
+        events = np.ascontiguousarray(events, dtype=self.dtype)
+        # Written from the memory of the array, without copying it to bytes
+        self._file.write(events.data)
+        self.num_events += len(events)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, self.num_events))
+        self._file.close()
+        self._file = None
+        # Stored uncompressed with zip64, like np.savez
+        with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            archive.write(self._tmp_path, arcname=self.key + '.npy')
+        os.remove(self._tmp_path)
+        logger.debug(f'Wrote {self.num_events} events to {self.path}')
+
+    def abort(self):
+        """ Drop the events written so far, without creating the .npz file """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Chunked event container: a data file of compressed column chunks, and an append-only index with one
+# record per chunk, so a time window or a region is read by decompressing only the chunks overlapping it
+CHUNKED_MAGIC = b'V2CE-EVC'
+CHUNKED_INDEX_MAGIC = b'V2CE-IDX'
+CHUNKED_VERSION = 1
+CHUNK_COLUMNS = ('timestamp', 'x', 'y', 'polarity')
+CHUNK_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('num_events', '<u4'), ('t_min', '<i8'), ('t_max', '<i8'),
+                              ('x_min', '<i2'), ('x_max', '<i2'), ('y_min', '<i2'), ('y_max', '<i2'),
+                              ('sizes', '<u4', (len(CHUNK_COLUMNS),))])
+_INDEX_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('chunk_size', '<u4')])
+
+
+def chunked_index_path(path):
+    return str(path) + '.idx'
+
+
+class ChunkedEventWriter:
+    """Appends events to a chunked event file (see `ChunkedEventReader`).
+
+    Events are buffered into chunks of `chunk_size` events. Each full chunk is stored as one zlib
+    compressed blob per column (the timestamps delta encoded), and its time range and bounding box
+    are appended to the index file next to it. An interrupted file can be resumed from any of its
+    chunks, e.g. the last one flushed at a checkpoint.
+    """
+
+    def __init__(self, path, chunk_size=65536, compression_level=1, resume_chunks=None):
+        """
+        Args:
+            path: the path of the data file, the index is written to `path + '.idx'`
+            chunk_size: the number of events per chunk, the last chunk may be smaller
+            compression_level: the zlib compression level
+            resume_chunks: the number of chunks of an existing file to keep and append to, None to start a new file
+        """
+        self.path = str(path)
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.num_events = 0
+        self.num_chunks = 0
+        self._buffer = np.empty(chunk_size, dtype=EVENT_DTYPE)
+        self._buffered = 0
+        if resume_chunks is None:
+            self._file = open(self.path, 'wb')
+            self._file.write(CHUNKED_MAGIC)
+            self._index_file = open(chunked_index_path(self.path), 'wb')
+            self._index_file.write(np.array([(CHUNKED_INDEX_MAGIC, CHUNKED_VERSION, chunk_size)], dtype=_INDEX_HEADER_DTYPE).tobytes())
+        else:
+            self._resume(resume_chunks)
+
+    def _resume(self, num_chunks):
+        # Drop the chunks written after the first `num_chunks`, and anything partially written after them
+        with ChunkedEventReader(self.path) as reader:
+            assert reader.num_chunks >= num_chunks, f'{self.path} has {reader.num_chunks} chunks, cannot resume from chunk {num_chunks}'
+            kept = reader.index[:num_chunks].copy()
+        data_size = int(kept['offset'][-1]) + int(kept['sizes'][-1].sum()) if num_chunks > 0 else len(CHUNKED_MAGIC)
+        index_size = _INDEX_HEADER_DTYPE.itemsize + num_chunks * CHUNK_INDEX_DTYPE.itemsize
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(data_size)
+        self._file.seek(data_size)
+        self._index_file = open(chunked_index_path(self.path), 'r+b')
+        self._index_file.truncate(index_size)
+        self._index_file.seek(index_size)
+        self.num_events = int(kept['num_events'].sum())
+        self.num_chunks = num_chunks
+        logger.debug(f'Resuming {self.path} after {self.num_events} events in {self.num_chunks} chunks')
+
+    def write(self, events):
+        """ Append a batch of events
+        Args:
+            events: a structured array (or recarray) with the fields of EVENT_DTYPE
+        """
+        assert self._file is not None, 'The writer is closed'
+        events = np.asarray(events)
+        start = 0
+        while start < len(events):
+            n = min(self.chunk_size - self._buffered, len(events) - start)
+            for name in CHUNK_COLUMNS:
+                self._buffer[name][self._buffered:self._buffered + n] = events[name][start:start + n]
+            self._buffered += n
+            start += n
+            if self._buffered == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """ Write the buffered events as a (possibly smaller) chunk, so that every event written so far is in the file """
+        if self._buffered == 0:
+            return
+        chunk = self._buffer[:self._buffered]
+        timestamp = chunk['timestamp']
+        columns = (np.diff(timestamp, prepend=np.int64(0)), chunk['x'], chunk['y'], chunk['polarity'])
+        blobs = [zlib.compress(np.ascontiguousarray(c).tobytes(), self.compression_level) for c in columns]
+
+        record = np.zeros(1, dtype=CHUNK_INDEX_DTYPE)
+        record['offset'] = self._file.tell()
+        record['num_events'] = len(chunk)
+        record['t_min'], record['t_max'] = timestamp.min(), timestamp.max()
+        record['x_min'], record['x_max'] = chunk['x'].min(), chunk['x'].max()
+        record['y_min'], record['y_max'] = chunk['y'].min(), chunk['y'].max()
+        record['sizes'] = [len(b) for b in blobs]
+        for blob in blobs:
+            self._file.write(blob)
+        # The data is flushed before its index record, so an interrupted file stays readable up to the last chunk
+        self._file.flush()
+        self._index_file.write(record.tobytes())
+        self._index_file.flush()
+
+        self.num_events += len(chunk)
+        self.num_chunks += 1
+        self._buffered = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._index_file.close()
+        self._file = self._index_file = None
+        logger.debug(f'Wrote {self.num_events} events in {self.num_chunks} chunks to {self.path}')
+
+    def abort(self):
+        """ Close the files, keeping the chunks written so far """
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+            self._file = self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ChunkedEventReader:
+    """Reads time windows and regions out of a chunked event file.
+
+    The data file is memory-mapped, and only the chunks whose time range and bounding box overlap
+    the query are decompressed, so reading a short window does not depend on the size of the file.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the path of the data file written by `ChunkedEventWriter`
+        """
+        self.path = str(path)
+        with open(chunked_index_path(self.path), 'rb') as f:
+            header = np.frombuffer(f.read(_INDEX_HEADER_DTYPE.itemsize), dtype=_INDEX_HEADER_DTYPE)
+            assert len(header) == 1 and header['magic'][0] == CHUNKED_INDEX_MAGIC, f'Not a chunked event index: {f.name}'
+            assert header['version'][0] <= CHUNKED_VERSION, f'Unsupported chunked event version {header["version"][0]}'
+            self.chunk_size = int(header['chunk_size'][0])
+            index = f.read()
+        # Ignore a partially written record at the end of an interrupted file
+        self.index = np.frombuffer(index[:len(index) - len(index) % CHUNK_INDEX_DTYPE.itemsize], dtype=CHUNK_INDEX_DTYPE)
+        self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        assert bytes(self._data[:len(CHUNKED_MAGIC)]) == CHUNKED_MAGIC, f'Not a chunked event file: {self.path}'
+
+    @property
+    def num_events(self):
+        return int(self.index['num_events'].sum())
+
+    @property
+    def num_chunks(self):
+        return len(self.index)
+
+    @property
+    def time_range(self):
+        """ The first and the last timestamp of the file, in microseconds """
+        if len(self.index) == 0:
+            return None
+        return int(self.index['t_min'].min()), int(self.index['t_max'].max())
+
+    def __len__(self):
+        return self.num_events
+
+    def read_chunk(self, chunk_idx):
+        """ Decompress a chunk
+        Args:
+            chunk_idx: the index of the chunk
+        Returns:
+            events: a structured array with the fields of EVENT_DTYPE
+        """
+        record = self.index[chunk_idx]
+        events = np.empty(int(record['num_events']), dtype=EVENT_DTYPE)
+        offset = int(record['offset'])
+        for name, size in zip(CHUNK_COLUMNS, record['sizes']):
+            blob = zlib.decompress(self._data[offset:offset + int(size)])
+            events[name] = np.frombuffer(blob, dtype=EVENT_DTYPE[name])
+            offset += int(size)
+        events['timestamp'] = np.cumsum(events['timestamp'])
+        return events
+
+    def select_chunks(self, t0=None, t1=None, roi=None):
+        """ Find the chunks which may hold events in the time window and the region
+        Args:
+            t0, t1: the time window [t0, t1) in microseconds, None for no bound
+            roi: the region (x0, y0, x1, y1), covering x0 <= x < x1 and y0 <= y < y1, None for the whole sensor
+        Returns:
+            chunk_idxs: the indices of the chunks
+        """
+        selection = np.ones(len(self.index), dtype=bool)
+        if t0 is not None:
+            selection &= self.index['t_max'] >= t0
+        if t1 is not None:
+            selection &= self.index['t_min'] < t1
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            selection &= (self.index['x_max'] >= x0) & (self.index['x_min'] < x1) & \
+                         (self.index['y_max'] >= y0) & (self.index['y_min'] < y1)
+        return np.nonzero(selection)[0]
+
+    def read(self, t0=None, t1=None, roi=None):
+        """ Read the events in a time window and a region
+        Args:
+            t0, t1: the time window [t0, t1) in microseconds, None for no bound
+            roi: the region (x0, y0, x1, y1), covering x0 <= x < x1 and y0 <= y < y1, None for the whole sensor
+        Returns:
+            events: a structured array with the fields of EVENT_DTYPE, in file order
+        """
+        selected = []
+        for chunk_idx in self.select_chunks(t0, t1, roi):
+            events = self.read_chunk(chunk_idx)
+            mask = np.ones(len(events), dtype=bool)
+            if t0 is not None:
+                mask &= events['timestamp'] >= t0
+            if t1 is not None:
+                mask &= events['timestamp'] < t1
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                mask &= (events['x'] >= x0) & (events['x'] < x1) & (events['y'] >= y0) & (events['y'] < y1)
+            selected.append(events if mask.all() else events[mask])
+        if len(selected) == 0:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return np.concatenate(selected)
+
+    def close(self):
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# EVT 2.0 encoding (the Prophesee .raw format): one little-endian 32-bit word per event, with a 4-bit type,
+# the 6 low bits of the timestamp and the 11-bit x and y, and a TIME_HIGH word holding the 28 high bits of
+# the timestamp whenever they change. A stream of dense events costs about 4 bytes per event.
+EVT2_CD_OFF = 0x0
+EVT2_CD_ON = 0x1
+EVT2_TIME_HIGH = 0x8
+EVT2_TIME_LOW_BITS = 6
+EVT2_TIME_BITS = 34
+EVT2_COORD_BITS = 11
+_EVT2_WORD_DTYPE = np.dtype('<u4')
+
+
+def encode_evt2(events, time_high=-1):
+    """ Encode events as EVT 2.0 words
+    Args:
+        events: a structured array with the fields of EVENT_DTYPE, timestamps in [0, 2**34) microseconds and
+            coordinates below 2048. The events are best sorted by timestamp, every change of the 28 high
+            bits of the timestamp costs a word
+        time_high: the time high of the words written before these, -1 for none
+    Returns:
+        words: the words. Shape: (N,), uint32
+        time_high: the time high of the last word, to encode the next events
+    """
+    events = np.asarray(events)
+    if len(events) == 0:
+        return np.empty(0, dtype=_EVT2_WORD_DTYPE), time_high
+    ts = events['timestamp'].astype(np.int64, copy=False)
+    x, y = events['x'], events['y']
+    assert ts.min() >= 0 and ts.max() < 2 ** EVT2_TIME_BITS, f'EVT 2.0 timestamps are in [0, 2**{EVT2_TIME_BITS}) microseconds'
+    assert min(x.min(), y.min()) >= 0 and max(x.max(), y.max()) < 2 ** EVT2_COORD_BITS, \
+        f'EVT 2.0 coordinates are below {2 ** EVT2_COORD_BITS}'
+
+    # A TIME_HIGH word goes before every event whose time high differs from the previous one
+    high = ts >> EVT2_TIME_LOW_BITS
+    new_high = np.empty(len(ts), dtype=bool)
+    new_high[0] = high[0] != time_high
+    np.not_equal(high[1:], high[:-1], out=new_high[1:])
+    positions = np.cumsum(new_high)
+    positions += np.arange(len(ts))
+
+    words = np.empty(len(ts) + int(positions[-1] - len(ts) + 1), dtype=_EVT2_WORD_DTYPE)
+    words[positions] = (events['polarity'].astype(np.uint32) << 28) \
+        | ((ts & (2 ** EVT2_TIME_LOW_BITS - 1)).astype(np.uint32) << 22) \
+        | (x.astype(np.uint32) << EVT2_COORD_BITS) | y.astype(np.uint32)
+    words[positions[new_high] - 1] = (EVT2_TIME_HIGH << 28) | high[new_high].astype(np.uint32)
+    return words, int(high[-1])
+
+
+def decode_evt2(words, time_high=0):
+    """ Decode EVT 2.0 words, the words of other types (e.g. external triggers) are skipped
+    Args:
+        words: the words. Shape: (N,), uint32
+        time_high: the time high of the words before these, for the events before their first TIME_HIGH word
+    Returns:
+        events: a structured array of EVENT_DTYPE
+        time_high: the time high after the last word, to decode the next words
+    """
+    words = np.asarray(words, dtype=_EVT2_WORD_DTYPE)
+    types = words >> 28
+    # The time high of each word is the one of the last TIME_HIGH word before it
+    is_time_high = types == EVT2_TIME_HIGH
+    last_time_high = np.maximum.accumulate(np.where(is_time_high, np.arange(len(words)), -1)) if len(words) > 0 \
+        else np.empty(0, dtype=np.int64)
+    high = np.where(last_time_high >= 0, words[last_time_high] & 0x0FFFFFFF, time_high)
+
+    is_event = types <= EVT2_CD_ON
+    event_words, event_high = words[is_event], high[is_event]
+    events = np.empty(len(event_words), dtype=EVENT_DTYPE)
+    events['timestamp'] = (event_high.astype(np.int64) << EVT2_TIME_LOW_BITS) | ((event_words >> 22) & (2 ** EVT2_TIME_LOW_BITS - 1))
+    events['x'] = (event_words >> EVT2_COORD_BITS) & (2 ** EVT2_COORD_BITS - 1)
+    events['y'] = event_words & (2 ** EVT2_COORD_BITS - 1)
+    events['polarity'] = types[is_event]
+    return events, int(high[-1]) if len(words) > 0 else time_high
+
+
+class Evt2EventWriter:
+    """Appends events to an EVT 2.0 .raw file, readable by `Evt2EventReader` and by the Prophesee tools.
+
+    The file starts with a text header of '%' lines, the sensor geometry when it is known, followed by the
+    EVT 2.0 words of the events, encoded as they are written.
+    """
+
+    def __init__(self, path, width=None, height=None):
+        """
+        Args:
+            path: the path of the .raw file
+            width, height: the size of the sensor, written to the header, None when unknown
+        """
+        self.path = str(path)
+        self.num_events = 0
+        self._time_high = -1
+        header = ['evt 2.0', 'format EVT2' + ('' if width is None or height is None else f';height={height};width={width}')]
+        if width is not None and height is not None:
+            header.append(f'geometry {width}x{height}')
+        self._file = open(self.path, 'wb')
+        self._file.write(''.join(f'% {line}\n' for line in header + ['end']).encode('ascii'))
+
+    def write(self, events):
+        """ Append a batch of events
+        Args:
+            events: a structured array (or recarray) with the fields of EVENT_DTYPE, see `encode_evt2`
+        """
+        assert self._file is not None, 'The writer is closed'
+        words, self._time_high = encode_evt2(events, self._time_high)
+        self._file.write(words.data)
+        self.num_events += len(events)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        logger.debug(f'Wrote {self.num_events} events to {self.path}')
+
+    def abort(self):
+        """ Close the file, keeping the events written so far """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Evt2EventReader:
+    """Reads the events of an EVT 2.0 .raw file, memory-mapped and decoded by batches of words."""
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the path of the .raw file, e.g. written by `Evt2EventWriter`
+        """
+        self.path = str(path)
+        self.header = {}
+        with open(self.path, 'rb') as f:
+            while True:
+                line = f.readline()
+                if not line.startswith(b'%'):
+                    raise ValueError(f'Not an EVT 2.0 file, its header has no end: {self.path}')
+                line = line[1:].strip().decode('ascii')
+                if line == 'end':
+                    break
+                key, _, value = line.partition(' ')
+                self.header[key] = value
+            data_offset = f.tell()
+        assert self.header.get('evt', '2.0') == '2.0', f'Unsupported EVT version {self.header["evt"]}'
+        self.width = self.height = None
+        if 'geometry' in self.header:
+            self.width, self.height = [int(v) for v in self.header['geometry'].split('x')]
+        # Ignore a partially written word at the end of an interrupted file
+        num_words = (os.path.getsize(self.path) - data_offset) // _EVT2_WORD_DTYPE.itemsize
+        self._words = np.memmap(self.path, dtype=_EVT2_WORD_DTYPE, mode='r', offset=data_offset, shape=(num_words,)) \
+            if num_words > 0 else np.empty(0, dtype=_EVT2_WORD_DTYPE)
+
+    @property
+    def num_words(self):
+        return len(self._words)
+
+    def iter_batches(self, batch_words=2 ** 22):
+        """ Decode the events by batches of `batch_words` words
+        Returns:
+            a generator of structured arrays of EVENT_DTYPE, in file order
+        """
+        time_high = 0
+        for start in range(0, len(self._words), batch_words):
+            events, time_high = decode_evt2(self._words[start:start + batch_words], time_high)
+            yield events
+
+    def read(self, t0=None, t1=None, roi=None):
+        """ Read the events in a time window and a region, the whole file is decoded
+        Args:
+            t0, t1: the time window [t0, t1) in microseconds, None for no bound
+            roi: the region (x0, y0, x1, y1), covering x0 <= x < x1 and y0 <= y < y1, None for the whole sensor
+        Returns:
+            events: a structured array with the fields of EVENT_DTYPE, in file order
+        """
+        selected = []
+        for events in self.iter_batches():
+            mask = np.ones(len(events), dtype=bool)
+            if t0 is not None:
+                mask &= events['timestamp'] >= t0
+            if t1 is not None:
+                mask &= events['timestamp'] < t1
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                mask &= (events['x'] >= x0) & (events['x'] < x1) & (events['y'] >= y0) & (events['y'] < y1)
+            selected.append(events if mask.all() else events[mask])
+        if len(selected) == 0:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return np.concatenate(selected)
+
+    def close(self):
+        self._words = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Output formats of the converter, with the file extension of each
+EVENT_FORMATS = {'npz': '.npz', 'chunked': '.evc', 'evt2': '.raw'}
+
+
+def open_event_writer(path_stem, event_format='npz', **kwargs):
+    """ Open an event writer for the given output format
+    Args:
+        path_stem: the output path without the extension
+        event_format: one of EVENT_FORMATS
+        kwargs: passed to the writer
+    Returns:
+        writer: the event writer, its output path is `writer.path`
+    """
+    assert event_format in EVENT_FORMATS, f'Invalid event format {event_format}'
+    path = str(path_stem) + EVENT_FORMATS[event_format]
+    if event_format == 'npz':
+        return NpzEventWriter(path, key='event_stream', **kwargs)
+    if event_format == 'evt2':
+        return Evt2EventWriter(path, **kwargs)
+    return ChunkedEventWriter(path, **kwargs)
+
+
+def read_events(path):
+    """ Read all the events of a file of any of EVENT_FORMATS, by its extension
+    Returns:
+        events: a structured array with the fields of EVENT_DTYPE
+    """
+    path = str(path)
+    if path.endswith(EVENT_FORMATS['chunked']):
+        with ChunkedEventReader(path) as reader:
+            return reader.read()
+    if path.endswith(EVENT_FORMATS['evt2']):
+        with Evt2EventReader(path) as reader:
+            return reader.read()
+    with np.load(path) as archive:
+        return archive['event_stream'] if 'event_stream' in archive else archive[archive.files[0]]
@@ -0,0 +1,159 @@
+"""
+Freeze V2ce3d for inference: bake the spectral normalization into plain convolution weights and fold
+the BatchNorm layers into the preceding convolutions.
+"""
+import logging
+
+import torch
+import torch.nn as nn
+
+from .v2ce_3d import V2ce3d
+from .spectral_norm import SpectralNorm
+from .submodules import ConvLayer3D, ResidualBlock3D
+
+logger = logging.getLogger(__name__)
+
+FROZEN_FORMAT = 'v2ce3d-frozen'
+FROZEN_VERSION = 1
+
+
+def clone_v2ce3d(model):
+    """ Copy a V2ce3d model through its state dict (SpectralNorm weights cannot be deep-copied) """
+    clone = V2ce3d().to(next(model.parameters()).device)
+    clone.load_state_dict(model.state_dict())
+    return clone.train(model.training)
+
+
+def _unwrap_spectral_norm(sn):
+    """ Replace a SpectralNorm wrapper by its module, with the normalized weight stored as a parameter
+    Args:
+        sn: the SpectralNorm module
+    Returns:
+        module: the wrapped module, without the `_u`, `_v` and `_bar` parameters
+    """
+    # Run the power iteration once, exactly as the next forward pass would
+    sn._update_u_v()
+    module = sn.module
+    weight = getattr(module, sn.name).detach().clone()
+    for suffix in ('_u', '_v', '_bar'):
+        delattr(module, sn.name + suffix)
+    delattr(module, sn.name)
+    module.register_parameter(sn.name, nn.Parameter(weight, requires_grad=False))
+    return module
+
+
+def _fold_bn(conv, bn):
+    """ Fold an eval-mode BatchNorm into the convolution before it, in place
+    Args:
+        conv: the convolution
+        bn: the BatchNorm following the convolution
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    conv.weight.data.mul_(scale.reshape(-1, *([1] * (conv.weight.dim() - 1))))
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias, requires_grad=False)
+
+
+@torch.no_grad()
+def freeze_v2ce3d(model):
+    """ Freeze a V2ce3d model for inference, in place
+    Every SpectralNorm is replaced by its convolution with the normalized weight, and every BatchNorm
+    is folded into the convolution before it, so the frozen model runs plain Conv3d layers only.
+    Args:
+        model: the V2ce3d model, with its trained weights loaded
+    Returns:
+        model: the frozen model, in eval mode
+    """
+    model.eval()
+
+    # Bake the spectral normalization into the weights
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, SpectralNorm):
+                setattr(module, name, _unwrap_spectral_norm(child))
+
+    # Fold the BatchNorm layers into the convolutions
+    for module in model.modules():
+        if isinstance(module, ConvLayer3D) and module.norm == 'BN':
+            _fold_bn(module.conv3d, module.norm_layer)
+            del module.norm_layer
+            module.norm = None
+        elif isinstance(module, ResidualBlock3D):
+            if module.norm == 'BN':
+                _fold_bn(module.conv1, module.bn1)
+                _fold_bn(module.conv2, module.bn2)
+                del module.bn1, module.bn2
+                module.norm = None
+            if isinstance(module.downsample, nn.Sequential) and len(module.downsample) == 2 \
+                    and isinstance(module.downsample[1], nn.BatchNorm3d):
+                _fold_bn(module.downsample[0], module.downsample[1])
+                module.downsample = nn.Sequential(module.downsample[0])
+
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model
+
+
+def save_frozen_v2ce3d(model, path, half=False):
+    """ Save a frozen model as a compact checkpoint
+    Args:
+        model: the model returned by `freeze_v2ce3d`
+        path: the path to write the checkpoint to
+        half: store the weights as fp16, they are cast back to fp32 when loaded
+    """
+    state_dict = {k: (v.half() if half and v.is_floating_point() else v).cpu()
+                  for k, v in model.state_dict().items()}
+    torch.save({'format': FROZEN_FORMAT, 'version': FROZEN_VERSION, 'state_dict': state_dict}, path)
+
+
+def is_frozen_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and checkpoint.get('format') == FROZEN_FORMAT
+
+
+def build_frozen_v2ce3d():
+    """ Build an untrained V2ce3d with the frozen architecture, ready to load a frozen state dict """
+    return freeze_v2ce3d(V2ce3d())
+
+
+def load_frozen_v2ce3d(checkpoint):
+    """ Load a frozen model
+    Args:
+        checkpoint: the path to a checkpoint written by `save_frozen_v2ce3d`, or the loaded checkpoint
+    Returns:
+        model: the frozen model, on CPU
+    """
+    if not isinstance(checkpoint, dict):
+        checkpoint = torch.load(checkpoint, map_location='cpu')
+    assert is_frozen_checkpoint(checkpoint), 'Not a frozen V2ce3d checkpoint'
+    assert checkpoint['version'] <= FROZEN_VERSION, f'Unsupported frozen checkpoint version {checkpoint["version"]}'
+    model = build_frozen_v2ce3d()
+    model.load_state_dict({k: v.float() if v.is_floating_point() else v for k, v in checkpoint['state_dict'].items()})
+    return model
+
+
+@torch.no_grad()
+def check_parity(model, frozen_model=None, inputs=None, atol=1e-4, rtol=1e-4):
+    """ Compare the outputs of the original and the frozen model on the same inputs
+    The original model runs its power iteration on a copy, so `model` is left untouched.
+    Args:
+        model: the original V2ce3d model
+        frozen_model: the frozen model, frozen from a copy of `model` if None
+        inputs: the image units. Shape: (B, L, 2, H, W), random if None
+        atol: absolute tolerance
+        rtol: relative tolerance
+    Returns:
+        ok: whether the outputs match within the tolerances
+        max_abs_error: the maximum absolute difference of the outputs
+    """
+    reference_model = clone_v2ce3d(model).eval()
+    if frozen_model is None:
+        frozen_model = freeze_v2ce3d(clone_v2ce3d(model))
+    if inputs is None:
+        inputs = torch.randn(1, 16, 2, 64, 96, device=next(model.parameters()).device)
+
+    reference = reference_model(inputs)
+    frozen = frozen_model(inputs)
+    max_abs_error = (reference - frozen).abs().max().item()
+    ok = torch.allclose(reference, frozen, atol=atol, rtol=rtol)
+    logger.info(f'Frozen model parity: max abs error {max_abs_error:.3e} ({"ok" if ok else "FAILED"})')
+    return ok, max_abs_error
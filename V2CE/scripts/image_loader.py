@@ -0,0 +1,111 @@
+import os
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def default_num_workers():
+    return min(8, os.cpu_count() or 1)
+
+
+class ImageFolderLoader:
+    """Loads the frames of an image sequence on a thread pool, with an LRU cache of the loaded frames.
+
+    cv2.imread and cv2.resize release the GIL, so the frames are decoded in parallel, ahead of
+    the consumer. The loaded (and transformed, e.g. resized) frames are cached by path, so frames
+    shared by overlapping windows are only decoded once.
+    """
+
+    def __init__(self, image_paths, num_workers=None, cache_size=64, transform=None, flags=cv2.IMREAD_GRAYSCALE):
+        """
+        Args:
+            image_paths: the paths of the frames, in frame order
+            num_workers: the number of decoding threads (default: min(8, cpu count))
+            cache_size: the number of loaded frames kept in the cache
+            transform: a function applied to every decoded frame on the worker threads
+            flags: the cv2.imread flags
+        """
+        self.image_paths = image_paths
+        self.num_workers = default_num_workers() if num_workers is None or num_workers <= 0 else num_workers
+        self.cache_size = cache_size
+        self.transform = transform
+        self.flags = flags
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='image-loader')
+        self._cache = OrderedDict()
+        self._pending = {}
+
+        # Statistics
+        self.decoded = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def _load(self, path):
+        frame = cv2.imread(path, self.flags)
+        if frame is None:
+            raise IOError(f'Failed to read image {path}')
+        return self.transform(frame) if self.transform is not None else frame
+
+    def prefetch(self, idx):
+        """ Start loading a frame on the thread pool, unless it is cached or already loading """
+        path = self.image_paths[idx]
+        if path not in self._cache and path not in self._pending:
+            self._pending[path] = self._executor.submit(self._load, path)
+
+    def get(self, idx):
+        """ Return a loaded frame, waiting for it if it is still loading
+        Args:
+            idx: the index of the frame
+        Returns:
+            frame: the loaded frame
+        """
+        path = self.image_paths[idx]
+        if path in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(path)
+            return self._cache[path]
+        self.prefetch(idx)
+        frame = self._pending.pop(path).result()
+        self.decoded += 1
+        self._cache[path] = frame
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return frame
+
+    def iter_windows(self, starting_idxs, window_len, readahead=None):
+        """ Yield the frames of each window, loading the next frames while the current window is consumed
+        Args:
+            starting_idxs: the first frame index of each window
+            window_len: the number of frames in each window
+            readahead: the number of frames loaded ahead of the consumer (default: a window plus a frame per worker)
+        Returns:
+            a generator of frame windows. Shape: (window_len, ...)
+        """
+        readahead = window_len + self.num_workers if readahead is None else readahead
+        order = [idx for starting_idx in starting_idxs for idx in range(int(starting_idx), int(starting_idx) + window_len)]
+        scheduled = 0
+        for i, starting_idx in enumerate(starting_idxs):
+            # Keep the pool busy with the frames of the next windows
+            while scheduled < min(len(order), (i + 1) * window_len + readahead):
+                self.prefetch(order[scheduled])
+                scheduled += 1
+            yield np.stack([self.get(idx) for idx in range(int(starting_idx), int(starting_idx) + window_len)], axis=0)
+        logger.debug(f'Image loader: decoded {self.decoded} frames, {self.hits} cache hits')
+
+    def close(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
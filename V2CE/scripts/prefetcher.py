@@ -0,0 +1,132 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class BackgroundPrefetcher:
+    """Runs an iterator on a background thread and hands its items over through a bounded queue.
+
+    The producer (e.g. frame decoding and preprocessing) works on item N+1 while the
+    consumer (e.g. model inference) works on item N. OpenCV and torch release the GIL
+    in their heavy kernels, so a thread is enough to overlap the two stages, also on
+    CPU-only hosts.
+    """
+
+    def __init__(self, iterable, depth=2, name='prefetch'):
+        """
+        Args:
+            iterable: the producer iterable, consumed on the background thread
+            depth: the maximum number of produced items waiting in the queue
+            name: the name of the pipeline stage, used in logs and the thread name
+        """
+        assert depth > 0
+        self.iterable = iterable
+        self.depth = depth
+        self.name = name
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Stage statistics, in seconds
+        self.items = 0
+        self.producer_busy = 0.
+        self.producer_blocked = 0.
+        self.consumer_busy = 0.
+        self.consumer_blocked = 0.
+        self._occupancy_sum = 0
+
+    def _produce(self):
+        iterator = iter(self.iterable)
+        try:
+            while not self._stop.is_set():
+                tic = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                toc = time.perf_counter()
+                self.producer_busy += toc - tic
+                if not self._put(item):
+                    return
+                self.producer_blocked += time.perf_counter() - toc
+        except BaseException as e:
+            self._put(_ProducerError(e))
+            return
+        self._put(_END)
+
+    def _put(self, item):
+        # Poll so that a consumer leaving early does not leave the producer blocked forever
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._produce, name=f'{self.name}-producer', daemon=True)
+        self._thread.start()
+        try:
+            toc = time.perf_counter()
+            while True:
+                self._occupancy_sum += self._queue.qsize()
+                tic = time.perf_counter()
+                self.consumer_busy += tic - toc
+                item = self._queue.get()
+                toc = time.perf_counter()
+                self.consumer_blocked += toc - tic
+                if item is _END:
+                    break
+                if isinstance(item, _ProducerError):
+                    raise item.exc
+                self.items += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """ Return the per-stage occupancy of the pipeline
+        Returns:
+            a dict with the item count, the busy/blocked seconds of both stages, their busy ratio,
+            and the mean queue occupancy seen by the consumer
+        """
+        def ratio(busy, blocked):
+            return busy / (busy + blocked) if busy + blocked > 0 else 0.
+
+        return {
+            'items': self.items,
+            'depth': self.depth,
+            'mean_queue_occupancy': self._occupancy_sum / max(self.items, 1),
+            'producer_busy_s': self.producer_busy,
+            'producer_blocked_s': self.producer_blocked,
+            'producer_utilization': ratio(self.producer_busy, self.producer_blocked),
+            'consumer_busy_s': self.consumer_busy,
+            'consumer_blocked_s': self.consumer_blocked,
+            'consumer_utilization': ratio(self.consumer_busy, self.consumer_blocked),
+        }
+
+    def log_stats(self, level=logging.INFO):
+        stats = self.stats()
+        logger.log(level, f"[{self.name}] {stats['items']} items, mean queue occupancy "
+                          f"{stats['mean_queue_occupancy']:.2f}/{self.depth}, "
+                          f"producer utilization {stats['producer_utilization']:.0%} "
+                          f"(busy {stats['producer_busy_s']:.2f}s, blocked {stats['producer_blocked_s']:.2f}s), "
+                          f"consumer utilization {stats['consumer_utilization']:.0%} "
+                          f"(busy {stats['consumer_busy_s']:.2f}s, blocked {stats['consumer_blocked_s']:.2f}s)")
@@ -0,0 +1,188 @@
+"""
+Named timing spans and counters of the conversion stages, reported as JSON or as a Chrome trace
+(chrome://tracing, https://ui.perfetto.dev).
+
+Profiling is off unless a Profiler is enabled with `enable_profiler`. While it is off, `span` returns a
+shared no-op context and `count` returns immediately, so the instrumentation can stay in the hot paths.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+import functools
+from collections import defaultdict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_NULL_SPAN = contextlib.nullcontext()
+_END = object()
+
+
+class Profiler:
+    """Records the spans of every thread, and the counters of the conversion."""
+
+    def __init__(self, sync_device=None, profile_ops=False):
+        """
+        Args:
+            sync_device: a CUDA device synchronized at the end of every span, so the queued kernels are
+                timed in the span that launched them. None for no synchronization
+            profile_ops: also record the time of every torch operator with torch.profiler
+        """
+        self.sync_device = None if sync_device is None or torch.device(sync_device).type != 'cuda' else torch.device(sync_device)
+        self.profile_ops = profile_ops
+        self.spans = []
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._torch_profiler = None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_device is not None:
+                torch.cuda.synchronize(self.sync_device)
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append((name, start - self._origin, end - start, threading.get_ident(), threading.current_thread().name))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def start(self):
+        if self.profile_ops:
+            self._torch_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU] +
+                                                          ([torch.profiler.ProfilerActivity.CUDA] if self.sync_device is not None else []))
+            self._torch_profiler.__enter__()
+
+    def stop(self):
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(None, None, None)
+
+    def summary(self):
+        """ Aggregate the spans and the operators
+        Returns:
+            a dict with, for every span name, the number of spans, their total, mean and max duration in
+            seconds, the counters, and the top operators when `profile_ops` is set
+        """
+        spans = {}
+        with self._lock:
+            for name, _, duration, _, _ in self.spans:
+                s = spans.setdefault(name, dict(count=0, total_s=0., max_s=0.))
+                s['count'] += 1
+                s['total_s'] += duration
+                s['max_s'] = max(s['max_s'], duration)
+            counters = dict(self.counters)
+        for s in spans.values():
+            s['mean_s'] = s['total_s'] / s['count']
+        summary = dict(wall_s=time.perf_counter() - self._origin, spans=dict(sorted(spans.items(), key=lambda kv: -kv[1]['total_s'])),
+                       counters=counters)
+        if self._torch_profiler is not None:
+            ops = sorted(self._torch_profiler.key_averages(), key=lambda e: -e.self_cpu_time_total)
+            summary['ops'] = [dict(name=e.key, count=e.count, self_cpu_s=e.self_cpu_time_total / 1e6, cpu_s=e.cpu_time_total / 1e6)
+                              for e in ops[:50]]
+        return summary
+
+    def chrome_trace(self):
+        """ The spans as complete events, and the counters as counter events, of the Chrome trace format """
+        pid = os.getpid()
+        with self._lock:
+            events = [dict(name=name, ph='X', ts=start * 1e6, dur=duration * 1e6, pid=pid, tid=tid, args=dict(thread=thread))
+                      for name, start, duration, tid, thread in self.spans]
+            end = (time.perf_counter() - self._origin) * 1e6
+            events += [dict(name=name, ph='C', ts=end, pid=pid, args={name: value}) for name, value in self.counters.items()]
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def save(self, path_stem):
+        """ Write the summary to `<path_stem>.json` and the Chrome trace to `<path_stem>.trace.json`
+        Returns:
+            the paths of the summary and of the trace
+        """
+        summary_path, trace_path = f'{path_stem}.json', f'{path_stem}.trace.json'
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(trace_path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        return summary_path, trace_path
+
+    def log_summary(self, level=logging.INFO):
+        summary = self.summary()
+        lines = [f'{"span":<24}{"count":>8}{"total s":>10}{"mean ms":>10}{"max ms":>10}']
+        for name, s in summary['spans'].items():
+            lines.append(f'{name:<24}{s["count"]:>8}{s["total_s"]:>10.2f}{s["mean_s"]*1e3:>10.1f}{s["max_s"]*1e3:>10.1f}')
+        lines += [f'{name}: {value}' for name, value in summary['counters'].items()]
+        logger.log(level, f'Profile over {summary["wall_s"]:.1f}s:\n' + '\n'.join(lines))
+
+
+_profiler = None
+
+
+def enable_profiler(**kwargs):
+    """ Start recording the spans and the counters of this process, see `Profiler`
+    Returns:
+        profiler: the enabled profiler
+    """
+    global _profiler
+    _profiler = Profiler(**kwargs)
+    _profiler.start()
+    return _profiler
+
+
+def disable_profiler():
+    """ Stop recording
+    Returns:
+        profiler: the profiler that was enabled, None if none was
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def span(name):
+    """ A context timing its body as the span `name`, a no-op when profiling is off """
+    if _profiler is None:
+        return _NULL_SPAN
+    return _profiler.span(name)
+
+
+def count(name, value=1):
+    """ Add `value` to the counter `name`, a no-op when profiling is off """
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def profiled(name):
+    """ Decorate a function to time each call as the span `name` """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_iter(iterable, name):
+    """ Time the production of every item of an iterable as the span `name` """
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
@@ -0,0 +1,182 @@
+"""
+Post-training quantization of a frozen V2ce3d for CPU inference: static int8 (weights and activations,
+calibrated on image units) or weight-only int8 (int8 weights dequantized on the fly).
+"""
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .freeze import build_frozen_v2ce3d
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ('none', 'int8', 'weight_only')
+
+INT8_FORMAT = 'v2ce3d-int8'
+INT8_VERSION = 1
+
+# The first and the last convolutions are small but sensitive, keep them in fp32
+FP32_MODULES = ('UNet.head', 'UNet.pred')
+
+
+def _qconfig_mapping(engine):
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    for name in FP32_MODULES:
+        qconfig_mapping = qconfig_mapping.set_module_name(name, None)
+    return qconfig_mapping
+
+
+def _example_inputs(seq_len=16, height=32, width=32):
+    return (torch.zeros(1, seq_len, 2, height, width),)
+
+
+@torch.no_grad()
+def prepare_int8(model, example_inputs=None, engine=None):
+    """ Insert the observers of static int8 quantization into a frozen V2ce3d
+    Args:
+        model: the frozen V2ce3d model, on CPU, see `freeze_v2ce3d`
+        example_inputs: a tuple of image units tracing the model, any shape works
+        engine: the quantized engine, None for the current `torch.backends.quantized.engine`
+    Returns:
+        observed: the model with observers, running in fp32 and recording the activation ranges
+    """
+    engine = torch.backends.quantized.engine if engine is None else engine
+    torch.backends.quantized.engine = engine
+    example_inputs = _example_inputs() if example_inputs is None else example_inputs
+    return prepare_fx(model.eval(), _qconfig_mapping(engine), example_inputs)
+
+
+@torch.no_grad()
+def quantize_int8(model, calibration_inputs, engine=None):
+    """ Quantize a frozen V2ce3d to static int8, the activation ranges being calibrated on image units
+    Args:
+        model: the frozen V2ce3d model, on CPU, see `freeze_v2ce3d`
+        calibration_inputs: an iterable of image units batches. Shape: (B, L, 2, H, W)
+        engine: the quantized engine, None for the current `torch.backends.quantized.engine`
+    Returns:
+        quantized: the int8 model, on CPU
+    """
+    observed = None
+    num_batches = 0
+    for inputs in calibration_inputs:
+        inputs = inputs.float().cpu()
+        if observed is None:
+            observed = prepare_int8(model, (inputs,), engine=engine)
+        observed(inputs)
+        num_batches += 1
+    assert observed is not None, 'No calibration inputs'
+    logger.info(f'Calibrated the int8 activations on {num_batches} batches')
+    return convert_fx(observed)
+
+
+def save_int8_v2ce3d(model, path):
+    """ Save an int8 model returned by `quantize_int8` """
+    torch.save({'format': INT8_FORMAT, 'version': INT8_VERSION, 'engine': torch.backends.quantized.engine,
+                'state_dict': model.state_dict()}, path)
+
+
+def is_int8_checkpoint(checkpoint):
+    return isinstance(checkpoint, dict) and checkpoint.get('format') == INT8_FORMAT
+
+
+@torch.no_grad()
+def load_int8_v2ce3d(checkpoint):
+    """ Load an int8 model
+    Args:
+        checkpoint: the path to a checkpoint written by `save_int8_v2ce3d`, or the loaded checkpoint
+    Returns:
+        model: the int8 model, on CPU
+    """
+    if not isinstance(checkpoint, dict):
+        checkpoint = torch.load(checkpoint, map_location='cpu')
+    assert is_int8_checkpoint(checkpoint), 'Not an int8 V2ce3d checkpoint'
+    assert checkpoint['version'] <= INT8_VERSION, f'Unsupported int8 checkpoint version {checkpoint["version"]}'
+    # Rebuild the quantized graph, its scales and zero points are then loaded with the weights
+    observed = prepare_int8(build_frozen_v2ce3d(), engine=checkpoint['engine'])
+    observed(*_example_inputs())
+    model = convert_fx(observed)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+
+class Int8Model(nn.Module):
+    """Quantizes a frozen V2ce3d to static int8 on its first forward, calibrated on the inputs of that forward.
+
+    The first batch is run by the calibrating fp32 model, the next batches by the int8 model. A copy of the
+    model sent to another process is calibrated again, on the first batch of that process, so the processes
+    of a conversion should share an int8 checkpoint written by tools/quantize_model.py instead.
+    """
+
+    def __init__(self, model):
+        """
+        Args:
+            model: the frozen V2ce3d model, prepared by the runtime on CPU
+        """
+        super().__init__()
+        self.model = model
+        self._quantized = None
+
+    @property
+    def UNet(self):
+        return self.model.UNet
+
+    def __getstate__(self):
+        # Quantized again in the process the model is sent to
+        state = self.__dict__.copy()
+        state['_quantized'] = None
+        return state
+
+    @torch.no_grad()
+    def forward(self, inputs):
+        if self._quantized is not None:
+            return self._quantized(inputs)
+        observed = prepare_int8(self.model, (inputs,))
+        outputs = observed(inputs)
+        # Not registered as a submodule, the int8 model is not part of the state of the model
+        object.__setattr__(self, '_quantized', convert_fx(observed))
+        logger.info(f'Quantized the model to int8, calibrated on a batch of {inputs.shape[0]} sequences')
+        return outputs
+
+
+class WeightOnlyConv3d(nn.Module):
+    """A Conv3d with int8 weights, quantized symmetrically per output channel and dequantized on every forward."""
+
+    def __init__(self, conv):
+        """
+        Args:
+            conv: the fp32 Conv3d, with zero padding
+        """
+        super().__init__()
+        assert conv.padding_mode == 'zeros', f'Unsupported padding mode {conv.padding_mode}'
+        weight = conv.weight.detach().float()
+        scale = weight.abs().amax(dim=(1, 2, 3, 4), keepdim=True).clamp_min(1e-12) / 127
+        self.register_buffer('qweight', torch.round(weight / scale).clamp(-127, 127).to(torch.int8))
+        self.register_buffer('scale', scale)
+        self.register_buffer('bias', None if conv.bias is None else conv.bias.detach().float().clone())
+        self.stride, self.padding, self.dilation, self.groups = conv.stride, conv.padding, conv.dilation, conv.groups
+        self.memory_format = torch.channels_last_3d if conv.weight.is_contiguous(memory_format=torch.channels_last_3d) \
+            and not conv.weight.is_contiguous() else torch.contiguous_format
+
+    def forward(self, x):
+        weight = (self.qweight.to(self.scale.dtype) * self.scale).contiguous(memory_format=self.memory_format)
+        return F.conv3d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+@torch.no_grad()
+def quantize_weight_only(model):
+    """ Replace every Conv3d of a frozen V2ce3d by a WeightOnlyConv3d, in place
+    The weights take 4x less memory, the activations and the convolutions stay in fp32.
+    Args:
+        model: the frozen V2ce3d model
+    Returns:
+        model: the model with int8 weights
+    """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Conv3d):
+                setattr(module, name, WeightOnlyConv3d(child))
+    return model
@@ -0,0 +1,114 @@
+import logging
+import contextlib
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ('fp32', 'bf16')
+
+
+def resolve_device(device='auto'):
+    """ Resolve the device string given on the command line
+    Args:
+        device: 'auto', 'cpu', 'cuda' or 'cuda:<index>'. 'auto' selects cuda when available
+    Returns:
+        device: the torch device
+    """
+    if device is None or device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise ValueError('CUDA is not available on this host, use --device=cpu')
+    return device
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None):
+    """ Set the intra-op (and optionally inter-op) thread pool sizes of torch on CPU
+    Args:
+        num_threads: the number of intra-op threads, None or <=0 keeps the torch default
+        num_interop_threads: the number of inter-op threads, None or <=0 keeps the torch default
+    """
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started
+            logger.warning('Failed to set the number of inter-op threads, keeping %d', torch.get_num_interop_threads())
+    logger.debug(f'Torch CPU threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}')
+
+
+class _FullPrecision(nn.Module):
+    """Runs the wrapped module in fp32 even inside an autocast region."""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self.module(x.float())
+
+
+class InferenceRuntime:
+    """Device, precision and memory format used to run V2ce3d."""
+
+    def __init__(self, device='auto', precision='fp32', channels_last=None):
+        """
+        Args:
+            device: the device to run on, see `resolve_device`
+            precision: 'fp32', or 'bf16' to autocast the convolutions to bfloat16
+            channels_last: use the channels-last 3D memory format, None enables it on CPU only
+        """
+        assert precision in PRECISIONS, f'Invalid precision {precision}'
+        self.device = resolve_device(device)
+        self.precision = precision
+        self.channels_last = self.device.type == 'cpu' if channels_last is None else channels_last
+        if precision == 'bf16' and self.device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            raise ValueError('bf16 is not supported on this GPU')
+
+    def __repr__(self):
+        return f'InferenceRuntime(device={self.device}, precision={self.precision}, channels_last={self.channels_last})'
+
+    def prepare_model(self, model):
+        """ Move the model to the device and memory format of the runtime
+        Args:
+            model: a V2ce3d model
+        Returns:
+            model: the prepared model
+        """
+        model = model.eval().to(self.device)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last_3d)
+        if self.precision == 'bf16' and hasattr(model, 'UNet'):
+            # The first and the last convolutions are small but sensitive, keep them in fp32
+            for name in ('head', 'pred'):
+                layer = getattr(model.UNet, name)
+                if not isinstance(layer, _FullPrecision):
+                    setattr(model.UNet, name, _FullPrecision(layer))
+        return model
+
+    def autocast(self):
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    @torch.no_grad()
+    def __call__(self, model, inputs):
+        """ Run the model on a batch of image units
+        Args:
+            model: the model returned by `prepare_model`
+            inputs: the image units. Shape: (B, L, 2, H, W)
+        Returns:
+            outputs: the fp32 predicted voxels on the runtime device. Shape: (B, L, 20, H, W)
+        """
+        inputs = inputs.to(self.device, dtype=torch.float32, non_blocking=True)
+        if self.channels_last:
+            # V2ce3d permutes the input to (B, 2, L, H, W), make that view channels-last
+            inputs = inputs.permute(0, 2, 1, 3, 4).contiguous(memory_format=torch.channels_last_3d).permute(0, 2, 1, 3, 4)
+        with self.autocast():
+            outputs = model(inputs)
+        return outputs.float()
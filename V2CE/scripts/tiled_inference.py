@@ -0,0 +1,169 @@
+"""
+Tiled inference of V2ce3d: split frames of any resolution into spatial tiles with a halo covering the receptive
+field of UNet3D, and pick the tile and batch sizes from a memory budget.
+"""
+import logging
+import math
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Peak activation memory of a V2ce3d forward per input pixel and frame, measured on CPU in fp32
+# (bf16 autocast keeps fp32 copies and saves little), with some margin
+ACTIVATION_BYTES_PER_PIXEL = 1280
+# Tiles must start on the grid of the 4 stride-2 encoders, so they see the same downsampling as the full frame
+TILE_ALIGNMENT = 16
+
+
+def unet3d_receptive_field(unet):
+    """ Compute the spatial receptive field of a UNet3D
+    Args:
+        unet: the UNet3D (V2ce3d.UNet)
+    Returns:
+        receptive_field: the width in pixels of the input region an output pixel depends on
+    """
+    receptive_field, jump = 3, 1  # head: 3x3 convolution
+    for _ in range(unet.num_encoders):
+        # ResidualBlock3D: stride-2 3x3 convolution, then a 3x3 convolution at the new scale
+        receptive_field += 2 * jump
+        jump *= 2
+        receptive_field += 2 * jump
+    receptive_field += unet.num_residual_blocks * 2 * 2 * jump
+    for _ in range(unet.num_encoders):
+        # Nearest upsampling, then a ResidualBlock3D at the finer scale
+        receptive_field += jump // 2
+        jump //= 2
+        receptive_field += 2 * 2 * jump
+    return receptive_field
+
+
+def default_halo(model):
+    """ The halo around each tile which makes the tiled outputs match the full frame outputs
+    Args:
+        model: a V2ce3d model
+    Returns:
+        halo: the receptive field radius, rounded up to TILE_ALIGNMENT
+    """
+    radius = (unet3d_receptive_field(model.UNet) - 1) // 2
+    return math.ceil(radius / TILE_ALIGNMENT) * TILE_ALIGNMENT
+
+
+def _tile_starts(size, tile):
+    return list(range(0, size, tile))
+
+
+class TiledInference:
+    """Runs V2ce3d on frames of any size within a memory budget.
+
+    The frames are split into tiles of `tile_height` x `tile_width` pixels. Each tile is inferred
+    with a halo of input pixels around it, cropped at the frame border, so every predicted pixel
+    sees the same input as in a full frame forward. Tiles (and sequences) of the same shape are
+    stacked into batches of `max_batch` forwards.
+    """
+
+    def __init__(self, model, runtime, memory_budget=4., halo=None, tile_size=None):
+        """
+        Args:
+            model: the V2ce3d model, prepared by `runtime`
+            runtime: the InferenceRuntime to run the model with
+            memory_budget: the memory in GB the activations of a forward may use
+            halo: the halo in pixels, rounded up to TILE_ALIGNMENT. None to cover the receptive field,
+                which makes the outputs match the full frame forward. A smaller halo trades accuracy
+                at the tile borders for speed
+            tile_size: a fixed (tile_height, tile_width), None to pick it from the memory budget
+        """
+        self.model = model
+        self.runtime = runtime
+        self.memory_budget = memory_budget
+        self.halo = default_halo(model) if halo is None else math.ceil(halo / TILE_ALIGNMENT) * TILE_ALIGNMENT
+        self.tile_size = tile_size
+        self._plans = {}
+
+    def __repr__(self):
+        return f'TiledInference(memory_budget={self.memory_budget}GB, halo={self.halo})'
+
+    def _forward_bytes(self, seq_len, height, width):
+        return ACTIVATION_BYTES_PER_PIXEL * seq_len * height * width
+
+    def plan(self, seq_len, height, width):
+        """ Pick the tile size and the number of tiles per forward for frames of the given size
+        Args:
+            seq_len: the sequence length
+            height, width: the size of the frames
+        Returns:
+            tile_height, tile_width: the size of the tiles without their halo
+            max_batch: the number of tiles inferred per forward
+        """
+        key = (seq_len, height, width)
+        if key in self._plans:
+            return self._plans[key]
+        budget = self.memory_budget * 1024 ** 3
+
+        def padded(size, tile):
+            return size if tile >= size else min(tile + 2 * self.halo, size)
+
+        if self.tile_size is not None:
+            tile_height, tile_width = self.tile_size
+        elif self._forward_bytes(seq_len, height, width) <= budget:
+            tile_height, tile_width = height, width
+        else:
+            # Among the tile heights, take the largest tile width within the budget, and keep the
+            # tiling with the largest share of predicted pixels in the inferred pixels
+            best, best_efficiency = None, 0
+            tile_heights = [height] + list(range(TILE_ALIGNMENT, height, TILE_ALIGNMENT))
+            for tile_height in tile_heights:
+                padded_height = padded(height, tile_height)
+                max_padded_width = int(budget // self._forward_bytes(seq_len, padded_height, 1))
+                tile_width = min(width, (max_padded_width - 2 * self.halo) // TILE_ALIGNMENT * TILE_ALIGNMENT)
+                if tile_width < TILE_ALIGNMENT:
+                    continue
+                tile_num = math.ceil(height / tile_height) * math.ceil(width / tile_width)
+                efficiency = height * width / (tile_num * padded_height * padded(width, tile_width))
+                if efficiency > best_efficiency:
+                    best, best_efficiency = (tile_height, tile_width), efficiency
+            if best is None:
+                raise ValueError(f'A memory budget of {self.memory_budget}GB is too small for a halo of {self.halo} pixels, '
+                                 f'increase the budget or decrease the halo')
+            tile_height, tile_width = best
+
+        forward_bytes = self._forward_bytes(seq_len, padded(height, tile_height), padded(width, tile_width))
+        max_batch = max(1, int(budget // forward_bytes))
+        logger.info(f'Tiled inference of {height}x{width} frames: {tile_height}x{tile_width} tiles, halo {self.halo}, '
+                    f'{max_batch} tiles per forward')
+        self._plans[key] = (tile_height, tile_width, max_batch)
+        return self._plans[key]
+
+    @torch.no_grad()
+    def __call__(self, image_units):
+        """ Infer the voxels of image units of any size
+        Args:
+            image_units: the image units. Shape: (B, L, 2, H, W)
+        Returns:
+            pred_voxel: the predicted voxels on CPU. Shape: (B, L, 20, H, W)
+        """
+        B, L, _, H, W = image_units.shape
+        tile_height, tile_width, max_batch = self.plan(L, H, W)
+
+        # Group the tiles by the shape of their padded input, so that they can be stacked
+        groups = {}
+        for y0 in _tile_starts(H, tile_height):
+            for x0 in _tile_starts(W, tile_width):
+                y1, x1 = min(y0 + tile_height, H), min(x0 + tile_width, W)
+                # The halo is a multiple of TILE_ALIGNMENT, so the padded tiles stay on the grid
+                py0, px0 = max(y0 - self.halo, 0), max(x0 - self.halo, 0)
+                py1, px1 = min(y1 + self.halo, H), min(x1 + self.halo, W)
+                groups.setdefault((py1 - py0, px1 - px0), []).append((y0, y1, x0, x1, py0, py1, px0, px1))
+
+        pred_voxel = None
+        for tiles in groups.values():
+            # Every (tile, sequence) pair is one sample of the batch, tile-major
+            for i in range(0, len(tiles) * B, max_batch):
+                items = [(tiles[j // B], j % B) for j in range(i, min(i + max_batch, len(tiles) * B))]
+                inputs = torch.stack([image_units[b, ..., py0:py1, px0:px1] for (_, _, _, _, py0, py1, px0, px1), b in items])
+                outputs = self.runtime(self.model, inputs).cpu()
+                if pred_voxel is None:
+                    pred_voxel = torch.empty(B, L, outputs.shape[2], H, W)
+                for output, ((y0, y1, x0, x1, py0, _, px0, _), b) in zip(outputs, items):
+                    pred_voxel[b, ..., y0:y1, x0:x1] = output[..., y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        return pred_voxel
@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as f
 import numpy as np
-from einops import rearrange
 from .submodules import ConvLayer2D, ResidualBlock, ConvLayer3D, ResidualBlock3D
 
 
@@ -355,11 +354,9 @@ class UNet3D(nn.Module):
         # Decoder
         all_pred = []
         for i, (skip_connection, decoder) in enumerate(zip(skip_connections, self.decoders)):
-            B, C, *_ = x.shape
-            x = rearrange(x, 'b c l h w -> (b l) c h w')
-            x = f.interpolate(x, size=(skip_connection.shape[3], skip_connection.shape[4]),
+            # Nearest upsampling of every frame, keeping the sequence length
+            x = f.interpolate(x, size=(x.shape[2], skip_connection.shape[3], skip_connection.shape[4]),
                               mode='nearest')
-            x = rearrange(x, '(b l) c h w -> b c l h w', b=B)
             # print(x.shape, skip_connection.shape)
             x = self.apply_skip_connection(x, skip_connection)
             x = decoder(x)
@@ -5,7 +5,7 @@ import logging
 import datetime
 import numpy as np
 from pathlib2 import Path
-from collections import namedtuple
+from collections import deque, namedtuple
 
 logger = logging.getLogger(__name__)
 Size = namedtuple("Size", ["height", "width"])
@@ -267,6 +267,54 @@ class VideoReader:
             logger.exception("Exception while reading movie %s" % self.path)
             return None
 
+    def iter_windows(self, starting_idxs, window_len):
+        """Decodes the video strictly sequentially and yields frame windows.
+
+        Frames are kept in a ring buffer of `window_len` entries, so frames
+        shared by overlapping windows (e.g. the boundary frame of two adjacent
+        sequences) are decoded only once, and no seek is issued as long as
+        the windows move forward through the video.
+
+        Arguments:
+            starting_idxs: the first frame index of each window. Should be
+                sorted from low-to-high, so that window ends never move
+                backwards.
+            window_len: the number of frames in each window.
+
+        Yields:
+            - a NumPy array of shape (window_len, height, width[, 3])
+
+        Reading stops if decoding a frame fails, in which case the remaining
+        windows are not yielded.
+        """
+        assert window_len > 0
+        ring = deque(maxlen=window_len)
+        next_idx = None  # index of the next frame returned by vidcap.read()
+
+        for starting_idx in starting_idxs:
+            starting_idx = int(starting_idx)
+            ending_idx = starting_idx + window_len
+
+            # Only seek if the window is not reachable by decoding forward
+            if next_idx is None or starting_idx < next_idx - len(ring) or starting_idx > next_idx:
+                logger.debug(f"Seeking to frame {starting_idx}")
+                self.vidcap.set(cv2.CAP_PROP_POS_FRAMES, starting_idx)
+                ring.clear()
+                next_idx = starting_idx
+
+            while next_idx < ending_idx:
+                ret, frame = self.vidcap.read()
+                if not ret or frame is None:
+                    logger.error("Error: Failed to retrieve frame %d from movie %s" %
+                                 (next_idx, self.path))
+                    return
+                ring.append(self._postprocess_frame(frame))
+                next_idx += 1
+
+            # ring[i] holds frame (next_idx - len(ring) + i)
+            first = starting_idx - (next_idx - len(ring))
+            yield np.stack([ring[i] for i in range(first, first + window_len)], axis=0)
+
     def read_middle_frame(self):
         """Reads the frame from the middle of the video."""
         return self._read_frame_at_index(self.frame_count // 2)
@@ -0,0 +1,58 @@
+import sys
+import os.path as op
+
+import pytest
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from scripts.v2ce_3d import V2ce3d
+from scripts.freeze import freeze_v2ce3d
+from scripts.backends import BackendModel, export_torchscript, export_onnx
+
+
+@pytest.fixture(scope='module')
+def frozen_model():
+    torch.manual_seed(0)
+    return freeze_v2ce3d(V2ce3d().eval()).eval()
+
+
+def image_units(batch_size, width, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand(batch_size, 16, 2, 32, width, generator=generator)
+
+
+@torch.no_grad()
+def test_torchscript_parity(frozen_model, tmp_path):
+    path = str(tmp_path / 'v2ce_3d.ts.pt')
+    export_torchscript(frozen_model, image_units(1, 48), path=path)
+    traced = torch.jit.load(path)
+    # The graph is traced at one shape and runs at others
+    for batch_size, width in [(1, 48), (2, 64)]:
+        inputs = image_units(batch_size, width, seed=batch_size)
+        torch.testing.assert_close(traced(inputs), frozen_model(inputs), atol=1e-4, rtol=1e-4)
+
+
+@torch.no_grad()
+def test_onnx_parity(frozen_model, tmp_path):
+    pytest.importorskip('onnxruntime')
+    from scripts.backends import OnnxRuntimeModel
+    path = str(tmp_path / 'v2ce_3d.onnx')
+    export_onnx(frozen_model, image_units(1, 48), path, dynamic_width=True)
+    graph = OnnxRuntimeModel(path)
+    for batch_size, width in [(1, 48), (2, 64)]:
+        inputs = image_units(batch_size, width, seed=batch_size)
+        torch.testing.assert_close(graph(inputs), frozen_model(inputs), atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize('backend', ['torchscript', 'onnxruntime'])
+@torch.no_grad()
+def test_backend_model(frozen_model, backend):
+    if backend == 'onnxruntime':
+        pytest.importorskip('onnxruntime')
+    model = BackendModel(frozen_model, backend)
+    inputs = image_units(1, 48)
+    torch.testing.assert_close(model(inputs), frozen_model(inputs), atol=1e-4, rtol=1e-4)
+    # The backend is kept, not replaced by the eager model after a failed parity check
+    assert model._graph is not frozen_model
+    inputs = image_units(2, 64, seed=2)
+    torch.testing.assert_close(model(inputs), frozen_model(inputs), atol=1e-4, rtol=1e-4)
@@ -0,0 +1,133 @@
+import sys
+import os.path as op
+
+import numpy as np
+import pytest
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from scripts.event_io import (EVENT_DTYPE, EVENT_FORMATS, EVT2_TIME_HIGH, EVT2_TIME_BITS, Evt2EventWriter, Evt2EventReader,
+                              encode_evt2, decode_evt2, open_event_writer, read_events)
+
+
+def make_events(timestamps, x=None, y=None, polarity=None, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(timestamps)
+    events = np.empty(n, dtype=EVENT_DTYPE)
+    events['timestamp'] = timestamps
+    events['x'] = rng.integers(0, 2048, n) if x is None else x
+    events['y'] = rng.integers(0, 2048, n) if y is None else y
+    events['polarity'] = rng.integers(0, 2, n) if polarity is None else polarity
+    return events
+
+
+def write_evt2(path, batches, **kwargs):
+    with Evt2EventWriter(path, **kwargs) as writer:
+        for events in batches:
+            writer.write(events)
+    return writer
+
+
+def test_encode_empty():
+    words, time_high = encode_evt2(np.empty(0, dtype=EVENT_DTYPE), time_high=5)
+    assert len(words) == 0 and time_high == 5
+    events, time_high = decode_evt2(words, time_high=5)
+    assert len(events) == 0 and events.dtype == EVENT_DTYPE and time_high == 5
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'empty.raw')
+    write_evt2(path, [np.empty(0, dtype=EVENT_DTYPE)], width=346, height=260)
+    with Evt2EventReader(path) as reader:
+        assert reader.num_words == 0
+        assert (reader.width, reader.height) == (346, 260)
+        events = reader.read()
+    assert len(events) == 0 and events.dtype == EVENT_DTYPE
+
+
+def test_time_high_carried_across_writes(tmp_path):
+    # Every batch starts within the time high of the previous one, so the writer must not repeat its TIME_HIGH word
+    events = make_events(np.arange(0, 640, 5))
+    batches = np.array_split(events, 7)
+    path = str(tmp_path / 'carry.raw')
+    write_evt2(path, batches)
+    with Evt2EventReader(path) as reader:
+        words = np.asarray(reader._words)
+        np.testing.assert_array_equal(reader.read(), events)
+    num_time_high = int(np.count_nonzero(words >> 28 == EVT2_TIME_HIGH))
+    assert num_time_high == len(np.unique(events['timestamp'] >> 6))
+    assert len(words) == len(events) + num_time_high
+
+
+def test_decode_across_batches():
+    events = make_events(np.arange(0, 10000, 7))
+    words, _ = encode_evt2(events)
+    decoded, time_high = [], 0
+    for start in range(0, len(words), 13):
+        batch, time_high = decode_evt2(words[start:start + 13], time_high)
+        decoded.append(batch)
+    np.testing.assert_array_equal(np.concatenate(decoded), events)
+
+
+def test_non_monotonic_timestamps(tmp_path):
+    timestamps = np.array([1000, 5, 70, 69, 1 << 20, 64, 64, 0, 127, 3 << 30])
+    events = make_events(timestamps)
+    path = str(tmp_path / 'unsorted.raw')
+    write_evt2(path, [events[:4], events[4:]])
+    np.testing.assert_array_equal(read_events(path), events)
+
+
+def test_timestamps_near_the_limit():
+    timestamps = np.array([0, 2 ** EVT2_TIME_BITS - 65, 2 ** EVT2_TIME_BITS - 64, 2 ** EVT2_TIME_BITS - 1])
+    events = make_events(timestamps)
+    words, time_high = encode_evt2(events)
+    assert time_high == (2 ** EVT2_TIME_BITS - 1) >> 6
+    decoded, _ = decode_evt2(words)
+    np.testing.assert_array_equal(decoded, events)
+    with pytest.raises(AssertionError):
+        encode_evt2(make_events([2 ** EVT2_TIME_BITS]))
+
+
+def test_coordinates_at_the_limit():
+    events = make_events(np.arange(4), x=[0, 2047, 2047, 0], y=[2047, 0, 2047, 0], polarity=[1, 0, 1, 0])
+    decoded, _ = decode_evt2(encode_evt2(events)[0])
+    np.testing.assert_array_equal(decoded, events)
+    with pytest.raises(AssertionError):
+        encode_evt2(make_events([0], x=[2048], y=[0]))
+
+
+def test_interrupted_file(tmp_path):
+    events = make_events(np.arange(0, 3000, 3))
+    path = str(tmp_path / 'interrupted.raw')
+    write_evt2(path, [events])
+    # Cut the file in the middle of the last word
+    with open(path, 'r+b') as f:
+        f.truncate(op.getsize(path) - 2)
+    with Evt2EventReader(path) as reader:
+        np.testing.assert_array_equal(reader.read(), events[:-1])
+
+
+def test_read_filters(tmp_path):
+    events = make_events(np.arange(0, 100000, 10), x=np.arange(10000) % 346, y=np.arange(10000) % 260)
+    path = str(tmp_path / 'filters.raw')
+    write_evt2(path, np.array_split(events, 3), width=346, height=260)
+    x, y, t = events['x'], events['y'], events['timestamp']
+    with Evt2EventReader(path) as reader:
+        np.testing.assert_array_equal(reader.read(t0=25000), events[t >= 25000])
+        np.testing.assert_array_equal(reader.read(t1=25000), events[t < 25000])
+        np.testing.assert_array_equal(reader.read(t0=1234, t1=56789), events[(t >= 1234) & (t < 56789)])
+        roi = (100, 50, 200, 60)
+        np.testing.assert_array_equal(reader.read(roi=roi), events[(x >= 100) & (x < 200) & (y >= 50) & (y < 60)])
+        np.testing.assert_array_equal(reader.read(t0=50000, t1=50000), events[:0])
+
+
+@pytest.mark.parametrize('event_format', list(EVENT_FORMATS))
+def test_round_trip(tmp_path, event_format):
+    rng = np.random.default_rng(0)
+    batches = [make_events(np.sort(rng.integers(0, 33333, 1000)) + i * 33333, x=rng.integers(0, 346, 1000),
+                           y=rng.integers(0, 260, 1000), seed=i) for i in range(4)]
+    batches.insert(2, np.empty(0, dtype=EVENT_DTYPE))
+    with open_event_writer(tmp_path / 'events', event_format) as writer:
+        for events in batches:
+            writer.write(events)
+    assert writer.path.endswith(EVENT_FORMATS[event_format])
+    np.testing.assert_array_equal(read_events(writer.path), np.concatenate(batches))
@@ -0,0 +1,46 @@
+import sys
+import os.path as op
+
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import get_patch_starts, infer_pano_image_unit
+
+
+class PixelModel(nn.Module):
+    """ A model predicting the voxels of each pixel from its own inputs, so that the patches of a panorama
+    stitch into the prediction of the whole image """
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.linear = nn.Linear(2, 20)
+
+    def forward(self, x):
+        return self.linear(x.movedim(2, -1)).movedim(-1, 2)
+
+
+@pytest.mark.parametrize('total_width, width, expected', [
+    (96, 48, [0, 48]),
+    (100, 48, [0, 48, 52]),
+    (48, 48, [0]),
+    (40, 48, [0]),
+])
+def test_patch_starts(total_width, width, expected):
+    assert get_patch_starts(total_width, width) == expected
+
+
+@pytest.mark.parametrize('total_width', [40, 48, 100])
+@pytest.mark.parametrize('chunk_size', [0, 1])
+@pytest.mark.parametrize('blend', [False, True])
+def test_pano_matches_whole_image(total_width, chunk_size, blend):
+    model = PixelModel().eval()
+    torch.manual_seed(1)
+    image_units = torch.rand(2, 16, 2, 32, total_width)
+    with torch.no_grad():
+        expected = model(image_units)
+        pred_voxel = infer_pano_image_unit(model, image_units, width=48, chunk_size=chunk_size, blend=blend)
+    assert pred_voxel.shape == (2, 16, 20, 32, total_width)
+    torch.testing.assert_close(pred_voxel, expected)
@@ -0,0 +1,207 @@
+"""
+This script converts many videos and image folders into events, loading the model once per worker.
+
+The progress of every input is kept in a status file of the output folder, updated at checkpoints every few
+sequences, so an interrupted run restarted with the same command skips the converted inputs and resumes the
+others from their last checkpoint (with the chunked event format, otherwise they start over).
+
+Example:
+    python tools/batch_convert.py --inputs ./videos -o ./output --event_format chunked --num_workers 4
+"""
+import os
+import sys
+import json
+import time
+import logging
+import multiprocessing
+import os.path as op
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+import v2ce
+from v2ce import SBool, get_parser, get_trained_mode, get_output_name, convert
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+
+logger = logging.getLogger('V2CE.batch')
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def find_inputs(path):
+    """ List the inputs of a directory or a manifest
+    Args:
+        path: a directory of videos and image folders (subdirectories holding .png images), or a text
+            file listing one video or image folder per line (empty lines and lines starting with # are skipped)
+    Returns:
+        inputs: a list of (name, kind, path), kind being 'video' or 'image_folder'
+    """
+    if op.isdir(path):
+        paths = [op.join(path, f) for f in sorted(os.listdir(path))]
+        paths = [p for p in paths if (op.isfile(p) and p.lower().endswith(VIDEO_EXTENSIONS)) or
+                 (op.isdir(p) and any(f.endswith('.png') for f in os.listdir(p)))]
+    else:
+        with open(path) as f:
+            paths = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+    inputs = []
+    for p in paths:
+        assert op.exists(p), f'{p} does not exist'
+        kind = 'image_folder' if op.isdir(p) else 'video'
+        name = op.basename(op.normpath(p)) if kind == 'image_folder' else op.splitext(op.basename(p))[0]
+        inputs.append((name, kind, p))
+    names = [name for name, _, _ in inputs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    assert len(duplicates) == 0, f'Inputs with the same name would write the same outputs: {duplicates}'
+    return inputs
+
+
+class StatusManifest:
+    """The status of every input of a batch, one JSON file per input in `<out_folder>/status`.
+
+    Each file is only written by the worker converting the input, and replaced atomically, so a
+    status is never partially written, whatever the moment the run is interrupted.
+    """
+
+    def __init__(self, out_folder):
+        self.folder = op.join(out_folder, 'status')
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, name):
+        return op.join(self.folder, f'{name}.json')
+
+    def load(self, name):
+        """ The status of an input, None if it was never started """
+        if not op.exists(self._path(name)):
+            return None
+        with open(self._path(name)) as f:
+            return json.load(f)
+
+    def save(self, name, status):
+        tmp_path = self._path(name) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, self._path(name))
+
+    def is_done(self, name):
+        status = self.load(name)
+        return status is not None and status['status'] == 'done' and op.exists(status['events_path'])
+
+
+# The model and the options of the worker process, set by `init_worker`
+_worker = {}
+
+
+def init_worker(args, num_threads):
+    """ Load the model once per worker process """
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    configure_cpu_threads(num_threads)
+    runtime = InferenceRuntime(device=args.device, precision=args.precision, channels_last=args.channels_last)
+    model = get_trained_mode(model_path=args.model_path, runtime=runtime, freeze=args.freeze,
+                             backend=args.backend, backend_path=args.backend_path, quantize=args.quantize)
+    _worker.update(args=args, runtime=runtime, model=model, manifest=StatusManifest(args.out_folder))
+    logger.info(f'Worker {os.getpid()} running on {runtime}')
+
+
+def convert_input(item):
+    """ Convert an input, resuming it from its last checkpoint when it was interrupted
+    Args:
+        item: (name, kind, path), see `find_inputs`
+    Returns:
+        name: the name of the input
+        status: its final status
+    """
+    name, kind, path = item
+    args, manifest = _worker['args'], _worker['manifest']
+    chunked = args.event_format == 'chunked'
+
+    status = manifest.load(name) or {}
+    resume = status.get('checkpoint') if chunked else None
+    # Only resume a conversion with the same output, the options may have changed since
+    if resume is not None and (status.get('output_name') != get_output_name(name, args) or not op.exists(status.get('events_path', ''))):
+        resume = None
+    status = dict(input=path, kind=kind, status='running', output_name=get_output_name(name, args),
+                  events_path=op.join(args.out_folder, f'{get_output_name(name, args)}-events{v2ce.EVENT_FORMATS[args.event_format]}'),
+                  checkpoint=resume, attempts=status.get('attempts', 0) + 1, pid=os.getpid())
+    manifest.save(name, status)
+
+    def on_checkpoint(checkpoint):
+        status['checkpoint'] = checkpoint
+        manifest.save(name, status)
+
+    start = time.perf_counter()
+    try:
+        summary = convert(_worker['model'], _worker['runtime'], args,
+                          image_folder=path if kind == 'image_folder' else None,
+                          input_video_path=path if kind == 'video' else None,
+                          resume=resume, checkpoint_interval=args.checkpoint_interval if chunked else 0,
+                          on_checkpoint=on_checkpoint)
+    except Exception as e:
+        logger.exception(f'Failed to convert {path}')
+        status.update(status='failed', error=repr(e), elapsed=time.perf_counter() - start)
+        manifest.save(name, status)
+        return name, status
+    status.update(summary, status='done', elapsed=time.perf_counter() - start)
+    status.pop('error', None)
+    manifest.save(name, status)
+    return name, status
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.description = 'Convert many videos and image folders into events, resuming interrupted runs.'
+    parser.add_argument('--inputs', type=str, required=True, help='A directory of videos and image folders, or a text file listing one per line')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of worker processes, each with its own model')
+    parser.add_argument('--checkpoint_interval', type=int, default=8, help='Number of sequences between two checkpoints of an input (chunked event format only)')
+    parser.add_argument('--retry_failed', type=SBool, default=True, nargs='?', const=True, help='Whether to convert again the inputs which failed in a previous run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    # The worker processes are daemons, which cannot start the shard and stage 2 processes
+    assert args.num_workers == 1 or args.num_shards == 1, 'Use either --num_workers or --num_shards'
+    assert args.num_workers == 1 or args.stage2_workers <= 1, 'Use either --num_workers or --stage2_workers'
+    # Every worker would calibrate its own model on the first batch of its first input
+    assert args.num_workers == 1 or args.quantize != 'int8', 'Use an int8 checkpoint calibrated by tools/quantize_model.py with --num_workers'
+    os.makedirs(args.out_folder, exist_ok=True)
+    manifest = StatusManifest(args.out_folder)
+
+    inputs = find_inputs(args.inputs)
+    todo = []
+    for name, kind, path in inputs:
+        status = manifest.load(name)
+        if manifest.is_done(name):
+            continue
+        if status is not None and status['status'] == 'failed' and not args.retry_failed:
+            continue
+        todo.append((name, kind, path))
+    logger.info(f'{len(inputs)} inputs, {len(inputs) - len(todo)} skipped (converted or failed before), {len(todo)} to convert')
+    if not args.event_format == 'chunked':
+        logger.info('Inputs interrupted in the middle are converted again from the start, use --event_format chunked to resume them')
+
+    # Split the CPU threads between the workers
+    num_workers = max(1, min(args.num_workers, len(todo)))
+    num_threads = args.num_threads if args.num_threads > 0 or num_workers == 1 else max(1, (os.cpu_count() or 1) // num_workers)
+
+    results = {}
+    start = time.perf_counter()
+    if num_workers == 1:
+        init_worker(args, num_threads)
+        completed = map(convert_input, todo)
+    else:
+        # Spawn the workers, forking a process which already runs torch threads is unsafe
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=(args, num_threads))
+        completed = pool.imap_unordered(convert_input, todo)
+    for i, (name, status) in enumerate(completed):
+        results[name] = status
+        logger.info(f'[{i + 1}/{len(todo)}] {name}: {status["status"]}' +
+                    (f' ({status["frames"]} frames, {status["num_events"]} events, {status["elapsed"]:.1f}s)' if status['status'] == 'done' else ''))
+    if num_workers > 1:
+        pool.close()
+        pool.join()
+
+    # Summary of the whole batch, including the inputs converted by previous runs
+    summary = {name: manifest.load(name) for name, _, _ in inputs}
+    with open(op.join(args.out_folder, 'batch_status.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    failed = [name for name, status in summary.items() if status is None or status['status'] != 'done']
+    logger.info(f'Converted {len(results) - sum(s["status"] != "done" for s in results.values())} inputs in {time.perf_counter() - start:.1f}s, '
+                f'{len(inputs) - len(failed)}/{len(inputs)} done' + (f', not done: {failed}' if failed else ''))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,90 @@
+"""
+This script compares the stage 1 (V2ce3d) throughput of the CPU inference configurations against plain fp32.
+"""
+import os
+import sys
+import time
+import argparse
+import os.path as op
+
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from scripts.v2ce_3d import V2ce3d
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+
+CONFIGS = {
+    'fp32': dict(precision='fp32', channels_last=False),
+    'fp32-channels_last': dict(precision='fp32', channels_last=True),
+    'bf16-channels_last': dict(precision='bf16', channels_last=True),
+}
+
+
+def benchmark(model_path, configs, batch_size=1, seq_len=16, height=260, width=346, iters=3, warmup=1):
+    """
+    Run every configuration on the same random image units.
+    Args:
+        model_path: path to the checkpoint, None to use randomly initialized weights
+        configs: the names of the configurations in CONFIGS to run, the first one is the reference
+        batch_size: batch size for inference
+        seq_len: the sequence length
+        height: the height of the image units
+        width: the width of the image units
+        iters: number of timed forward passes
+        warmup: number of untimed forward passes
+    Returns:
+        results: a list of dicts with the frames/sec and the error against the reference outputs
+    """
+    torch.manual_seed(0)
+    state_dict = torch.load(model_path, map_location='cpu') if model_path is not None else V2ce3d().state_dict()
+    inputs = torch.randn(batch_size, seq_len, 2, height, width)
+
+    results = []
+    reference = None
+    for name in configs:
+        runtime = InferenceRuntime(device='cpu', **CONFIGS[name])
+        model = V2ce3d()
+        model.load_state_dict(state_dict)
+        model = runtime.prepare_model(model)
+
+        for _ in range(warmup):
+            outputs = runtime(model, inputs)
+        start = time.perf_counter()
+        for _ in range(iters):
+            outputs = runtime(model, inputs)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference = outputs
+        error = (outputs - reference).abs()
+        results.append({
+            'config': name,
+            'frames_per_sec': iters * batch_size * seq_len / elapsed,
+            'max_abs_error': error.max().item(),
+            'mean_abs_error': error.mean().item(),
+            'mean_abs_reference': reference.abs().mean().item(),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the CPU throughput of V2ce3d inference configurations.')
+    parser.add_argument('-m', '--model_path', type=str, default=None, help='The path to the trained model, random weights if not set')
+    parser.add_argument('-c', '--configs', type=str, nargs='+', default=list(CONFIGS), choices=list(CONFIGS), help='The configurations to compare, the first one is the reference')
+    parser.add_argument('-b', '--batch_size', type=int, default=1, help='Batch size for inference')
+    parser.add_argument('--seq_len', type=int, default=16, help='Sequence length')
+    parser.add_argument('--height', type=int, default=260, help='The height of the image units')
+    parser.add_argument('--width', type=int, default=346, help='The width of the image units')
+    parser.add_argument('--iters', type=int, default=3, help='Number of timed forward passes')
+    parser.add_argument('--num_threads', type=int, default=os.cpu_count(), help='Number of intra-op CPU threads')
+    args = parser.parse_args()
+
+    configure_cpu_threads(args.num_threads)
+    results = benchmark(args.model_path, args.configs, batch_size=args.batch_size, seq_len=args.seq_len,
+                        height=args.height, width=args.width, iters=args.iters)
+
+    base = results[0]['frames_per_sec']
+    print(f'{"config":<22}{"frames/s":>10}{"speedup":>9}{"max abs err":>13}{"mean abs err":>14}')
+    for r in results:
+        print(f'{r["config"]:<22}{r["frames_per_sec"]:>10.2f}{r["frames_per_sec"]/base:>8.2f}x'
+              f'{r["max_abs_error"]:>13.2e}{r["mean_abs_error"]:>14.2e}')
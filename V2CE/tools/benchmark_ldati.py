@@ -0,0 +1,200 @@
+"""
+This script measures the stage 2 (LDATI) event emission rate, and compares the batched `pick_and_sort`
+against the original per-batch, per-time-bin implementation.
+"""
+import sys
+import time
+import argparse
+import os.path as op
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+import scripts.LDATI as LDATI
+
+# The original implementation, kept as the "before" reference of the benchmark
+
+def _densify(additional_ts, shape):
+    """ Scatter the ragged additional timestamps into the dense (..., max_event_num_per_voxel) layout of the reference """
+    values, offsets, voxel_index = additional_ts
+    max_event_num_per_voxel = max(int((offsets[1:] - offsets[:-1]).max()), 1) if voxel_index.numel() > 0 else 1
+    dense = torch.zeros(shape.numel(), max_event_num_per_voxel, dtype=values.dtype, device=values.device)
+    dense[voxel_index, torch.arange(len(voxel_index), device=values.device) - offsets[voxel_index]] = values
+    return dense.reshape(*shape, max_event_num_per_voxel)
+
+
+def _pick_elements_reference(ts: Tensor, num_elements: Tensor, additional_ts:Tensor, additional_events_strategy='none') -> Tuple[Tensor, Tensor, Tensor]:
+    """ Pick the first `num_elements` events from `ts`, and add their x and y index
+    Args:
+        ts(H,W): the exact location of the last event within the voxel
+        num_elements(H,W): event number at each pixel 
+        additional_ts(H,W,max_event_num_per_voxel): timestamps of additional events (where the voxel value is larger than 1)
+    """
+    H, W = num_elements.shape
+    device = ts.device
+
+    # if a voxel in num_elements has a value which is larger than 0 and smaller than 1, select it
+    selection = (num_elements == 1) #(num_elements > 0) & (num_elements <= 1)
+    # Create the row and column indices for events generated
+    x_index = torch.arange(W, device=device, dtype=torch.int16).expand(H, W)
+    y_index = torch.arange(H, device=device, dtype=torch.int16).unsqueeze(1).expand(H, W)
+    ts_selected = ts[selection]
+    x_index_selected = x_index[selection]
+    y_index_selected = y_index[selection]
+    
+    num_elements = torch.where((num_elements==1), torch.zeros_like(num_elements), num_elements)
+    
+    max_event_num_per_voxel = additional_ts.shape[-1]
+    selection_additional = torch.arange(additional_ts.shape[-1], device=device).unsqueeze(0).unsqueeze(1) < num_elements.unsqueeze(2)
+
+    if additional_events_strategy != 'none':
+        ts_selected = torch.cat((ts_selected, additional_ts[selection_additional]))
+        x_index_selected = torch.cat((x_index_selected, x_index.unsqueeze(-1).expand(H, W, max_event_num_per_voxel)[selection_additional]))
+        y_index_selected = torch.cat((y_index_selected, y_index.unsqueeze(-1).expand(H, W, max_event_num_per_voxel)[selection_additional]))
+    return ts_selected, x_index_selected, y_index_selected
+
+def _pick_and_sort_reference(ts, num_elements, additional_ts=None, additional_events_strategy='none', time_offsets=None, sink=None):
+    """ Pick the first `num_elements` events from `ts`, and add their x and y index, output as dvs events
+    Args:
+        ts(B,P,C,H,W): timestamp of the last event within the voxel
+        num_elements(B,P,C,H,W): number of element to keep in each 1-d array of timestamps of the voxel
+        additional_ts(B,P,C,H,W): timestamps of additional events (where the voxel value is larger than 1)
+        time_offsets, sink: not supported, the runs of the benchmark do not use them
+    """
+    assert time_offsets is None and sink is None
+    B, P, C, H, W = ts.shape
+    device = ts.device
+    
+    if isinstance(additional_ts, LDATI.RaggedTimestamps):
+        additional_ts = _densify(additional_ts, ts.shape)
+    num_elements = torch.swapaxes(num_elements, 1, 2)
+    ts = torch.swapaxes(ts, 1, 2) # (B, C, P, H, W)
+    if additional_ts is not None:
+        additional_ts = torch.swapaxes(additional_ts, 1, 2)
+    else:
+        additional_ts = torch.zeros(ts.shape+(1,), device=device, dtype=ts.dtype)
+
+    # these two tensors need to be sliced B times, convert into tuple for faster accessing
+    ts_by_batch = tuple(ts)
+    selection_by_batch = tuple(num_elements)
+    additional_ts_by_batch = tuple(additional_ts)
+
+    result_all = []
+    # Iterate through each batch
+    for batch_idx in range(B): # B
+        # four arrays store the four columns of output in this batch
+        ts_all, row_all, column_all, p_all = [], [], [], []
+
+        ts_by_voxel = tuple(ts_by_batch[batch_idx]) # (C, P, H, W)
+        selection_by_voxel = tuple(selection_by_batch[batch_idx])
+        additional_ts_by_voxel = tuple(additional_ts_by_batch[batch_idx]) 
+
+        # Iterate through each channel
+        for channel_index in range(C): # C
+            ts_channel = ts_by_voxel[channel_index] # (P, H, W)
+            selection_channel = selection_by_voxel[channel_index] # (P, H, W)
+            additional_ts_channel = additional_ts_by_voxel[channel_index] # (P, H, W)
+
+            # process negative events
+            ts_n, row_n, column_n = _pick_elements_reference(ts_channel[1], selection_channel[1], additional_ts_channel[1], additional_events_strategy=additional_events_strategy)
+
+            # process positive events
+            ts_p, row_p, column_p = _pick_elements_reference(ts_channel[0], selection_channel[0], additional_ts_channel[0], additional_events_strategy=additional_events_strategy)
+
+            # stack them together, sort them
+            ts_np = torch.hstack((ts_n, ts_p))
+            sorting = ts_np.argsort()
+
+            ts_all.append(ts_np[sorting])
+            row_all.append(torch.hstack((row_n, row_p))[sorting])
+            column_all.append(torch.hstack((column_n, column_p))[sorting])
+            p_all.append(torch.hstack((torch.zeros((ts_n.shape[0]), device=device, dtype=torch.int8),
+                                       torch.ones((ts_p.shape[0]), device=device, dtype=torch.int8)))[sorting])
+            
+        ts_all, row_all, column_all, p_all = [torch.hstack(x).cpu() for x in [ts_all, row_all, column_all, p_all]]
+        
+        # convert to numpy recarray
+        result_all.append(np.rec.fromarrays([ts_all, row_all, column_all, p_all], names=['timestamp', 'x', 'y', 'polarity']))
+        # [('timestamp', '<i8'), ('x', '<i2'), ('y', '<i2'), ('polarity', 'i1')]
+    return result_all
+
+
+def run(pick_and_sort, y, seed, strategy, device, iters):
+    """
+    Run sample_voxel_statistical with the given pick_and_sort implementation.
+    Returns:
+        events: the event streams of the last run
+        elapsed: the mean run time in seconds
+    """
+    original = LDATI.pick_and_sort
+    LDATI.pick_and_sort = pick_and_sort
+    try:
+        elapsed = 0
+        for _ in range(iters):
+            torch.manual_seed(seed)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            events = LDATI.sample_voxel_statistical(y, additional_events_strategy=strategy)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+    finally:
+        LDATI.pick_and_sort = original
+    return events, elapsed / iters
+
+
+def same_events(events_a, events_b):
+    """ Whether both lists of event streams hold the same records, only the order of events with equal timestamps may differ """
+    return all(np.array_equal(np.sort(np.asarray(a), order=['timestamp', 'x', 'y', 'polarity']),
+                              np.sort(np.asarray(b), order=['timestamp', 'x', 'y', 'polarity']))
+               for a, b in zip(events_a, events_b))
+
+
+def check_near_zero_voxels(device):
+    """
+    Regression check: a tiny value followed by an empty bin is relocated to a count of -1,
+    which must produce no events instead of failing to build the additional events.
+    Returns:
+        ok: whether every strategy runs and matches the reference implementation
+    """
+    y = torch.zeros((2, 2, 10, 8, 8), device=device)
+    y[0, 0, 3, 1, 1] = 1.0017e-6
+    y[0, 1, 0, 2, 5] = 1e-7
+    y[1, 0, 8, 7, 0] = 1.0017e-6
+    y[1, 1, 4:6, 3, 3] = 2.5
+    ok = True
+    for strategy in ['none', 'random', 'slope']:
+        before, _ = run(_pick_and_sort_reference, y, 0, strategy, device, 1)
+        after, _ = run(LDATI.pick_and_sort, y, 0, strategy, device, 1)
+        ok &= same_events(before, after)
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the LDATI event emission.')
+    parser.add_argument('-b', '--batch_size', type=int, default=4, help='Number of frames per stage 2 batch')
+    parser.add_argument('--height', type=int, default=260, help='The height of the voxels')
+    parser.add_argument('--width', type=int, default=346, help='The width of the voxels')
+    parser.add_argument('--scale', type=float, default=2., help='Synthetic voxels are uniform in [0, scale)')
+    parser.add_argument('-s', '--strategy', type=str, default='slope', choices=['none', 'random', 'slope'], help='additional_events_strategy')
+    parser.add_argument('-d', '--device', type=str, default='cpu', help='The device to run on')
+    parser.add_argument('--iters', type=int, default=3, help='Number of timed runs')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    y = torch.rand((args.batch_size, 2, 10, args.height, args.width), device=device) * args.scale
+
+    results = {}
+    for name, impl in [('before', _pick_and_sort_reference), ('after', LDATI.pick_and_sort)]:
+        events, elapsed = run(impl, y, 0, args.strategy, device, args.iters)
+        total = sum(e.shape[0] for e in events)
+        results[name] = events
+        print(f'{name:<8}{total:>12d} events{elapsed*1e3:>10.1f} ms{total/elapsed/1e6:>10.2f} Mev/s')
+
+    print(f'Same events: {same_events(results["before"], results["after"])}')
+    print(f'Near-zero voxels: {"ok" if check_near_zero_voxels(device) else "FAILED"}')
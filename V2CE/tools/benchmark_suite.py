@@ -0,0 +1,291 @@
+"""
+This script benchmarks every stage of the V2CE pipeline on CPU, on synthetic frames and voxels, and writes
+the results as JSON, to compare them across changes:
+    - decode: frames/sec of VideoReader on a synthetic video
+    - preprocessing: frames/sec of the tensor (`preprocess_windows`) and cv2 (`image_pre_processing`) paths
+    - stage1: frames/sec of V2ce3d per backend and batch size
+    - stage2: events/sec of LDATI per additional_events_strategy
+    - write: events/sec and MB/sec of writing each event format, its size, and the events/sec of reading it back
+    - accumulate: events/sec of accumulating events into event frames, time surfaces and voxel grids, with numpy and torch
+Each stage runs in its own process, and the peak RSS of that process is recorded with the stage, along with the
+RSS it started the stage with (the interpreter and the imports).
+
+Example:
+    python tools/benchmark_suite.py -o benchmark.json
+    python tools/benchmark_suite.py --stages stage1 --backends eager torchscript --batch_sizes 1 4 -m ./weights/v2ce_3d.pt
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import os.path as op
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import get_trained_mode, preprocess_windows, image_pre_processing, PREPROCESSINGS
+from scripts.LDATI import sample_voxel_statistical, timer
+from scripts.video_reader import VideoReader
+from scripts.event_io import EVENT_DTYPE, EVENT_FORMATS, open_event_writer, read_events
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+from scripts.backends import BACKENDS
+from scripts.event_accumulator import event_frames, time_surface, voxel_grid, frame_voxel_grids
+from scripts.freeze import save_frozen_v2ce3d, build_frozen_v2ce3d
+
+logger = logging.getLogger('V2CE.benchmark')
+
+STAGES = ('decode', 'preprocessing', 'stage1', 'stage2', 'write', 'accumulate')
+STRATEGIES = ('none', 'random', 'slope')
+
+
+def peak_rss_mb():
+    """ The peak resident set size of the current process so far """
+    # On Linux, ru_maxrss keeps the peak of the process before its exec, i.e. of the parent of a spawned
+    # process, the peak of the current image (VmHWM) starts over
+    if op.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def synthetic_frames(num_frames, height, width, seed=0):
+    """ Frames of a textured pattern moving one pixel per frame, with noise. Shape: (num_frames, height, width), uint8 """
+    rng = np.random.default_rng(seed)
+    texture = cv2.GaussianBlur(rng.integers(0, 256, (height, width + num_frames), dtype=np.uint8), (7, 7), 0)
+    frames = np.stack([texture[:, i:i + width] for i in range(num_frames)], axis=0)
+    noise = rng.integers(-4, 5, frames.shape)
+    return np.clip(frames.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def time_iters(func, iters, warmup=1):
+    """ The mean run time of a function in seconds, and its last result """
+    for _ in range(warmup):
+        res = func()
+    elapsed = 0.
+    for _ in range(iters):
+        ms, res = timer(func, 'cpu')
+        elapsed += ms / 1e3
+    return elapsed / iters, res
+
+
+def bench_decode(args, workdir):
+    path = op.join(workdir, 'synthetic.avi')
+    frames = synthetic_frames(args.num_frames, args.frame_height, args.frame_width, seed=args.seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (args.frame_width, args.frame_height), isColor=False)
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+    window_len = args.seq_len + 1
+    starting_idxs = np.arange(0, args.num_frames - window_len + 1, args.seq_len)
+
+    def decode():
+        vidcap = VideoReader(path, color_mode='GRAY')
+        num = sum(len(w) for w in vidcap.iter_windows(starting_idxs, window_len))
+        vidcap.close()
+        return num
+
+    elapsed, num = time_iters(decode, args.iters)
+    decoded = len(starting_idxs) * args.seq_len + 1
+    return [dict(codec='MJPG', height=args.frame_height, width=args.frame_width, frames=decoded,
+                 frames_per_sec=decoded / elapsed, seconds=elapsed)]
+
+
+def bench_preprocessing(args, workdir):
+    frames = synthetic_frames(args.seq_len + 1, args.frame_height, args.frame_width, seed=args.seed)
+    results = []
+    for batch_size in args.batch_sizes:
+        windows = np.stack([frames] * batch_size, axis=0)
+        for preprocessing in PREPROCESSINGS:
+            if preprocessing == 'tensor':
+                func = lambda: preprocess_windows(windows, height=args.height)
+            else:
+                func = lambda: torch.cat([image_pre_processing(w, height=args.height)[np.newaxis] for w in windows], dim=0)
+            elapsed, _ = time_iters(func, args.iters)
+            results.append(dict(preprocessing=preprocessing, batch_size=batch_size, frames_per_sec=batch_size * args.seq_len / elapsed,
+                                seconds=elapsed))
+    return results
+
+
+def bench_stage1(args, workdir):
+    model_path = args.model_path
+    if model_path is None:
+        # Random weights, the speed does not depend on them
+        model_path = op.join(workdir, 'random_frozen.pt')
+        torch.manual_seed(args.seed)
+        save_frozen_v2ce3d(build_frozen_v2ce3d(), model_path)
+    runtime = InferenceRuntime(device='cpu')
+    torch.manual_seed(args.seed)
+    results = []
+    for backend in args.backends:
+        model = get_trained_mode(model_path, runtime, backend=backend)
+        for batch_size in args.batch_sizes:
+            inputs = torch.randn(batch_size, args.seq_len, 2, args.height, args.width)
+            try:
+                elapsed, _ = time_iters(lambda: runtime(model, inputs), args.iters, warmup=2 if backend == 'compile' else 1)
+            except Exception as e:
+                logger.warning(f'Failed to run the {backend} backend: {e}')
+                results.append(dict(backend=backend, batch_size=batch_size, error=repr(e)))
+                continue
+            results.append(dict(backend=backend, batch_size=batch_size, frames_per_sec=batch_size * args.seq_len / elapsed,
+                                seconds=elapsed, backend_error=getattr(model, 'parity_error', None)))
+        del model
+    return results
+
+
+def bench_stage2(args, workdir):
+    torch.manual_seed(args.seed)
+    voxels = torch.rand((args.stage2_batch_size, 2, 10, args.height, args.width)) * args.voxel_scale
+    results = []
+    for strategy in STRATEGIES:
+        def run():
+            torch.manual_seed(args.seed)
+            return sample_voxel_statistical(voxels, fps=30, additional_events_strategy=strategy)
+        elapsed, events = time_iters(run, args.iters)
+        num_events = sum(len(e) for e in events)
+        results.append(dict(strategy=strategy, frames=args.stage2_batch_size, events=num_events,
+                            events_per_sec=num_events / elapsed, seconds=elapsed))
+    return results
+
+
+def synthetic_events(args):
+    """ Synthetic frames of events, sorted by timestamp within each frame like the LDATI outputs """
+    rng = np.random.default_rng(args.seed)
+    frames = []
+    for i in range(args.write_frames):
+        events = np.empty(args.events_per_frame, dtype=EVENT_DTYPE)
+        events['timestamp'] = np.sort(rng.integers(0, 33333, args.events_per_frame)) + i * 33333
+        events['x'] = rng.integers(0, args.width, args.events_per_frame)
+        events['y'] = rng.integers(0, args.height, args.events_per_frame)
+        events['polarity'] = rng.integers(0, 2, args.events_per_frame)
+        frames.append(events)
+    return frames
+
+
+def bench_write(args, workdir):
+    frames = synthetic_events(args)
+    num_events = args.write_frames * args.events_per_frame
+
+    results = []
+    for event_format in EVENT_FORMATS:
+        def write():
+            with open_event_writer(op.join(workdir, f'bench-{event_format}'), event_format) as writer:
+                for events in frames:
+                    writer.write(events)
+            return writer.path
+        elapsed, path = time_iters(write, args.iters)
+        size = sum(op.getsize(p) for p in (path, path + '.idx') if op.exists(p))
+        read_elapsed, events = time_iters(lambda: read_events(path), args.iters)
+        results.append(dict(event_format=event_format, events=num_events, events_per_sec=num_events / elapsed,
+                            mb_per_sec=num_events * EVENT_DTYPE.itemsize / 2**20 / elapsed,
+                            bytes_per_event=size / num_events, seconds=elapsed, read_events_per_sec=num_events / read_elapsed,
+                            read_seconds=read_elapsed, round_trip=bool(np.array_equal(events, np.concatenate(frames)))))
+    return results
+
+
+def bench_accumulate(args, workdir):
+    events = np.concatenate(synthetic_events(args))
+    # The synthetic frames are 33333us long, like the frames of a 30 FPS video starting at frame 0
+    accumulators = {'event_frames': lambda device: event_frames(events, args.height, args.width, num_frames=args.write_frames, device=device),
+                    'time_surface': lambda device: time_surface(events, args.height, args.width, tau=10000, device=device),
+                    'voxel_grid': lambda device: voxel_grid(events, args.height, args.width, device=device),
+                    'frame_voxel_grids': lambda device: frame_voxel_grids(events, args.height, args.width, args.write_frames, device=device)}
+    results = []
+    for name, accumulate in accumulators.items():
+        for device in (None, 'cpu'):
+            elapsed, _ = time_iters(lambda: accumulate(device), args.iters)
+            results.append(dict(accumulator=name, backend='numpy' if device is None else 'torch', events=len(events),
+                                events_per_sec=len(events) / elapsed, seconds=elapsed))
+    return results
+
+
+BENCHMARKS = {'decode': bench_decode, 'preprocessing': bench_preprocessing, 'stage1': bench_stage1,
+              'stage2': bench_stage2, 'write': bench_write, 'accumulate': bench_accumulate}
+
+
+def _init_stage_worker(log_level, num_threads):
+    logging.basicConfig(level=getattr(logging, log_level.upper()))
+    configure_cpu_threads(num_threads)
+
+
+def _run_stage(stage, args, workdir):
+    start_rss = peak_rss_mb()
+    start = time.perf_counter()
+    results = BENCHMARKS[stage](args, workdir)
+    return dict(results=results, seconds=time.perf_counter() - start, start_rss_mb=start_rss, peak_rss_mb=peak_rss_mb())
+
+
+def run_stage(stage, args, workdir):
+    """ Benchmark a stage in a new process, so that its peak RSS is not the high-water mark of the previous stages
+    Args:
+        stage: one of STAGES
+        args: the options of the benchmark
+        workdir: the directory of the temporary files
+    Returns:
+        report: a dict of the results of the stage, its run time, and the RSS of its process at the start of the
+            stage and at its peak, in MB
+    """
+    # Spawn the process, forking a process which already runs torch threads is unsafe
+    with multiprocessing.get_context('spawn').Pool(1, initializer=_init_stage_worker, initargs=(args.log_level, args.num_threads)) as pool:
+        return pool.apply(_run_stage, (stage, args, workdir))
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=op.dirname(op.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), torch=torch.__version__, numpy=np.__version__,
+                opencv=cv2.__version__, platform=platform.platform(), processor=platform.processor(),
+                cpu_count=os.cpu_count(), torch_threads=torch.get_num_threads())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the V2CE pipeline on CPU with synthetic inputs.')
+    parser.add_argument('-o', '--out_path', type=str, default=None, help='The path to write the JSON results to, printed if not set')
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=STAGES, help='The stages to benchmark')
+    parser.add_argument('-m', '--model_path', type=str, default=None, help='The path to the trained model, random weights if not set')
+    parser.add_argument('--backends', type=str, nargs='+', default=['eager'], choices=BACKENDS, help='The stage 1 backends')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2], help='The stage 1 and preprocessing batch sizes')
+    parser.add_argument('--seq_len', type=int, default=16, help='Sequence length')
+    parser.add_argument('--height', type=int, default=260, help='The height of the image units and the voxels')
+    parser.add_argument('--width', type=int, default=346, help='The width of the image units and the voxels')
+    parser.add_argument('--frame_height', type=int, default=480, help='The height of the synthetic video frames')
+    parser.add_argument('--frame_width', type=int, default=640, help='The width of the synthetic video frames')
+    parser.add_argument('--num_frames', type=int, default=161, help='Number of frames of the synthetic video')
+    parser.add_argument('--stage2_batch_size', type=int, default=8, help='Number of frames of synthetic voxels per stage 2 run')
+    parser.add_argument('--voxel_scale', type=float, default=2., help='Synthetic voxels are uniform in [0, voxel_scale)')
+    parser.add_argument('--write_frames', type=int, default=32, help='Number of frames of synthetic events written and accumulated')
+    parser.add_argument('--events_per_frame', type=int, default=200000, help='Number of synthetic events per written or accumulated frame')
+    parser.add_argument('--iters', type=int, default=3, help='Number of timed runs of each measurement')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the synthetic inputs')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of intra-op CPU threads used by torch, 0 to keep the torch default')
+    parser.add_argument('-l', '--log_level', type=str, default='warning', help='Logging level')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    configure_cpu_threads(args.num_threads)
+    report = dict(environment=environment(), options=vars(args), stages={})
+    with tempfile.TemporaryDirectory(prefix='v2ce-benchmark-') as workdir:
+        for stage in args.stages:
+            report['stages'][stage] = run_stage(stage, args, workdir)
+            logger.info(f'{stage}: {json.dumps(report["stages"][stage])}')
+
+    if args.out_path is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.out_path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,62 @@
+"""
+This script converts event files between the formats written by v2ce.py (see EVENT_FORMATS), e.g. to archive
+.npz event streams in the compact EVT 2.0 encoding, about 4 bytes per event instead of 13.
+
+The format of each output is given by -f, the output path is the input path with the extension of that format
+in the output folder (next to the input if not set).
+
+Example:
+    python tools/convert_events.py -i ./output/*-events.npz -f evt2 --width 346 --height 260
+"""
+import sys
+import logging
+import argparse
+import os.path as op
+
+import numpy as np
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from scripts.event_io import EVENT_FORMATS, open_event_writer, read_events
+
+logger = logging.getLogger('V2CE.convert_events')
+
+
+def convert_events(in_path, out_path_stem, event_format, width=None, height=None, verify=True):
+    """ Convert an event file to another format
+    Args:
+        in_path: the path of the event file, of any of EVENT_FORMATS
+        out_path_stem: the output path without the extension
+        event_format: the output format, one of EVENT_FORMATS
+        width, height: the size of the sensor, written to the header of the evt2 format
+        verify: read the output back and check it holds the same events
+    Returns:
+        out_path: the path of the output
+    """
+    events = read_events(in_path)
+    kwargs = dict(width=width, height=height) if event_format == 'evt2' else {}
+    with open_event_writer(out_path_stem, event_format, **kwargs) as writer:
+        writer.write(events)
+    if verify:
+        assert np.array_equal(read_events(writer.path), events), f'{writer.path} does not hold the events of {in_path}'
+    return writer.path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert V2CE event files between the event formats.')
+    parser.add_argument('-i', '--inputs', type=str, nargs='+', required=True, help='The event files to convert (.npz, .evc or .raw)')
+    parser.add_argument('-o', '--out_folder', type=str, default=None, help='The folder to write the outputs to, next to the inputs if not set')
+    parser.add_argument('-f', '--event_format', type=str, default='evt2', choices=list(EVENT_FORMATS), help='The output format')
+    parser.add_argument('--width', type=int, default=None, help='The width of the sensor, for the header of the evt2 format')
+    parser.add_argument('--height', type=int, default=None, help='The height of the sensor, for the header of the evt2 format')
+    parser.add_argument('--verify', type=int, default=1, help='Read every output back and check it holds the same events')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for in_path in args.inputs:
+        stem = op.splitext(in_path)[0]
+        if args.out_folder is not None:
+            stem = op.join(args.out_folder, op.basename(stem))
+        out_path = convert_events(in_path, stem, args.event_format, width=args.width, height=args.height, verify=bool(args.verify))
+        in_size = sum(op.getsize(p) for p in (in_path, in_path + '.idx') if op.exists(p))
+        out_size = sum(op.getsize(p) for p in (out_path, out_path + '.idx') if op.exists(p))
+        logger.info(f'{in_path} -> {out_path}: {in_size / 2**20:.1f} MB -> {out_size / 2**20:.1f} MB ({in_size / max(out_size, 1):.2f}x smaller)')
@@ -0,0 +1,113 @@
+"""
+This script measures how well the events of a conversion reproduce its voxels, over many videos and image folders.
+Stage 1 predicts the voxels, and stage 2 converts them into events. The events are then accumulated back into
+voxel grids (see scripts/event_accumulator.py), and the two grids are compared frame by frame:
+    - voxel_rel_l1: sum |accumulated - predicted| / sum |predicted|, over the pixels and the time bins
+    - frame_rel_l1: the same error on the event frames, i.e. the voxels summed over the time bins
+    - count_error: the relative error of the number of events against the sum of the predicted voxels
+
+The script takes the options of v2ce.py, and samples the events the same way a conversion with those options does.
+
+Example:
+    python tools/event_round_trip.py --inputs ./videos -m ./weights/v2ce_3d.pt -b 4 --report ./round_trip.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import os.path as op
+from functools import partial
+
+import numpy as np
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import get_parser, get_trained_mode, iter_video_voxels, iter_voxel_chunks, frame_time_offsets
+from batch_convert import find_inputs
+from scripts.LDATI import sample_voxel_statistical
+from scripts.video_reader import VideoReader
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+from scripts.event_accumulator import INTERPOLATIONS, frame_voxel_grids
+
+logger = logging.getLogger('V2CE.round_trip')
+
+
+def round_trip_sums(voxels, events, fps=30, start_frame=0, interpolation='bilinear'):
+    """ The error sums of the voxels accumulated from the events of a chunk of frames
+    Args:
+        voxels: the predicted voxels. Shape: (N, 2, 10, H, W)
+        events: the events of the frames, a structured array of EVENT_DTYPE
+        fps: the FPS of the video
+        start_frame: the index of the first frame of the voxels
+        interpolation: see `frame_voxel_grids`
+    Returns:
+        sums: a dict of the sums of the errors and of the references, to be added over chunks, see `summarize`
+    """
+    N, _, num_bins, H, W = voxels.shape
+    accumulated = frame_voxel_grids(events, H, W, N, fps=fps, start_frame=start_frame, num_bins=num_bins, interpolation=interpolation)
+    voxels = voxels.astype(np.float32, copy=False)
+    return dict(frames=N, events=len(events), voxel_abs=float(np.abs(voxels).sum(dtype=np.float64)),
+                voxel_sum=float(voxels.sum(dtype=np.float64)), voxel_error=float(np.abs(accumulated - voxels).sum(dtype=np.float64)),
+                frame_error=float(np.abs(accumulated.sum(axis=2) - voxels.sum(axis=2)).sum(dtype=np.float64)))
+
+
+def summarize(sums):
+    voxel_abs = max(sums['voxel_abs'], 1e-12)
+    return dict(frames=sums['frames'], events=sums['events'], voxel_rel_l1=sums['voxel_error'] / voxel_abs,
+                frame_rel_l1=sums['frame_error'] / voxel_abs, count_error=(sums['events'] - sums['voxel_sum']) / max(sums['voxel_sum'], 1e-12))
+
+
+def input_round_trip(model, runtime, args, kind, path, interpolation='bilinear'):
+    """ The error sums of the round trip of the frames of an input """
+    if kind == 'image_folder':
+        source = dict(image_paths=sorted([op.join(path, f) for f in os.listdir(path) if f.endswith('.png')]))
+    else:
+        source = dict(vidcap=VideoReader(path, color_mode='GRAY'))
+    voxel_batches = iter_video_voxels(model, infer_type=args.infer_type, seq_len=args.seq_len, batch_size=args.batch_size,
+                                      width=args.width, height=args.height, prefetch_depth=args.prefetch_depth, runtime=runtime,
+                                      pano_chunk_size=args.pano_chunk_size, pano_blend=args.pano_blend,
+                                      preprocessing=args.preprocessing, num_threads=args.num_threads, **source)
+    ldati = partial(sample_voxel_statistical, fps=args.fps, bidirectional=False, additional_events_strategy='slope', seed=args.seed)
+    sums = dict(frames=0, events=0, voxel_abs=0., voxel_sum=0., voxel_error=0., frame_error=0.)
+    frame_idx = 0
+    for voxels in iter_voxel_chunks(voxel_batches, args.stage2_batch_size):
+        events = np.concatenate(ldati(torch.from_numpy(voxels).to(runtime.device), frame_idx=frame_idx,
+                                      time_offsets=frame_time_offsets(frame_idx, len(voxels), args.fps)))
+        for key, value in round_trip_sums(voxels, events, fps=args.fps, start_frame=frame_idx, interpolation=interpolation).items():
+            sums[key] += value
+        frame_idx += len(voxels)
+    return sums
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.description = 'Measure the error of the voxels accumulated from the events of many videos and image folders.'
+    parser.add_argument('--inputs', type=str, required=True, help='A directory of videos and image folders, or a text file listing one per line')
+    parser.add_argument('--interpolation', type=str, default='bilinear', choices=INTERPOLATIONS, help='How the events are accumulated into the time bins')
+    parser.add_argument('--report', type=str, default=None, help='The path to write the errors of every input and of the whole dataset to, as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    configure_cpu_threads(args.num_threads)
+    runtime = InferenceRuntime(device=args.device, precision=args.precision, channels_last=args.channels_last)
+    model = get_trained_mode(model_path=args.model_path, runtime=runtime, freeze=args.freeze,
+                             backend=args.backend, backend_path=args.backend_path, quantize=args.quantize)
+
+    results = {}
+    total = dict(frames=0, events=0, voxel_abs=0., voxel_sum=0., voxel_error=0., frame_error=0.)
+    start = time.perf_counter()
+    for name, kind, path in find_inputs(args.inputs):
+        sums = input_round_trip(model, runtime, args, kind, path, interpolation=args.interpolation)
+        for key, value in sums.items():
+            total[key] += value
+        results[name] = summarize(sums)
+        r = results[name]
+        logger.info(f'{name}: {r["frames"]} frames, {r["events"]} events, voxel rel L1 {r["voxel_rel_l1"]:.4f}, '
+                    f'frame rel L1 {r["frame_rel_l1"]:.4f}, count error {r["count_error"]:+.2%}')
+    summary = summarize(total)
+    print(f'{len(results)} inputs, {summary["frames"]} frames, {summary["events"]} events in {time.perf_counter() - start:.1f}s: '
+          f'voxel rel L1 {summary["voxel_rel_l1"]:.4f}, frame rel L1 {summary["frame_rel_l1"]:.4f}, count error {summary["count_error"]:+.2%}')
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(dict(options=vars(args), inputs=results, total=summary), f, indent=2)
@@ -0,0 +1,80 @@
+"""
+This script exports a V2ce3d checkpoint to a TorchScript and/or an ONNX graph, for the torchscript and
+onnxruntime backends of v2ce.py (--backend, --backend_path).
+
+The model is frozen before the export, and the exported graphs are checked against the eager model,
+at another width than the one they were exported with when their width is dynamic.
+
+Example:
+    python tools/export_model.py -m ./weights/v2ce_3d.pt --torchscript ./weights/v2ce_3d.ts.pt --onnx ./weights/v2ce_3d.onnx
+"""
+import sys
+import logging
+import argparse
+import os.path as op
+
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import SBool
+from scripts.v2ce_3d import V2ce3d
+from scripts.freeze import freeze_v2ce3d, is_frozen_checkpoint, load_frozen_v2ce3d
+from scripts.backends import export_torchscript, export_onnx, OnnxRuntimeModel
+
+
+@torch.no_grad()
+def check_graph(name, graph, model, inputs, atol):
+    outputs = graph(inputs)
+    reference = model(inputs)
+    max_abs_error = (outputs.float() - reference.float()).abs().max().item()
+    ok = outputs.shape == reference.shape and max_abs_error <= atol
+    print(f'{name} on {tuple(inputs.shape)}: max abs error {max_abs_error:.3e} ({"OK" if ok else "FAILED"})')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a V2ce3d checkpoint to TorchScript and ONNX graphs.')
+    parser.add_argument('-m', '--model_path', type=str, default='./weights/v2ce_3d.pt', help='The path to the trained or frozen model')
+    parser.add_argument('--torchscript', type=str, default=None, help='The path to write the TorchScript graph to')
+    parser.add_argument('--onnx', type=str, default=None, help='The path to write the ONNX graph to')
+    parser.add_argument('--dynamic_width', type=SBool, default=True, nargs='?', const=True, help='Whether the ONNX graph accepts any batch size, height and width')
+    parser.add_argument('--opset_version', type=int, default=17, help='The ONNX opset')
+    parser.add_argument('--seq_len', type=int, default=16, help='The sequence length of the exported model')
+    parser.add_argument('--height', type=int, default=260, help='The height of the example inputs')
+    parser.add_argument('--width', type=int, default=346, help='The width of the example inputs')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Absolute tolerance of the parity check')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    assert args.torchscript is not None or args.onnx is not None, 'Nothing to export, set --torchscript and/or --onnx'
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    if is_frozen_checkpoint(checkpoint):
+        model = load_frozen_v2ce3d(checkpoint)
+    else:
+        model = V2ce3d()
+        model.load_state_dict(checkpoint)
+        model = freeze_v2ce3d(model)
+    model.eval()
+
+    inputs = torch.randn(1, args.seq_len, 2, args.height, args.width)
+    # A dynamic graph is also checked on another batch size and width than the ones it was exported with
+    check_inputs = [inputs]
+    if args.dynamic_width:
+        check_inputs.append(torch.randn(2, args.seq_len, 2, args.height, args.width + 64))
+
+    ok = True
+    if args.torchscript is not None:
+        export_torchscript(model, inputs, args.torchscript)
+        print(f'TorchScript graph written to {args.torchscript} ({op.getsize(args.torchscript)/2**20:.1f} MB)')
+        graph = torch.jit.load(args.torchscript, map_location='cpu')
+        ok &= all(check_graph('TorchScript', graph, model, x, args.atol) for x in check_inputs)
+    if args.onnx is not None:
+        export_onnx(model, inputs, args.onnx, dynamic_width=args.dynamic_width, opset_version=args.opset_version)
+        print(f'ONNX graph written to {args.onnx} ({op.getsize(args.onnx)/2**20:.1f} MB)')
+        try:
+            graph = OnnxRuntimeModel(args.onnx)
+        except ImportError:
+            print('onnxruntime is not installed, skipping the parity check of the ONNX graph')
+        else:
+            ok &= all(check_graph('ONNX', graph, model, x, args.atol) for x in check_inputs)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,40 @@
+"""
+This script freezes a trained V2ce3d checkpoint for inference and saves it as a compact frozen checkpoint.
+"""
+import sys
+import logging
+import argparse
+import os.path as op
+
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from scripts.v2ce_3d import V2ce3d
+from scripts.freeze import clone_v2ce3d, freeze_v2ce3d, save_frozen_v2ce3d, load_frozen_v2ce3d, check_parity
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Freeze a V2ce3d checkpoint for inference.')
+    parser.add_argument('-m', '--model_path', type=str, default='./weights/v2ce_3d.pt', help='The path to the trained model')
+    parser.add_argument('-o', '--out_path', type=str, default='./weights/v2ce_3d_frozen.pt', help='The path to write the frozen checkpoint to')
+    parser.add_argument('--half', action='store_true', help='Store the frozen weights as fp16')
+    parser.add_argument('--height', type=int, default=260, help='The height of the parity check inputs')
+    parser.add_argument('--width', type=int, default=346, help='The width of the parity check inputs')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Absolute tolerance of the parity check')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model = V2ce3d()
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+
+    # Freeze a copy, the original model is kept as the parity reference
+    frozen = freeze_v2ce3d(clone_v2ce3d(model))
+    save_frozen_v2ce3d(frozen, args.out_path, half=args.half)
+    print(f'Frozen checkpoint written to {args.out_path} '
+          f'({op.getsize(args.model_path)/2**20:.1f} MB -> {op.getsize(args.out_path)/2**20:.1f} MB)')
+
+    # Check the saved checkpoint against the original model
+    inputs = torch.randn(1, 16, 2, args.height, args.width)
+    ok, max_abs_error = check_parity(model, load_frozen_v2ce3d(args.out_path), inputs,
+                                     atol=args.atol if not args.half else max(args.atol, 1e-2))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,146 @@
+"""
+This script quantizes a V2ce3d checkpoint to static int8 for CPU inference, calibrating the activations on the
+frames of a video or an image folder, and reports the accuracy, speed and memory of the quantized models
+(static int8 and weight-only int8) against fp32 on other sequences of the same input.
+
+The int8 checkpoint is loaded by v2ce.py like any other checkpoint (-m), without calibrating on the first batch.
+
+Example:
+    python tools/quantize_model.py -m ./weights/v2ce_3d.pt -i ./video.mp4 -o ./weights/v2ce_3d_int8.pt --report ./int8_report.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import os.path as op
+
+import numpy as np
+import torch
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import get_trained_mode, get_starting_indexes, iter_image_unit_batches
+from scripts.LDATI import sample_voxel_statistical
+from scripts.video_reader import VideoReader
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+from scripts.freeze import is_frozen_checkpoint, load_frozen_v2ce3d, freeze_v2ce3d
+from scripts.v2ce_3d import V2ce3d
+from scripts.quantization import quantize_int8, save_int8_v2ce3d
+
+logger = logging.getLogger('V2CE.quantize')
+
+
+def load_image_units(path, starting_indexes, seq_len=16, height=260, width=346, batch_size=1):
+    """ Load the center crops of the sequences of a video or an image folder
+    Returns:
+        a list of image unit batches, on CPU. Shape: (batch_size, seq_len, 2, height, width)
+    """
+    if op.isdir(path):
+        image_paths = sorted([op.join(path, f) for f in os.listdir(path) if f.endswith('.png')])
+        batches = iter_image_unit_batches(starting_indexes, seq_len, height=height, batch_size=batch_size, image_paths=image_paths)
+    else:
+        batches = iter_image_unit_batches(starting_indexes, seq_len, height=height, batch_size=batch_size,
+                                          vidcap=VideoReader(path, color_mode='GRAY'))
+    return [b[..., b.shape[-1]//2-width//2:b.shape[-1]//2+width//2].contiguous() for b in batches]
+
+
+def state_dict_bytes(model):
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values() if isinstance(t, torch.Tensor))
+
+
+def count_events(voxels, fps=30):
+    """ The number of events of each frame, from the voxels of a batch. Shape: (B, L, 20, H, W) """
+    torch.manual_seed(0)
+    voxels = voxels.reshape(-1, 2, 10, *voxels.shape[-2:])
+    return np.array([len(e) for e in sample_voxel_statistical(voxels, fps=fps, additional_events_strategy='slope')])
+
+
+@torch.no_grad()
+def evaluate(name, model, runtime, batches, reference=None, fps=30):
+    """ Run a model on the evaluation batches, and compare its voxels and events with the reference
+    Returns:
+        result: a dict of the speed, the weight memory and the errors against the reference
+        outputs: the voxels and the event counts of every batch
+    """
+    runtime(model, batches[0])  # Warmup
+    voxels, elapsed = [], 0.
+    for inputs in batches:
+        start = time.perf_counter()
+        voxels.append(runtime(model, inputs).cpu())
+        elapsed += time.perf_counter() - start
+    events = np.concatenate([count_events(v, fps=fps) for v in voxels])
+    num_frames = sum(len(v) * v.shape[1] for v in voxels)
+    result = dict(model=name, frames_per_sec=num_frames / elapsed, weights_mb=state_dict_bytes(model) / 2**20,
+                  num_events=int(events.sum()))
+    if reference is not None:
+        ref_voxels, ref_events = reference
+        error = torch.cat([(v - r).abs().flatten() for v, r in zip(voxels, ref_voxels)])
+        ref_abs = torch.cat([r.abs().flatten() for r in ref_voxels])
+        result.update(max_abs_error=error.max().item(), mean_abs_error=error.mean().item(),
+                      relative_l1_error=(error.sum() / ref_abs.sum().clamp_min(1e-12)).item(),
+                      event_count_error=(events.sum() - ref_events.sum()) / max(ref_events.sum(), 1),
+                      frame_event_count_error=float(np.mean(np.abs(events - ref_events) / np.maximum(ref_events, 1))))
+    return result, (voxels, events)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a V2ce3d checkpoint to int8 and report its accuracy, speed and memory against fp32.')
+    parser.add_argument('-m', '--model_path', type=str, default='./weights/v2ce_3d.pt', help='The path to the trained or frozen model')
+    parser.add_argument('-i', '--input', type=str, required=True, help='A video or an image folder, to calibrate and evaluate on')
+    parser.add_argument('-o', '--out_path', type=str, default='./weights/v2ce_3d_int8.pt', help='The path to write the int8 checkpoint to')
+    parser.add_argument('--report', type=str, default=None, help='The path to write the report to, as JSON')
+    parser.add_argument('--calibration_sequences', type=int, default=8, help='Number of sequences to calibrate the activations on')
+    parser.add_argument('--eval_sequences', type=int, default=4, help='Number of sequences to evaluate on, not used for calibration')
+    parser.add_argument('--seq_len', type=int, default=16, help='Sequence length')
+    parser.add_argument('--height', type=int, default=260, help='The height of the resized frames')
+    parser.add_argument('--width', type=int, default=346, help='The width of the center crop of the resized frames')
+    parser.add_argument('-b', '--batch_size', type=int, default=1, help='Batch size for inference')
+    parser.add_argument('--fps', type=int, default=30, help='The FPS of the input, for the events')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of intra-op CPU threads used by torch, 0 to keep the torch default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    configure_cpu_threads(args.num_threads)
+    frame_count = len([f for f in os.listdir(args.input) if f.endswith('.png')]) if op.isdir(args.input) \
+        else VideoReader(args.input, color_mode='GRAY').frame_count
+    starting_indexes, _ = get_starting_indexes(frame_count, args.seq_len)
+    # Evaluate on the first sequences, calibrate on sequences spread over the rest of the input
+    eval_indexes = starting_indexes[:args.eval_sequences]
+    rest = starting_indexes[args.eval_sequences:] if len(starting_indexes) > args.eval_sequences else starting_indexes
+    calibration_indexes = rest[np.unique(np.linspace(0, len(rest) - 1, args.calibration_sequences).round().astype(int))]
+    load = dict(seq_len=args.seq_len, height=args.height, width=args.width, batch_size=args.batch_size)
+    eval_batches = load_image_units(args.input, eval_indexes, **load)
+    calibration_batches = load_image_units(args.input, calibration_indexes, **load)
+    logger.info(f'Calibrating on {len(calibration_indexes)} sequences, evaluating on {len(eval_indexes)} sequences')
+
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    if is_frozen_checkpoint(checkpoint):
+        model = load_frozen_v2ce3d(checkpoint)
+    else:
+        model = V2ce3d()
+        model.load_state_dict(checkpoint)
+        model = freeze_v2ce3d(model)
+    save_int8_v2ce3d(quantize_int8(model, calibration_batches), args.out_path)
+    print(f'Int8 checkpoint written to {args.out_path} '
+          f'({op.getsize(args.model_path)/2**20:.1f} MB -> {op.getsize(args.out_path)/2**20:.1f} MB)')
+
+    # Compare the saved checkpoint and the weight-only model against fp32
+    runtime = InferenceRuntime(device='cpu')
+    results = []
+    result, reference = evaluate('fp32', get_trained_mode(args.model_path, runtime), runtime, eval_batches, fps=args.fps)
+    results.append(result)
+    for name, model in (('weight_only', get_trained_mode(args.model_path, runtime, quantize='weight_only')),
+                        ('int8', get_trained_mode(args.out_path, runtime))):
+        results.append(evaluate(name, model, runtime, eval_batches, reference=reference, fps=args.fps)[0])
+
+    base = results[0]['frames_per_sec']
+    print(f'{"model":<13}{"frames/s":>10}{"speedup":>9}{"weights MB":>12}{"voxel rel L1":>14}{"max abs err":>13}'
+          f'{"events":>10}{"events err":>12}{"frame events err":>18}')
+    for r in results:
+        print(f'{r["model"]:<13}{r["frames_per_sec"]:>10.2f}{r["frames_per_sec"]/base:>8.2f}x{r["weights_mb"]:>12.1f}'
+              f'{r.get("relative_l1_error", 0):>14.2e}{r.get("max_abs_error", 0):>13.2e}{r["num_events"]:>10}'
+              f'{r.get("event_count_error", 0):>+12.2%}{r.get("frame_event_count_error", 0):>18.2%}')
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(dict(model_path=args.model_path, int8_path=args.out_path, input=args.input, results=results), f, indent=2)
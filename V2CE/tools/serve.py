@@ -0,0 +1,334 @@
+"""
+This script runs V2CE as a local service, which keeps the model loaded between conversions.
+
+Concurrent requests are merged into dynamic batches of sequences, and each request streams back the voxels or the
+events of its sequences as they are inferred, as a sequence of .npy arrays (read them with `iter_npy_stream`).
+
+Endpoints:
+    POST /frames?output=events|voxels    body: a .npy array of frames, (N, H, W) grayscale or (N, H, W, 3) BGR, uint8
+    POST /video?output=events|voxels     body: JSON {"path": "<video path>", "max_frame_num": 0}
+    GET  /metrics                        the queue depth and the batching statistics, as JSON
+    GET  /health
+
+Example:
+    python tools/serve.py -m ./weights/v2ce_3d.pt --port 8000
+    curl -s --data-binary @frames.npy 'http://127.0.0.1:8000/frames?output=events' > events.npy
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import http.client
+import socketserver
+import os.path as op
+from collections import deque
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import torch
+import numpy as np
+from numpy.lib import format as npy_format
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+from v2ce import get_parser, get_trained_mode, get_starting_indexes, preprocess_windows, infer_image_units, trim_voxels, frame_time_offsets
+from scripts.LDATI import sample_voxel_statistical
+from scripts.video_reader import VideoReader
+from scripts.event_io import EVENT_DTYPE
+from scripts.dynamic_batcher import DynamicBatcher
+from scripts.tiled_inference import TiledInference
+from scripts.runtime import InferenceRuntime, configure_cpu_threads
+
+logger = logging.getLogger('V2CE.serve')
+
+OUTPUTS = ('events', 'voxels')
+
+
+class RequestError(ValueError):
+    """An invalid request, answered with a 400 status."""
+
+
+def iter_npy_stream(fp):
+    """ Read the arrays of a response, written one after the other in the .npy format
+    Args:
+        fp: a file-like object, e.g. the response of urllib.request.urlopen
+    Returns:
+        a generator of the arrays
+    """
+    while True:
+        try:
+            yield npy_format.read_array(fp)
+        except ValueError as e:
+            if 'EOF' in str(e):
+                return
+            raise
+
+
+class V2ceService:
+    """Converts the frames of the requests with a resident model.
+
+    Every sequence of a request is submitted to a DynamicBatcher, up to `max_batch_size` sequences
+    ahead of the one being returned, so a single request fills the batches by itself and
+    concurrent requests share them.
+    """
+
+    def __init__(self, model, runtime, args, max_batch_size=8, max_delay=0.02):
+        """
+        Args:
+            model: the trained model, prepared by `runtime`
+            runtime: the InferenceRuntime to run the model with
+            args: the options of `get_parser` (inference type, size, fps...)
+            max_batch_size: the maximum number of sequences per forward
+            max_delay: the maximum time in seconds a sequence waits for others to fill its batch
+        """
+        self.args = args
+        self.device = runtime.device
+        tiled = TiledInference(model, runtime, memory_budget=args.memory_budget, halo=args.tile_halo) if args.infer_type == 'full' else None
+        self.batcher = DynamicBatcher(partial(infer_image_units, model, infer_type=args.infer_type, width=args.width, runtime=runtime,
+                                              pano_chunk_size=args.pano_chunk_size, pano_blend=args.pano_blend, tiled=tiled),
+                                      max_batch_size=max_batch_size, max_delay=max_delay, name='v2ce-batcher')
+        self.ldati = partial(sample_voxel_statistical, fps=args.fps, bidirectional=False, additional_events_strategy='slope',
+                             compile_kernel=args.stage2_compile, seed=args.seed)
+        self._lock = threading.Lock()
+        self.active_requests = 0
+        self.served_requests = 0
+        self.served_frames = 0
+
+    def warmup(self, frame_width):
+        """ Run a request of black frames, so that the first request does not pay for the first-call overheads """
+        tic = time.perf_counter()
+        frames = np.zeros((self.args.seq_len + 1, self.args.height, frame_width), dtype=np.uint8)
+        for _ in self.iter_outputs(len(frames), (frames[s:s + self.args.seq_len + 1] for s in [0]), output='events'):
+            pass
+        logger.info(f'Warmed up in {time.perf_counter() - tic:.1f}s')
+
+    def iter_outputs(self, frame_count, frame_windows, output='events'):
+        """ Convert the frame windows of a request
+        Args:
+            frame_count: the number of frames of the request
+            frame_windows: the frame windows of the sequences of `get_starting_indexes`, uint8. Shape: (seq_len+1, H, W)
+            output: 'events' or 'voxels'
+        Returns:
+            a generator of the output of each sequence, the voxels (Shape: (N, 2, 10, H, W)) or the events of its
+            frames, with the timestamps relative to the first frame
+        """
+        seq_len, fps = self.args.seq_len, self.args.fps
+        starting_indexes, mode = get_starting_indexes(frame_count, seq_len)
+        frame_windows = iter(frame_windows)
+        pending = deque()
+        frame_idx = 0
+        with self._lock:
+            self.active_requests += 1
+        try:
+            for seq_idx in range(len(starting_indexes)):
+                while len(pending) < self.batcher.max_batch_size and seq_idx + len(pending) < len(starting_indexes):
+                    frames = next(frame_windows, None)
+                    if frames is None:
+                        raise RequestError(f'Failed to read the frames of sequence {seq_idx + len(pending)}')
+                    image_units = preprocess_windows(frames[np.newaxis], height=self.args.height, device=self.device)[0]
+                    pending.append(self.batcher.submit(image_units))
+                pred_voxel = pending.popleft().result()
+                voxels = trim_voxels(pred_voxel[np.newaxis].numpy(), height=self.args.height, width=pred_voxel.shape[-1],
+                                     mode=mode, is_last=seq_idx == len(starting_indexes) - 1)
+                if output == 'voxels':
+                    yield voxels
+                else:
+                    event_streams = self.ldati(torch.from_numpy(voxels).to(self.device), frame_idx=frame_idx,
+                                               time_offsets=frame_time_offsets(frame_idx, len(voxels), fps))
+                    yield np.concatenate(event_streams).astype(EVENT_DTYPE, copy=False)
+                frame_idx += len(voxels)
+        finally:
+            for future in pending:
+                future.cancel()
+            with self._lock:
+                self.active_requests -= 1
+                self.served_requests += 1
+                self.served_frames += frame_idx
+
+    def stats(self):
+        with self._lock:
+            stats = dict(active_requests=self.active_requests, served_requests=self.served_requests, served_frames=self.served_frames)
+        stats.update(self.batcher.stats())
+        return stats
+
+    def close(self):
+        self.batcher.close()
+
+
+def read_frames(body):
+    """ Read the frames of a /frames request """
+    try:
+        frames = np.load(io.BytesIO(body), allow_pickle=False)
+    except Exception as e:
+        raise RequestError(f'The body is not a .npy array: {e}')
+    if frames.dtype != np.uint8 or frames.ndim not in (3, 4):
+        raise RequestError(f'Expected uint8 frames of shape (N, H, W) or (N, H, W, 3), got {frames.dtype} {frames.shape}')
+    if frames.ndim == 4:
+        frames = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames])
+    return frames
+
+
+def read_video_request(body):
+    """ Read the video path and the maximum number of frames of a /video request """
+    request = json.loads(body or b'{}')
+    if not isinstance(request, dict):
+        raise RequestError(f'Expected a JSON object, got {type(request).__name__}')
+    path, max_frame_num = request.get('path'), request.get('max_frame_num', 0)
+    if not isinstance(path, str):
+        raise RequestError(f'Expected the video path as a string, got {path!r}')
+    if not isinstance(max_frame_num, int) or isinstance(max_frame_num, bool):
+        raise RequestError(f'Expected max_frame_num as an integer, got {max_frame_num!r}')
+    if not op.exists(path):
+        raise RequestError(f'Video {path} does not exist')
+    return path, max_frame_num
+
+
+def make_handler(service):
+    """ Build the request handler of the service """
+    seq_len = service.args.seq_len
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def log_message(self, format, *args):
+            logger.debug(f'{self.address_string()} {format % args}')
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                self._send_json(200, service.stats())
+            elif path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f'Unknown endpoint {path}'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            vidcap = None
+            try:
+                try:
+                    output = params.get('output', ['events'])[0]
+                    if output not in OUTPUTS:
+                        raise RequestError(f'Invalid output {output}, expected one of {OUTPUTS}')
+                    if url.path == '/frames':
+                        frames = read_frames(body)
+                        frame_count = len(frames)
+                    elif url.path == '/video':
+                        path, max_frame_num = read_video_request(body)
+                        vidcap = VideoReader(path, color_mode='GRAY')
+                        if max_frame_num > 0:
+                            vidcap.frame_count = min(vidcap.frame_count, max_frame_num)
+                        frame_count = vidcap.frame_count
+                    else:
+                        self._send_json(404, {'error': f'Unknown endpoint {url.path}'})
+                        return
+                    if frame_count < seq_len + 1:
+                        raise RequestError(f'A request needs at least {seq_len + 1} frames, got {frame_count}')
+                    starting_indexes, _ = get_starting_indexes(frame_count, seq_len)
+                    if url.path == '/frames':
+                        frame_windows = (frames[s:s + seq_len + 1] for s in starting_indexes)
+                    else:
+                        frame_windows = vidcap.iter_windows(starting_indexes, seq_len + 1)
+                except (RequestError, json.JSONDecodeError) as e:
+                    self._send_json(400, {'error': str(e)})
+                    return
+
+                # Stream the output of each sequence as soon as it is inferred
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for array in service.iter_outputs(frame_count, frame_windows, output=output):
+                        buffer = io.BytesIO()
+                        npy_format.write_array(buffer, array, allow_pickle=False)
+                        self._write_chunk(buffer.getvalue())
+                    self._write_chunk(b'')
+                except Exception:
+                    # The status is already sent, closing the connection without the last chunk tells the client
+                    logger.exception(f'Failed to convert {url.path} request')
+                    self.close_connection = True
+            finally:
+                # The video is read until the output of its last sequence is streamed
+                if vidcap is not None:
+                    vidcap.close()
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An http.client connection to a service listening on a Unix socket."""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.description = 'Run V2CE as a local service with dynamic batching.'
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='The port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None, help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='Maximum number of sequences per forward, merged across requests')
+    parser.add_argument('--max_batch_delay_ms', type=float, default=20, help='Maximum time a sequence waits for others to fill its batch')
+    parser.add_argument('--warmup_width', type=int, default=None, help='The width of the resized frames of the warmup request (default: --width)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    # The warmup request would calibrate the int8 model on black frames
+    assert args.quantize != 'int8', 'Serve an int8 checkpoint calibrated by tools/quantize_model.py instead of --quantize int8'
+    configure_cpu_threads(args.num_threads)
+    runtime = InferenceRuntime(device=args.device, precision=args.precision, channels_last=args.channels_last)
+    logger.info(f'Running on {runtime}')
+    model = get_trained_mode(model_path=args.model_path, runtime=runtime, freeze=args.freeze,
+                             backend=args.backend, backend_path=args.backend_path, quantize=args.quantize)
+    service = V2ceService(model, runtime, args, max_batch_size=args.max_batch_size, max_delay=args.max_batch_delay_ms / 1000)
+    service.warmup(args.warmup_width or args.width)
+
+    if args.unix_socket is not None:
+        if op.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, make_handler(service))
+        logger.info(f'Listening on {args.unix_socket}')
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+        logger.info(f'Listening on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        logger.info(f'Stopped, {service.stats()}')
@@ -3,18 +3,35 @@ import sys
 import cv2
 import torch
 import logging
+import queue
 import argparse
+import traceback
+import multiprocessing
 import numpy as np
 import os.path as op
 from pathlib2 import Path
+import torch.nn.functional as F
 from torchvision import transforms
 from functools import partial
+from collections import deque
 from tqdm import tqdm
 
 sys.path.append(op.abspath('../..'))
 from scripts.v2ce_3d import V2ce3d
 from scripts.LDATI import sample_voxel_statistical
 from scripts.video_reader import VideoReader
+from scripts.prefetcher import BackgroundPrefetcher
+from scripts.image_loader import ImageFolderLoader
+from scripts.runtime import InferenceRuntime, configure_cpu_threads, PRECISIONS
+from scripts.freeze import freeze_v2ce3d, is_frozen_checkpoint, load_frozen_v2ce3d
+from scripts.event_io import EVENT_FORMATS, EventBuffer, open_event_writer
+from scripts.event_frame_video import EventFrameVideoWriter
+from scripts.tiled_inference import TiledInference
+from scripts.backends import BACKENDS, BackendModel
+from scripts.quantization import QUANTIZATIONS, Int8Model, quantize_weight_only, is_int8_checkpoint, load_int8_v2ce3d
+from scripts import profiler
+
+logger = logging.getLogger('V2CE')
 
 def SBool(v):
     if isinstance(v, bool):
@@ -27,36 +44,84 @@ def SBool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def get_trained_mode(model_path='./weights/v2ce_3d.pt'):
+def get_trained_mode(model_path='./weights/v2ce_3d.pt', runtime=None, freeze=True, backend='eager', backend_path=None, quantize='none'):
     """
     Get the trained model from the checkpoint
     Args:
-        model_path: path to the checkpoint
-        batch_size: batch size for inference
+        model_path: path to the checkpoint, either a V2ce3d state dict, a frozen or an int8 checkpoint
+        runtime: the InferenceRuntime the model is prepared for (default: cuda if available, else cpu)
+        freeze: bake the spectral norm and fold the BatchNorm layers of a regular checkpoint
+        backend: the backend running the model, one of BACKENDS, see `BackendModel`
+        backend_path: a graph exported by tools/export_model.py for the torchscript and onnxruntime
+            backends, None to export it from the checkpoint on the first forward
+        quantize: 'int8' to quantize the model to static int8, calibrated on the first batch, which runs
+            in fp32 (int8 checkpoints written by tools/quantize_model.py are already calibrated), 'weight_only' to
+            store the convolution weights in int8, or 'none'
     Returns:
         model: the trained model
     """
-    model = V2ce3d()
-    model.load_state_dict(torch.load(model_path))
-    model = model.eval()
-    model = model.to('cuda')
+    runtime = InferenceRuntime() if runtime is None else runtime
+    checkpoint = torch.load(model_path, map_location='cpu')
+    if is_int8_checkpoint(checkpoint) or quantize != 'none':
+        assert runtime.device.type == 'cpu' and runtime.precision == 'fp32', 'Quantized models run on CPU in fp32 only'
+        assert backend == 'eager', 'Quantized models run with the eager backend only'
+        assert freeze or is_frozen_checkpoint(checkpoint) or is_int8_checkpoint(checkpoint), 'Quantized models are frozen'
+    if is_int8_checkpoint(checkpoint):
+        return runtime.prepare_model(load_int8_v2ce3d(checkpoint))
+    if is_frozen_checkpoint(checkpoint):
+        model = load_frozen_v2ce3d(checkpoint)
+    else:
+        model = V2ce3d()
+        model.load_state_dict(checkpoint)
+        if freeze:
+            model = freeze_v2ce3d(model)
+    if quantize == 'weight_only':
+        model = quantize_weight_only(model)
+    model = runtime.prepare_model(model)
+    if quantize == 'int8':
+        model = Int8Model(model)
+    if backend != 'eager':
+        assert freeze or is_frozen_checkpoint(checkpoint), f'The {backend} backend runs frozen models only'
+        assert runtime.precision == 'fp32' or backend == 'compile', f'The {backend} backend runs in fp32 only'
+        model = BackendModel(model, backend, path=backend_path)
     return model
 
+def default_runtime(model):
+    """ Build an fp32 runtime on the device the model already lives on """
+    parameter = next(model.parameters(), None)
+    return InferenceRuntime(device='cpu' if parameter is None else parameter.device, channels_last=False)
+
+def prepare_frame(img, height=260):
+    """ Scale a grayscale frame to [0, 1] and resize it so that its height is `height`, keeping the aspect ratio
+    Args:
+        img: the uint8 frame. Shape: (H, W)
+        height: the height of the target image unit height (default: 260)
+    Returns:
+        frame: the float32 frame. Shape: (height, W*height/H)
+    """
+    img = img.astype(np.float32)/255
+    return cv2.resize(img, (int(img.shape[1]/img.shape[0]*height), height))
+
+# The normalization of the frames the model was trained with
+FRAME_MEAN, FRAME_STD = 0.153, 0.165
+PREPROCESSINGS = ('tensor', 'cv2')
+
 def image_pre_processing(images, height=260):
     """ Preprocess the images
     Args:
-        images: the images to preprocess. Shape: (N, H, W)
+        images: the images to preprocess, uint8, or float32 frames already prepared by `prepare_frame`. Shape: (N, H, W)
         height: the height of the target image unit height (default: 260)
     Returns:
         image_units: the image units
     """
     frame_normalize = transforms.Compose([
-                transforms.Normalize([0.153, 0.153], [0.165, 0.165])])
+                transforms.Normalize([FRAME_MEAN, FRAME_MEAN], [FRAME_STD, FRAME_STD])])
     
-    images = images.astype(np.float32)/255 
-
     # Resize images so that the video's height is set to `height`, and the width is scaled accordingly, and crop the center height x width
-    images = np.stack([cv2.resize(img, (int(img.shape[1]/img.shape[0]*height), height)) for img in images], axis=0)
+    if images.dtype == np.uint8:
+        images = np.stack([prepare_frame(img, height) for img in images], axis=0)
+    else:
+        assert images.shape[1] == height, f'Prepared frames of height {images.shape[1]} do not match the height {height}'
     
     # Stack images into pairs
     image_units = torch.tensor(np.stack([images[:-1], images[1:]], axis=1))
@@ -64,23 +129,52 @@ def image_pre_processing(images, height=260):
     return image_units
 
 @torch.no_grad()
-def infer_center_image_unit(model, image_units, width=346):
+def preprocess_windows(windows, height=260, device='cpu'):
+    """ Preprocess a batch of frame windows with batched tensor ops on the device
+    Args:
+        windows: the frame windows, uint8, or float32 in [0, 1]. Shape: (B, N, H, W)
+        height: the height of the target image unit height (default: 260)
+        device: the device to preprocess on
+    Returns:
+        image_units: the image units, a strided view of the normalized frames in which the pairs
+            (t, t+1) share their frames instead of copying them. Shape: (B, N-1, 2, height, W*height/H)
+    """
+    frames = torch.as_tensor(windows).to(device, non_blocking=True)
+    B, N, H, W = frames.shape
+    # Only modify the frames in place once they are a copy, the float windows may be shared with the image loader cache
+    owned = frames.dtype == torch.uint8
+    frames = frames.float().div_(255) if owned else frames.float()
+
+    # Resize the frames so that the video's height is set to `height`, and the width is scaled accordingly
+    width = int(W/H*height)
+    if (H, W) != (height, width):
+        frames = F.interpolate(frames, size=(height, width), mode='bilinear', align_corners=False)
+        owned = True
+    frames = frames.sub_(FRAME_MEAN).div_(FRAME_STD) if owned else (frames - FRAME_MEAN) / FRAME_STD
+
+    # Stack the frames into pairs as a view, the image unit t holds the frames t and t+1
+    frames = frames.contiguous()
+    frame_size = height * width
+    return frames.as_strided((B, N - 1, 2, height, width), (N * frame_size, frame_size, frame_size, width, 1))
+
+@torch.no_grad()
+def infer_center_image_unit(model, image_units, width=346, runtime=None):
     """
     Infer the center of the image units
     Args:
         model: the trained model
         image_units: the image units to infer
         width: the width of the target image unit width (default: 346)
+        runtime: the InferenceRuntime to run the model with (default: fp32 on the model's device)
     Returns:
         pred_voxel: the predicted voxel
     """
+    runtime = default_runtime(model) if runtime is None else runtime
     # Crop the center of the image on the width
     image_units = image_units[..., image_units.shape[-1]//2-width//2:image_units.shape[-1]//2+width//2]
     
     # Run the model
-    inputs = image_units.float().cuda()#.unsqueeze(0)
-    outputs = model(inputs)
-    del inputs
+    outputs = runtime(model, image_units)
     
     # Collect the outputs
     pred_voxel = outputs.cpu()
@@ -88,156 +182,518 @@ def infer_center_image_unit(model, image_units, width=346):
     logger.debug(f'Predicted voxel shape: {pred_voxel.shape}')
     return pred_voxel
 
+def get_patch_starts(total_width, width=346):
+    """ Split the width into patches of `width` columns, the last patch is aligned to the right edge
+    Args:
+        total_width: the width of the image units
+        width: the width of each patch, image units narrower than it are a single patch of their whole width
+    Returns:
+        starts: the first column of each patch
+    """
+    patch_num = int(np.ceil(total_width/width))
+    starts = [i*width for i in range(patch_num)]
+    if total_width % width != 0:
+        starts[-1] = max(total_width - width, 0)
+    return starts
+
+def get_patch_weights(starts, width=346):
+    """ Blending weights of the patches, ramping linearly over the columns shared with a neighbour patch
+    Args:
+        starts: the first column of each patch, see `get_patch_starts`
+        width: the width of each patch
+    Returns:
+        weights: the weight of each column of each patch. Shape: (patch_num, width)
+    """
+    weights = torch.ones(len(starts), width)
+    for i in range(len(starts)-1):
+        overlap = starts[i] + width - starts[i+1]
+        if overlap > 0:
+            ramp = torch.linspace(0, 1, overlap+2)[1:-1]
+            weights[i, width-overlap:] *= ramp.flip(0)
+            weights[i+1, :overlap] *= ramp
+    return weights
+
 @torch.no_grad()
-def infer_pano_image_unit(model, image_units, width=346):
+def infer_pano_image_unit(model, image_units, width=346, runtime=None, chunk_size=0, blend=False):
     """
     Infer the panorama of the image units
+    All the patches of all the sequences are stacked along the batch dimension and inferred in chunks.
     Args:
         model: the trained model
-        image_units: the image units to infer
+        image_units: the image units to infer. Shape: (B, L, 2, H, W)
         width: the width of the target image unit width (default: 346)
+        runtime: the InferenceRuntime to run the model with (default: fp32 on the model's device)
+        chunk_size: the number of patches inferred per forward, 0 to use the batch size B
+        blend: blend the overlapping columns of the last patch with the previous patch, instead of
+            cropping the last patch to the columns not covered by the previous patches
     Returns:
-        pred_voxel_out: the predicted voxel
+        pred_voxel_out: the predicted voxel. Shape: (B, L, 20, H, W)
     """
-    # Split images into 260x346 patches along the width
-    patch_num = np.ceil(image_units.shape[-1]/width).astype(int)
-    exact_div = image_units.shape[-1] % 346 == 0
-    patch_remainder = image_units.shape[-1] % width
-    image_units_patches = []
-    for i in range(patch_num):
-        if i == patch_num-1 and not exact_div:
-            image_units_patches.append(image_units[..., -width:])
-        else:
-            image_units_patches.append(image_units[..., i*width:(i+1)*width])
-        
+    runtime = default_runtime(model) if runtime is None else runtime
+    B, L, _, H, total_width = image_units.shape
+    starts = get_patch_starts(total_width, width)
+    # A frame narrower than the patches (e.g. a portrait video) is inferred whole
+    width = min(width, total_width)
+    chunk_size = B if chunk_size <= 0 else chunk_size
+
+    # Stack the patches along the batch dimension, patch-major. Shape: (patch_num*B, L, 2, H, width)
+    patches = torch.cat([image_units[..., start:start+width] for start in starts], dim=0)
+
     # Predict voxels
     pred_voxel_patches = []
-    for i, image_unit in enumerate(image_units_patches):
-        logger.debug(f'Predicting patch {i+1}/{len(image_units_patches)}')
-
-        inputs = image_unit.float().cuda()#.unsqueeze(0)
-        outputs = model(inputs)
-        pred_voxel = outputs
-        if i == len(image_units_patches)-1 and not exact_div:
-            pred_voxel = pred_voxel[..., -patch_remainder:]
-        pred_voxel_patches.append(pred_voxel.cpu())
-
-    # Concatenate patches on the width
-    pred_voxel_out = torch.cat(pred_voxel_patches, dim=-1)
-    
+    for i in range(0, patches.shape[0], chunk_size):
+        logger.debug(f'Predicting patches {i+1}-{min(i+chunk_size, patches.shape[0])}/{patches.shape[0]}')
+        pred_voxel_patches.append(runtime(model, patches[i:i+chunk_size]).cpu())
+    pred_voxel_patches = torch.cat(pred_voxel_patches, dim=0).reshape(len(starts), B, L, -1, H, width)
+
+    # Stitch the patches on the width
+    pred_voxel_out = torch.zeros(B, L, pred_voxel_patches.shape[3], H, total_width)
+    if blend:
+        weights = get_patch_weights(starts, width)
+        for start, pred_voxel, weight in zip(starts, pred_voxel_patches, weights):
+            pred_voxel_out[..., start:start+width] += pred_voxel * weight
+    else:
+        # Each patch only fills the columns not covered by the previous patches
+        covered = 0
+        for start, pred_voxel in zip(starts, pred_voxel_patches):
+            pred_voxel_out[..., covered:start+width] = pred_voxel[..., covered-start:]
+            covered = start + width
+
     logger.debug(f'Predicted voxel shape: {pred_voxel_out.shape}')
     return pred_voxel_out
 
-@torch.no_grad()
-def video_to_voxels(model, image_paths=None, vidcap=None, infer_type='center', 
-                              seq_len=16, width=346, height=260, batch_size=1):
-    """ Infer the voxel from the video or image sequence
+def iter_frame_windows(starting_indexes, seq_len, image_paths=None, vidcap=None, height=260, loader_workers=0, prepare_frames=True):
+    """ Yield the frames of each sequence, in the order of `starting_indexes`
     Args:
-        model: the trained model
+        starting_indexes: the index of the first frame of each sequence
+        seq_len: the sequence length, each window holds seq_len+1 frames
         image_paths: the paths to the images
         vidcap: the video reader
-        infer_type: the type of inference, can be center or pano
+        height: the height the images are resized to by the image loader
+        loader_workers: the number of threads loading the images, 0 for min(8, cpu count)
+        prepare_frames: prepare the images with `prepare_frame` on the loader threads, otherwise keep them as decoded
+    Returns:
+        a generator of frame windows, uint8 frames from the video reader, or float32 frames
+        prepared by `prepare_frame` from the images. Shape: (seq_len+1, H, W)
+    """
+    if vidcap is not None:
+        # Decode the video sequentially, the frames shared by adjacent sequences are decoded only once
+        yield from vidcap.iter_windows(starting_indexes, seq_len + 1)
+    else:
+        # Load rgb images as grayscale and resize them on a thread pool. The cache holds two windows, so the frames
+        # shared by adjacent sequences and by the re-aligned last sequence are loaded only once
+        with ImageFolderLoader(image_paths, num_workers=loader_workers, cache_size=2 * (seq_len + 1),
+                               transform=partial(prepare_frame, height=height) if prepare_frames else None) as loader:
+            yield from loader.iter_windows(starting_indexes, seq_len + 1)
+
+def iter_image_unit_batches(starting_indexes, seq_len, height=260, batch_size=1, image_paths=None, vidcap=None, loader_workers=0,
+                            preprocessing='tensor', device='cpu'):
+    """ Load and preprocess the sequences, and group them into batches
+    Args:
+        starting_indexes: the index of the first frame of each sequence
         seq_len: the sequence length
-        width: the width of the image
         height: the height of the image
         batch_size: batch size for inference
+        image_paths: the paths to the images
+        vidcap: the video reader
+        loader_workers: the number of threads loading the images, 0 for min(8, cpu count)
+        preprocessing: 'tensor' to preprocess each batch with `preprocess_windows` on `device`,
+            or 'cv2' to preprocess each sequence with `image_pre_processing` on the CPU
+        device: the device of the tensor preprocessing
     Returns:
-        all_pred_voxel: the predicted voxel
+        a generator of image unit batches. Shape: (batch_size, seq_len, 2, H, W)
     """
-    assert image_paths is not None or vidcap is not None
-    infer_video = True if vidcap is not None else False
-    frame_count = vidcap.frame_count if infer_video else len(image_paths)
-    sequence_num = np.ceil((frame_count-1)/seq_len).astype(int)
-    mode = (frame_count-1) % seq_len
-    starting_indexes = np.arange(sequence_num) * seq_len
-    if mode != 0:
-        starting_indexes[-1] -= (seq_len-mode)
-
-    logger.debug(f'Found {frame_count} images, divided into {sequence_num} sequences')
-    logger.debug(f'Starting indexes: {starting_indexes}')
-    logger.debug(f'Mode: {mode}')
-    
-    all_pred_voxel = []
+    assert preprocessing in PREPROCESSINGS, f'Invalid preprocessing {preprocessing}'
     batch_idx = 0
     input_image_batches = []
-    for seq_idx in tqdm(range(len(starting_indexes))):
+    frame_windows = profiler.profiled_iter(iter_frame_windows(starting_indexes, seq_len, image_paths=image_paths, vidcap=vidcap,
+                                                              height=height, loader_workers=loader_workers,
+                                                              prepare_frames=preprocessing == 'cv2'), 'decode')
+    for seq_idx in range(len(starting_indexes)):
         starting_idx = starting_indexes[seq_idx]
         ending_idx = starting_idx + seq_len + 1 # +1 for geting the last frame of the last image unit
         logger.debug(f'Using images {starting_idx} to {ending_idx-1}')
-            
-        if infer_video:
-            # Load rgb images as grayscale
-            images = vidcap.read_frames_at_indices(range(starting_idx, ending_idx))
-        else:
-            image_paths_seq = image_paths[starting_idx:ending_idx]
-            # Load rgb images as grayscale
-            images = np.stack([cv2.imread(p, cv2.IMREAD_GRAYSCALE) for p in image_paths_seq], axis=0)
-        
-        image_units = image_pre_processing(images, height=height)
-        resized_width = image_units.shape[-1]
+
+        images = next(frame_windows, None)
+        if images is None:
+            raise ValueError(f'Failed to read images {starting_idx} to {ending_idx-1}')
         
-        input_image_batches.append(image_units[np.newaxis, ...])
+        if preprocessing == 'cv2':
+            with profiler.span('preprocess'):
+                input_image_batches.append(image_pre_processing(images, height=height)[np.newaxis, ...])
+        else:
+            input_image_batches.append(images)
         batch_idx += 1
         if batch_idx == batch_size or seq_idx == len(starting_indexes)-1:
             # Concatenate the input image batches
-            if len(input_image_batches) > 1:
+            if len(input_image_batches) == 0:
+                raise ValueError('No input image batches')
+            elif preprocessing == 'tensor':
+                with profiler.span('preprocess'):
+                    input_image_batches = preprocess_windows(np.stack(input_image_batches, axis=0), height=height, device=device)
+            elif len(input_image_batches) > 1:
                 input_image_batches = torch.cat(input_image_batches, dim=0)
-            elif len(input_image_batches) == 1:
-                input_image_batches = input_image_batches[0]
             else:
-                raise ValueError('No input image batches')
+                input_image_batches = input_image_batches[0]
             
             logger.debug(f'Input_image_batches shape: {input_image_batches.shape}')
-            
-            # Infer the voxel
-            if infer_type == 'center':
-                out_width = width
-                pred_voxel = infer_center_image_unit(model, input_image_batches, width)
-            elif infer_type == 'pano':
-                out_width = resized_width
-                pred_voxel = infer_pano_image_unit(model, input_image_batches, width)        
-            else:
-                raise ValueError(f'Invalid infer_type {infer_type}')
+            yield input_image_batches
             batch_idx = 0
             input_image_batches = []
-            
-            all_pred_voxel.append(pred_voxel.cpu().detach().numpy())
-        
-    all_pred_voxel = merge_voxels(all_pred_voxel, height=height, width=out_width, mode=mode)
+
+def get_starting_indexes(frame_count, seq_len=16):
+    """ Split the frames into sequences of seq_len image units
+    Args:
+        frame_count: the number of frames
+        seq_len: the sequence length
+    Returns:
+        starting_indexes: the index of the first frame of each sequence
+        mode: the number of image units of the last sequence not covered by the previous sequences,
+            the last sequence is shifted back to end at the last frame when it is not 0
+    """
+    sequence_num = np.ceil((frame_count-1)/seq_len).astype(int)
+    mode = (frame_count-1) % seq_len
+    starting_indexes = np.arange(sequence_num) * seq_len
+    if mode != 0:
+        starting_indexes[-1] -= (seq_len-mode)
+    return starting_indexes, mode
+
+@torch.no_grad()
+def infer_image_units(model, image_units, infer_type='center', width=346, runtime=None, pano_chunk_size=0, pano_blend=False, tiled=None):
+    """ Infer a batch of image units
+    Args:
+        model: the trained model
+        image_units: the image units. Shape: (B, L, 2, H, W)
+        the others: see `iter_video_voxels`
+    Returns:
+        pred_voxel: the predicted voxels, on CPU. Shape: (B, L, 20, H, width), or (B, L, 20, H, W) in pano and full modes
+    """
+    with profiler.span('stage1'):
+        if infer_type == 'center':
+            pred_voxel = infer_center_image_unit(model, image_units, width, runtime=runtime)
+        elif infer_type == 'pano':
+            pred_voxel = infer_pano_image_unit(model, image_units, width, runtime=runtime,
+                                               chunk_size=pano_chunk_size, blend=pano_blend)
+        elif infer_type == 'full':
+            if tiled is None:
+                tiled = TiledInference(model, default_runtime(model) if runtime is None else runtime)
+            pred_voxel = tiled(image_units)
+        else:
+            raise ValueError(f'Invalid infer_type {infer_type}')
+        pred_voxel = pred_voxel.detach().cpu()
+    profiler.count('sequences', len(pred_voxel))
+    return pred_voxel
+
+@torch.no_grad()
+def iter_pred_voxels(model, starting_indexes, image_paths=None, vidcap=None, infer_type='center', seq_len=16, width=346, height=260,
+                     batch_size=1, prefetch_depth=2, runtime=None, pano_chunk_size=0, pano_blend=False, tiled=None,
+                     loader_workers=0, preprocessing='tensor', progress=True):
+    """ Infer the sequences starting at `starting_indexes`, one batch at a time
+    Args:
+        model: the trained model
+        starting_indexes: the index of the first frame of each sequence
+        progress: whether to show a progress bar
+        the others: see `iter_video_voxels`
+    Returns:
+        a generator of the predicted voxels of each batch, on CPU. Shape: (B, L, 20, H, W)
+    """
+    runtime = default_runtime(model) if runtime is None else runtime
+    batch_num = int(np.ceil(len(starting_indexes)/batch_size))
+    batches = iter_image_unit_batches(starting_indexes, seq_len, height=height, batch_size=batch_size,
+                                      image_paths=image_paths, vidcap=vidcap, loader_workers=loader_workers,
+                                      preprocessing=preprocessing, device=runtime.device)
+    if prefetch_depth > 0:
+        # Decode and preprocess batch N+1 while batch N is inferred
+        batches = BackgroundPrefetcher(batches, depth=prefetch_depth, name='decode+preprocess')
+    
+    if infer_type == 'full' and tiled is None:
+        tiled = TiledInference(model, runtime)
+    for input_image_batches in tqdm(batches, total=batch_num, disable=not progress):
+        yield infer_image_units(model, input_image_batches, infer_type, width, runtime=runtime,
+                                pano_chunk_size=pano_chunk_size, pano_blend=pano_blend, tiled=tiled)
+
+    if prefetch_depth > 0:
+        batches.log_stats()
+
+def _voxel_shard_worker(shard_idx, num_shards, model, starting_indexes, image_paths, video, num_threads, options, out_queue, release):
+    """ Infer the batches shard_idx, shard_idx+num_shards, ... of the sequences, and put their voxels in out_queue,
+    followed by None, or the traceback of the error. The shard then waits for `release`, its voxels are shared
+    memory which can only be received while it is alive """
+    try:
+        configure_cpu_threads(num_threads)
+        batch_size = options['batch_size']
+        shard_starting_indexes = [starting_indexes[i:i+batch_size] for i in range(shard_idx*batch_size, len(starting_indexes), num_shards*batch_size)]
+        shard_starting_indexes = np.concatenate(shard_starting_indexes) if len(shard_starting_indexes) > 0 else np.zeros(0, dtype=int)
+        vidcap = None
+        if video is not None:
+            # The capture of the parent cannot be shared, each shard decodes its own frames
+            path, color_mode, frame_count = video
+            vidcap = VideoReader(path, color_mode=color_mode)
+            vidcap.frame_count = frame_count
+        for pred_voxel in iter_pred_voxels(model, shard_starting_indexes, image_paths=image_paths, vidcap=vidcap, progress=False, **options):
+            out_queue.put(pred_voxel)
+        out_queue.put(None)
+    except Exception:
+        out_queue.put(traceback.format_exc())
+    release.wait()
+
+def iter_sharded_pred_voxels(model, starting_indexes, num_shards, image_paths=None, vidcap=None, num_threads=0, queue_depth=2, **options):
+    """ Infer the sequences in `num_shards` processes, each running a replica of the model on its own CPU threads
+    The batches are dealt to the shards in turn and collected in the same order, so the voxels come out in frame
+    order as with `iter_pred_voxels`, and each shard runs at most `queue_depth` batches ahead of the consumer.
+    Args:
+        model: the trained model, on CPU. Its weights are shared with the shards, not copied
+        starting_indexes: the index of the first frame of each sequence
+        num_shards: the number of processes
+        image_paths: the paths to the images
+        vidcap: the video reader, each shard opens its own reader of the same video
+        num_threads: the total number of CPU threads, split between the shards, 0 for the number of cores
+        queue_depth: the number of batches of each shard waiting for the consumer
+        options: the options of `iter_pred_voxels`
+    Returns:
+        a generator of the predicted voxels of each batch, on CPU. Shape: (B, L, 20, H, W)
+    """
+    runtime = options.get('runtime')
+    assert runtime is None or runtime.device.type == 'cpu', 'Sharded inference runs on CPU'
+    assert not isinstance(model, Int8Model), 'Each shard would calibrate its own int8 model, use an int8 checkpoint instead'
+    shard_threads = max(1, (num_threads if num_threads > 0 else os.cpu_count() or 1) // num_shards)
+    batch_num = int(np.ceil(len(starting_indexes)/options['batch_size']))
+    video = None if vidcap is None else (vidcap.path, vidcap.color_mode, vidcap.frame_count)
+
+    # Spawn the shards, forking a process which already runs torch threads is unsafe
+    context = torch.multiprocessing.get_context('spawn')
+    model.share_memory()
+    queues = [context.Queue(maxsize=queue_depth) for _ in range(num_shards)]
+    release = context.Event()
+    shards = [context.Process(target=_voxel_shard_worker, name=f'v2ce-shard-{i}', daemon=True,
+                              args=(i, num_shards, model, starting_indexes, image_paths, video, shard_threads, options, queues[i], release))
+              for i in range(num_shards)]
+    for shard in shards:
+        shard.start()
+    logger.info(f'Inferring {batch_num} batches in {num_shards} shards of {shard_threads} threads')
+
+    try:
+        for batch_idx in tqdm(range(batch_num)):
+            shard_idx = batch_idx % num_shards
+            while True:
+                try:
+                    item = queues[shard_idx].get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not shards[shard_idx].is_alive() and queues[shard_idx].empty():
+                        raise RuntimeError(f'Shard {shard_idx} exited with code {shards[shard_idx].exitcode}')
+            if item is None or isinstance(item, str):
+                raise RuntimeError(f'Shard {shard_idx} failed at batch {batch_idx}:\n{item}')
+            yield item
+    finally:
+        release.set()
+        for shard in shards:
+            # The shards which are still inferring (e.g. when the consumer stops early) are stopped
+            shard.join(timeout=1)
+            if shard.is_alive():
+                shard.terminate()
+                shard.join()
+
+@torch.no_grad()
+def iter_video_voxels(model, image_paths=None, vidcap=None, infer_type='center', 
+                      seq_len=16, width=346, height=260, batch_size=1, prefetch_depth=2, runtime=None,
+                      pano_chunk_size=0, pano_blend=False, tiled=None, loader_workers=0, preprocessing='tensor',
+                      start_sequence=0, num_shards=1, num_threads=0):
+    """ Infer the voxels from the video or image sequence, one batch at a time
+    Args:
+        model: the trained model
+        image_paths: the paths to the images
+        vidcap: the video reader
+        infer_type: the type of inference, can be center, pano, or full to infer the whole frame with `tiled`
+        seq_len: the sequence length
+        width: the width of the image
+        height: the height of the image
+        batch_size: batch size for inference
+        prefetch_depth: the number of batches decoded and preprocessed ahead of the inference
+            on a background thread, 0 to run everything on the calling thread
+        runtime: the InferenceRuntime to run the model with (default: fp32 on the model's device)
+        pano_chunk_size: the number of patches inferred per forward in pano mode, 0 to use the batch size
+        pano_blend: blend the overlapping patches in pano mode, see `infer_pano_image_unit`
+        tiled: the TiledInference used in full mode (default: a 4GB budget)
+        loader_workers: the number of threads loading the images, 0 for min(8, cpu count)
+        preprocessing: 'tensor' to preprocess the batches on the runtime device, or 'cv2', see `iter_image_unit_batches`
+        start_sequence: the first sequence to infer, to resume an interrupted conversion. The voxels
+            then start at frame start_sequence*seq_len
+        num_shards: the number of processes inferring the sequences on CPU, see `iter_sharded_pred_voxels`
+        num_threads: the total number of CPU threads of the shards, 0 for the number of cores
+    Returns:
+        a generator of the predicted voxels of each batch, in frame order. Shape: (N, 2, 10, H, W)
+    """
+    assert image_paths is not None or vidcap is not None
+    infer_video = True if vidcap is not None else False
+    frame_count = vidcap.frame_count if infer_video else len(image_paths)
+    starting_indexes, mode = get_starting_indexes(frame_count, seq_len)
+    starting_indexes = starting_indexes[start_sequence:]
+    batch_num = int(np.ceil(len(starting_indexes)/batch_size))
+
+    logger.debug(f'Found {frame_count} images, divided into {len(starting_indexes)} sequences')
+    logger.debug(f'Starting indexes: {starting_indexes}')
+    logger.debug(f'Mode: {mode}')
+
+    options = dict(infer_type=infer_type, seq_len=seq_len, width=width, height=height, batch_size=batch_size,
+                   prefetch_depth=prefetch_depth, runtime=runtime, pano_chunk_size=pano_chunk_size, pano_blend=pano_blend,
+                   tiled=tiled, loader_workers=loader_workers, preprocessing=preprocessing)
+    if num_shards > 1:
+        pred_voxels = iter_sharded_pred_voxels(model, starting_indexes, num_shards, image_paths=image_paths, vidcap=vidcap,
+                                               num_threads=num_threads, **options)
+    else:
+        pred_voxels = iter_pred_voxels(model, starting_indexes, image_paths=image_paths, vidcap=vidcap, **options)
+
+    # The sequences only overlap at the end, where the last sequence is re-aligned to the last frame
+    for batch_idx, pred_voxel in enumerate(pred_voxels):
+        with profiler.span('merge'):
+            voxels = trim_voxels(pred_voxel.numpy(), height=height, width=pred_voxel.shape[-1],
+                                 mode=mode, is_last=batch_idx == batch_num-1)
+        yield voxels
+
+def video_to_voxels(model, image_paths=None, vidcap=None, **kwargs):
+    """ Infer the voxel from the video or image sequence
+    Args:
+        see `iter_video_voxels`
+    Returns:
+        all_pred_voxel: the predicted voxel
+    """
+    all_pred_voxel = np.concatenate(list(iter_video_voxels(model, image_paths=image_paths, vidcap=vidcap, **kwargs)), axis=0)
     
     logger.debug(f"predicted voxels shape: {all_pred_voxel.shape}")
     return all_pred_voxel
         
-def merge_voxels(voxel_list, height=260, width=346, mode=0):
+def trim_voxels(pred_voxel, height=260, width=346, mode=0, is_last=False):
     """
-    Merge the voxel list into a single voxel
+    Split the predicted voxels of a batch into frames
     Args:
-        voxel_list: the list of voxels
+        pred_voxel: the predicted voxels of a batch. Shape: (B, L, 20, H, W)
+        mode: see `get_starting_indexes`
+        is_last: whether this is the last batch, whose last sequence overlaps the previous one
+    Returns:
+        the voxels of the frames not predicted by a previous batch. Shape: (N, 2, 10, H, W)
     """
-    if len(voxel_list) > 1:
-        pred_voxel = np.concatenate(voxel_list[:-1], axis=0).reshape(-1, 2, 10, height, width)
-    else:
-        pred_voxel = None
-    
-    if voxel_list[-1].shape[0] > 1:
-        temp = voxel_list[-1][:-1].reshape(-1, 2, 10, height, width)
-        if pred_voxel is None:
-            pred_voxel = temp
-        else:
-            pred_voxel = np.concatenate([pred_voxel, temp], axis=0)
-    
-    if mode != 0:
-        temp = voxel_list[-1][-1][-mode:].reshape(-1, 2, 10, height, width)
-    else:
-        temp = voxel_list[-1][-1].reshape(-1, 2, 10, height, width)
+    if not is_last or mode == 0:
+        return pred_voxel.reshape(-1, 2, 10, height, width)
+    # Only keep the image units of the last sequence which are not in the previous sequence
+    return np.concatenate([pred_voxel[:-1].reshape(-1, 2, 10, height, width),
+                           pred_voxel[-1][-mode:].reshape(-1, 2, 10, height, width)], axis=0)
+
+def iter_voxel_chunks(voxel_batches, chunk_size):
+    """ Regroup the voxel batches into chunks of `chunk_size` frames (the last chunk may be smaller)
+    Args:
+        voxel_batches: an iterable of voxels. Shape: (N, 2, 10, H, W)
+        chunk_size: the number of frames of each chunk
+    Returns:
+        a generator of voxel chunks. Shape: (chunk_size, 2, 10, H, W)
+    """
+    pending = []
+    pending_num = 0
+    for voxels in voxel_batches:
+        pending.append(voxels)
+        pending_num += len(voxels)
+        if pending_num < chunk_size:
+            continue
+        with profiler.span('merge'):
+            voxels = np.concatenate(pending, axis=0) if len(pending) > 1 else pending[0]
+        split = len(voxels) - len(voxels) % chunk_size
+        for i in range(0, split, chunk_size):
+            yield voxels[i:i+chunk_size]
+        pending = [voxels[split:]] if split < len(voxels) else []
+        pending_num = len(voxels) - split
+    if pending_num > 0:
+        yield np.concatenate(pending, axis=0)
+
+def _init_ldati_worker(num_threads):
+    configure_cpu_threads(num_threads)
+
+def frame_time_offsets(frame_idx, num_frames, fps=30):
+    """ The timestamp offset of the events of each frame, in microseconds """
+    return [int((frame_idx + i) * 1 / fps * 1e6) for i in range(num_frames)]
+
+@torch.no_grad()
+def _ldati_chunk(ldati, voxels, frame_idx, fps):
+    return ldati(torch.from_numpy(voxels), frame_idx=frame_idx, time_offsets=frame_time_offsets(frame_idx, len(voxels), fps))
+
+def iter_parallel_ldati(voxel_chunks, ldati, start_frame=0, num_workers=2, num_threads=0, fps=30):
+    """ Convert the voxel chunks into events in a pool of CPU processes, `2 * num_workers` chunks at a time
+    Args:
+        voxel_chunks: an iterable of voxels, in frame order. Shape: (N, 2, 10, H, W)
+        ldati: the stage 2 function, picklable, taking the index of the first frame of the voxels as `frame_idx`
+            and the timestamp offset of each frame as `time_offsets`
+        start_frame: the index of the first frame of the voxels
+        num_workers: the number of processes
+        num_threads: the total number of CPU threads, split between the processes, 0 for the number of cores
+        fps: the FPS of the video
+    Returns:
+        a generator of the event streams of each chunk, in frame order
+    """
+    worker_threads = max(1, (num_threads if num_threads > 0 else os.cpu_count() or 1) // num_workers)
+    # Spawn the workers, forking a process which already runs torch threads is unsafe
+    pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_ldati_worker, initargs=(worker_threads,))
+    pending = deque()
+    frame_idx = start_frame
+    try:
+        for voxels in voxel_chunks:
+            pending.append(pool.apply_async(_ldati_chunk, (ldati, voxels, frame_idx, fps)))
+            frame_idx += len(voxels)
+            # Bound the chunks in flight, the voxels are produced as fast as stage 1 runs
+            while len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
 
-    if pred_voxel is None:
-        pred_voxel = temp
+def _iter_frame_indexes(voxel_chunks, start_frame):
+    frame_idx = start_frame
+    for voxels in voxel_chunks:
+        yield frame_idx, voxels
+        frame_idx += len(voxels)
+
+def iter_event_streams(voxel_batches, ldati, fps=30, stage2_batch_size=24, device='cpu', start_frame=0, num_workers=0, num_threads=0,
+                       sink=None):
+    """ Convert the voxels into events as they are predicted
+    Args:
+        voxel_batches: an iterable of voxels, in frame order. Shape: (N, 2, 10, H, W)
+        ldati: the stage 2 function, mapping voxels to the event stream of each frame, and taking the index of
+            the first frame of the voxels as `frame_idx`, the timestamp offset of each frame as `time_offsets`,
+            and the buffer of the events as `sink`
+        fps: the FPS of the video
+        stage2_batch_size: the number of frames converted at once
+        device: the device stage 2 runs on
+        start_frame: the index of the first frame of the voxels
+        num_workers: the number of CPU processes running stage 2, see `iter_parallel_ldati`. With the per-frame
+            generators of `sample_voxel_statistical`, the events do not depend on it
+        num_threads: the total number of CPU threads of the processes, 0 for the number of cores
+        sink: an EventBuffer the events of every chunk are written to when stage 2 runs in this process, so an event
+            stream is overwritten by the next chunk and must be consumed before the next one is requested. None to
+            allocate the events of every chunk
+    Returns:
+        a generator of the event stream of each frame, with the timestamps offset to the start of the frame
+    """
+    voxel_chunks = iter_voxel_chunks(voxel_batches, stage2_batch_size)
+    if num_workers > 1:
+        event_stream_chunks = iter_parallel_ldati(voxel_chunks, ldati, start_frame, num_workers=num_workers, num_threads=num_threads, fps=fps)
     else:
-        pred_voxel = np.concatenate([pred_voxel, temp], axis=0)
+        event_stream_chunks = (ldati(torch.from_numpy(voxels).to(device), frame_idx=frame_idx,
+                                     time_offsets=frame_time_offsets(frame_idx, len(voxels), fps), sink=sink)
+                               for frame_idx, voxels in _iter_frame_indexes(voxel_chunks, start_frame))
+    for event_streams in event_stream_chunks:
+        yield from event_streams
+
+def write_event_frames(voxel_batches, ef_video):
+    """ Pass the voxel batches through, writing their event frames to the video
+    Args:
+        voxel_batches: an iterable of voxels. Shape: (N, 2, 10, H, W)
+        ef_video: the EventFrameVideoWriter
+    """
+    for voxels in voxel_batches:
+        with profiler.span('event_frame_video'):
+            ef_video.write(voxels)
+        yield voxels
 
-    return pred_voxel
-    
 def write_event_frame_video(voxel_grid, ef_video_path, fps, ceil, upper_bound_percentile=98, keep_polarity=True):
     """
     Write the event frame video.
@@ -248,38 +704,12 @@ def write_event_frame_video(voxel_grid, ef_video_path, fps, ceil, upper_bound_pe
         ceil: the ceiling of the ef value
     """
     logger.info("Writing event frame video...")
-    # Write all_pred_ef into a mp4 video
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    B, P, L, H, W = voxel_grid.shape
-    if keep_polarity:
-        efs = np.sum(voxel_grid, axis=2) # [B, P(2), L, H, W]
-        # Concatenate a zero tensor to the blue channel to make the channel number 3
-        efs = np.concatenate([efs, np.zeros((B, 1, H, W))], axis=1)
-    else:
-        efs = np.sum(voxel_grid, axis=(1,2))[:,np.newaxis,...] # [B, P(2), L(10), H, W]
-        efs = np.repeat(efs, 3, axis=1) # [B, P(10), H, W]
-    # get the <u>% percentile of the ef value to set the upper bound
-    efs_flatten = efs.flatten()
-    efs_flatten = efs_flatten[efs_flatten > 0]
-    efs_upper_bound = min(np.percentile(efs_flatten, upper_bound_percentile), ceil)
-    logger.info(f'Upper bound of the event frame value during video writing: {efs_upper_bound}')
-    # Clip the ef value to the upper bound
-    efs = np.clip(efs, 0, efs_upper_bound) / efs_upper_bound
-    # Move the Channel dimension to the last dimension
-    efs = np.moveaxis(efs, 1, -1)
-    print(efs.shape)
-    
-    video_size = (W, H)
-    video = cv2.VideoWriter(ef_video_path, fourcc, fps, video_size)
-    for i in range(efs.shape[0]):
-        frame = efs[i]#/efs.max() 
-        frame = (frame*255).astype(np.uint8)
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        video.write(frame)
-    video.release()
-    logger.info(f'Event frame video written to {ef_video_path}')
+    # The upper bound is estimated on the whole clip before any frame is written
+    with EventFrameVideoWriter(ef_video_path, fps, ceil, upper_bound_percentile, keep_polarity, warmup_frames=None) as ef_video:
+        ef_video.write(voxel_grid)
 
-if __name__ == '__main__':
+def get_parser():
+    """ The options of the command line, also used by the batch converter (tools/batch_convert.py) """
     parser = argparse.ArgumentParser()
     parser.add_argument('--fps', type=int, default=30, help='FPS of the output video')
     parser.add_argument('--seq_len', type=int, default=16, help='Sequence length')
@@ -288,22 +718,152 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--image_folder', type=str, help='The folder containing the images to infer') # default='/tsukimi/v2ce-project/video_for_test/dash-cam-test-video'
     parser.add_argument('-i', '--input_video_path', type=str, help='The path to the input video')
     parser.add_argument('-o', '--out_folder', type=str, default='./output', help='The folder to save the output video')
-    parser.add_argument('-t', '--infer_type', type=str, default='center', help='The type of inference, can be center or pano')
+    parser.add_argument('-t', '--infer_type', type=str, default='center', help='The type of inference, can be center, pano, or full to infer whole frames of any size in memory-budgeted tiles')
+    parser.add_argument('--memory_budget', type=float, default=4., help='Memory in GB for the activations of a forward in full mode, the tile and batch sizes are picked from it')
+    parser.add_argument('--tile_halo', type=int, default=None, help='Halo in pixels around each tile in full mode (default: the receptive field radius, matching a full frame forward)')
+    parser.add_argument('--pano_chunk_size', type=int, default=0, help='Number of pano patches inferred per forward, 0 to use the batch size')
+    parser.add_argument('--pano_blend', type=SBool, default=False, nargs='?', const=True, help='Whether to blend the overlapping columns of the last pano patch instead of cropping it')
     parser.add_argument('-m', '--model_path', type=str, default='./weights/v2ce_3d.pt', help='The path to the trained model')
+    parser.add_argument('--freeze', type=SBool, default=True, nargs='?', const=True, help='Whether to bake the spectral norm and fold the BatchNorm layers of the model before inference')
     parser.add_argument('--out_name_suffix', type=str, default='', help='The suffix of the output video name')
-    parser.add_argument('--max_frame_num', type=int, default=1800, help='The maximum number of frames to process')
+    parser.add_argument('--max_frame_num', type=int, default=0, help='The maximum number of frames to process, 0 for no limit')
     parser.add_argument('--width', type=int, default=346, help='The width of the frame/tensor input to the model')
     parser.add_argument('--height', type=int, default=260, help='The height of the frame/tensor input to the model')
     parser.add_argument('--write_event_frame_video', type=SBool, default=True, nargs='?', const=True, help='Whether to write the event frame video')
+    parser.add_argument('--vis_upper_bound', type=float, default=None, help='A preset upper bound of the event frame value during video writing, instead of estimating it')
+    parser.add_argument('--vis_warmup_frames', type=int, default=150, help='Number of frames the upper bound of the event frame video is estimated on before writing')
     parser.add_argument('--vis_keep_polarity', type=SBool, default=True, nargs='?', const=True, help='Whether to keep the polarity of the event frame during visualization')
+    parser.add_argument('--event_format', type=str, default='npz', choices=list(EVENT_FORMATS), help='The format of the event stream file, chunked writes time-indexed compressed chunks that can be read by time window or region, evt2 writes the 4-byte words of the EVT 2.0 encoding (a Prophesee .raw file)')
+    parser.add_argument('--event_chunk_size', type=int, default=65536, help='Number of events per chunk of the chunked event format')
+    parser.add_argument('--profile', type=str, default=None, help='Time the decode, preprocess, stage1, merge, ldati and write spans, and write the report to <profile>.json and a Chrome trace to <profile>.trace.json')
+    parser.add_argument('--profile_ops', type=SBool, default=False, nargs='?', const=True, help='With --profile, also report the time of every torch operator (slower)')
     parser.add_argument('-l', '--log_level', type=str, default='info', help='Logging level')
     parser.add_argument('-b', '--batch_size', type=int, default=1, help='Batch size for inference')
+    parser.add_argument('-d', '--device', type=str, default='auto', help='The device to run on: auto, cpu, cuda or cuda:<index>')
+    parser.add_argument('--backend', type=str, default='eager', choices=BACKENDS, help='The backend running the model, checked against eager on the first batch and falling back to it on a mismatch')
+    parser.add_argument('--backend_path', type=str, default=None, help='A TorchScript (.pt) or ONNX (.onnx) graph exported by tools/export_model.py, exported on the fly if not set')
+    parser.add_argument('--quantize', type=str, default='none', choices=QUANTIZATIONS, help='CPU only. int8 quantizes the model to static int8, calibrated on the first batch, which runs in fp32, weight_only stores the convolution weights in int8')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='The precision of stage 1 inference, bf16 autocasts the convolutions to bfloat16')
+    parser.add_argument('--channels_last', type=SBool, default=None, nargs='?', const=True, help='Whether to use the channels-last 3D memory format (default: on CPU only)')
+    parser.add_argument('--num_threads', type=int, default=0, help='Number of intra-op CPU threads used by torch, 0 to keep the torch default')
+    parser.add_argument('--num_shards', type=int, default=1, help='Number of processes inferring the sequences on CPU, each with a replica of the model and --num_threads/num_shards threads')
+    parser.add_argument('--prefetch_depth', type=int, default=2, help='Number of batches decoded and preprocessed ahead of inference on a background thread, 0 to disable')
+    parser.add_argument('--preprocessing', type=str, default='tensor', choices=PREPROCESSINGS, help='Preprocess each batch with tensor ops on the device, or each sequence with cv2 on the CPU (matches older outputs exactly)')
+    parser.add_argument('--loader_workers', type=int, default=0, help='Number of threads loading the images of an image folder, 0 for min(8, cpu count)')
     parser.add_argument('--stage2_batch_size', type=int, default=24, help='Batch size for inference')
-    args = parser.parse_args()
+    parser.add_argument('--stage2_workers', type=int, default=0, help='Number of CPU processes running stage 2 on chunks of --stage2_batch_size frames, 0 to run it in the main process')
+    parser.add_argument('--seed', type=int, default=0, help='The seed of the stage 2 sampling, each frame draws from a generator seeded from (seed, frame index), so the events do not depend on the batch sizes and the number of workers')
+    parser.add_argument('--stage2_compile', type=SBool, default=False, nargs='?', const=True, help='Whether to compile the per-pixel stage 2 kernels with torch.compile')
+    return parser
+
+def get_output_name(name, args):
+    """ The stem of the output files of the input `name` """
+    output_name = f'{name}-ceil_{args.ceil}-fps_{args.fps}'
+    return output_name if args.out_name_suffix == '' else f'{output_name}-{args.out_name_suffix}'
+
+def convert(model, runtime, args, image_folder=None, input_video_path=None, resume=None, checkpoint_interval=0, on_checkpoint=None):
+    """ Convert a video or an image sequence into events, with the options of the command line
+    Args:
+        model: the trained model, prepared by `runtime`
+        runtime: the InferenceRuntime to run the model with
+        args: the options parsed by `get_parser`
+        image_folder: the folder containing the images to infer
+        input_video_path: the path to the input video
+        resume: the last checkpoint of an interrupted conversion of the same input, to continue it
+            instead of starting over. Requires the chunked event format
+        checkpoint_interval: the number of sequences between two checkpoints, 0 for no checkpoints.
+            Requires the chunked event format
+        on_checkpoint: called with each checkpoint, a dict of the sequences and frames converted so far,
+            and of the events and chunks of the event file holding their events
+    Returns:
+        summary: a dict of the number of frames and events, and of the output paths
+    """
+    assert (image_folder is None) != (input_video_path is None), 'Either image_folder or input_video_path should be specified'
+    if resume is not None or checkpoint_interval > 0:
+        assert args.event_format == 'chunked', 'Checkpoints require the chunked event format'
+    name = Path(image_folder).name if image_folder is not None else Path(input_video_path).stem
+    output_name = get_output_name(name, args)
+    os.makedirs(args.out_folder, exist_ok=True)
+    start_sequence = 0 if resume is None else resume['sequences']
+    start_frame = start_sequence * args.seq_len
+
+    tiled = TiledInference(model, runtime, memory_budget=args.memory_budget, halo=args.tile_halo) if args.infer_type == 'full' else None
+
+    # Stream the video through stage 1 one batch at a time
+    if image_folder is not None:
+        image_paths = sorted([op.join(image_folder, f) for f in os.listdir(image_folder) if f.endswith('.png')])
+        if args.max_frame_num > 0:
+            image_paths = image_paths[:args.max_frame_num]
+        logger.info(f'Now processing {image_folder}, Found {len(image_paths)} images.')
+
+        voxel_batches = iter_video_voxels(model, image_paths=image_paths, infer_type=args.infer_type, seq_len=args.seq_len, batch_size=args.batch_size,
+                                          width=args.width, height=args.height, prefetch_depth=args.prefetch_depth, runtime=runtime,
+                                          pano_chunk_size=args.pano_chunk_size, pano_blend=args.pano_blend, tiled=tiled,
+                                          loader_workers=args.loader_workers, preprocessing=args.preprocessing,
+                                          start_sequence=start_sequence, num_shards=args.num_shards, num_threads=args.num_threads)
+    else:
+        vidcap = VideoReader(input_video_path, color_mode='GRAY')
+        if args.max_frame_num is not None and args.max_frame_num > 0 and vidcap.frame_count > args.max_frame_num:
+            vidcap.frame_count = args.max_frame_num
+        logger.info(f'Now processing {input_video_path}, processing {vidcap.frame_count} frames.')
+
+        voxel_batches = iter_video_voxels(model, vidcap=vidcap, infer_type=args.infer_type, seq_len=args.seq_len, batch_size=args.batch_size,
+                                          width=args.width, height=args.height, prefetch_depth=args.prefetch_depth, runtime=runtime,
+                                          pano_chunk_size=args.pano_chunk_size, pano_blend=args.pano_blend, tiled=tiled,
+                                          preprocessing=args.preprocessing, start_sequence=start_sequence,
+                                          num_shards=args.num_shards, num_threads=args.num_threads)
+    if start_frame > 0:
+        logger.info(f'Resuming from sequence {start_sequence} (frame {start_frame})')
+
+    # Write the event frames as the voxels are predicted, normalized by an upper bound estimated on the first frames
+    ef_video = None
+    if args.write_event_frame_video:
+        vis_color = 'rgb' if args.vis_keep_polarity else 'gray'
+        ef_video_name = f'{args.infer_type}-{output_name}-pred_ef_{vis_color}'
+        # A video cannot be appended to, the frames of a resumed conversion go to a video of their own
+        ef_video_path = op.join(args.out_folder, f'{ef_video_name}.mp4' if start_frame == 0 else f'{ef_video_name}-from_{start_frame}.mp4')
+        ef_video = EventFrameVideoWriter(ef_video_path, args.fps, args.ceil, args.upper_bound_percentile, args.vis_keep_polarity,
+                                         upper_bound=args.vis_upper_bound, warmup_frames=args.vis_warmup_frames)
+        voxel_batches = write_event_frames(voxel_batches, ef_video)
+    
+    # Initialize the LDATI function
+    ldati = partial(sample_voxel_statistical, fps=args.fps, bidirectional=False, additional_events_strategy='slope', compile_kernel=args.stage2_compile,
+                    seed=args.seed)
+
+    # Convert each batch into events as soon as it is predicted, and append them to the output
+    writer_kwargs = dict(chunk_size=args.event_chunk_size) if args.event_format == 'chunked' else {}
+    if args.event_format == 'evt2' and args.infer_type == 'center':
+        # The size of the other inference types is only known from the frames
+        writer_kwargs.update(width=args.width, height=args.height)
+    if resume is not None:
+        writer_kwargs['resume_chunks'] = resume['num_chunks']
+    frame_num = start_frame
+    with open_event_writer(op.join(args.out_folder, f'{output_name}-events'), args.event_format, **writer_kwargs) as writer:
+        for event_stream in iter_event_streams(voxel_batches, ldati, fps=args.fps, stage2_batch_size=args.stage2_batch_size,
+                                               device=runtime.device, start_frame=start_frame,
+                                               num_workers=args.stage2_workers, num_threads=args.num_threads, sink=EventBuffer()):
+            with profiler.span('write'):
+                writer.write(event_stream)
+            profiler.count('frames')
+            profiler.count('events', len(event_stream))
+            frame_num += 1
+            if checkpoint_interval > 0 and frame_num % (checkpoint_interval * args.seq_len) == 0:
+                # Every event of the sequences converted so far is in the file once it is flushed
+                writer.flush()
+                if on_checkpoint is not None:
+                    on_checkpoint(dict(sequences=frame_num // args.seq_len, frames=frame_num,
+                                       num_events=writer.num_events, num_chunks=writer.num_chunks))
+    if ef_video is not None:
+        ef_video.close()
+    logger.info(f"Generated {writer.num_events} events over {frame_num} frames, written to {writer.path}")
+    return dict(frames=frame_num, num_events=writer.num_events, events_path=writer.path,
+                ef_video_path=None if ef_video is None else ef_video.path)
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
     
     # Set the logging level to the specified level
     logging.basicConfig(level=getattr(logging, args.log_level.upper()))
-    logger = logging.getLogger('V2CE')
 
     # Check the input to make sure only one of image_folder and input_video_path is specified
     assert args.image_folder is not None or args.input_video_path is not None
@@ -312,61 +872,20 @@ if __name__ == '__main__':
         assert os.path.exists(args.image_folder), f'{args.image_folder} does not exist'
     if args.input_video_path is not None:
         assert os.path.exists(args.input_video_path), f'{args.input_video_path} does not exist'
-        
-    name = Path(args.image_folder).name if args.image_folder is not None else Path(args.input_video_path).stem
-    output_name=f'{name}-ceil_{args.ceil}-fps_{args.fps}' if args.out_name_suffix == '' else f'{name}-ceil_{args.ceil}-fps_{args.fps}-{args.out_name_suffix}'
-    if not op.exists(args.out_folder):
-        os.makedirs(args.out_folder, exist_ok=True)
+    # Every shard would calibrate its own replica on its own first batch
+    assert args.quantize != 'int8' or args.num_shards <= 1, 'Use an int8 checkpoint calibrated by tools/quantize_model.py with --num_shards'
 
     # Get the trained model
-    model = get_trained_mode(model_path=args.model_path)
-    
-    # Run the core function and get the predicted voxel    
-    if args.image_folder is not None:
-        image_paths = sorted([op.join(args.image_folder, f) for f in os.listdir(args.image_folder) if f.endswith('.png')])[:args.max_frame_num] # 1800 is the max number of images in a sequence, which equals to 1 minute of 30FPS video
-        logger.info(f'Now processing {args.image_folder}, Found {len(image_paths)} images.')
-
-        # Generate the video
-        pred_voxel = video_to_voxels(model, image_paths=image_paths, infer_type=args.infer_type, seq_len=args.seq_len, batch_size=args.batch_size,
-                            width=args.width, height=args.height)
-    elif args.input_video_path is not None:
-        vidcap = VideoReader(args.input_video_path, color_mode='GRAY')
-        if args.max_frame_num is not None and args.max_frame_num > 0 and vidcap.frame_count > args.max_frame_num:
-            vidcap.frame_count = args.max_frame_num
-        logger.info(f'Now processing {args.input_video_path}, processing {vidcap.frame_count} frames.')
+    configure_cpu_threads(args.num_threads)
+    runtime = InferenceRuntime(device=args.device, precision=args.precision, channels_last=args.channels_last)
+    logger.info(f'Running on {runtime}')
+    model = get_trained_mode(model_path=args.model_path, runtime=runtime, freeze=args.freeze,
+                             backend=args.backend, backend_path=args.backend_path, quantize=args.quantize)
 
-        pred_voxel = video_to_voxels(model, vidcap=vidcap, infer_type=args.infer_type, seq_len=args.seq_len, batch_size=args.batch_size,
-                            width=args.width, height=args.height)
-    else:
-        raise ValueError('Either image_folder or input_video_path should be specified')
-    logger.info(f"Predicted voxel shape: {pred_voxel.shape}")
-    
-    if args.write_event_frame_video:
-        if not op.exists(args.out_folder):
-            os.makedirs(args.out_folder, exist_ok=True)
-        vis_color = 'rgb' if args.vis_keep_polarity else 'gray'
-        ef_video_path = op.join(args.out_folder, f'{args.infer_type}-{output_name}-pred_ef_{vis_color}.mp4')
-        write_event_frame_video(pred_voxel, ef_video_path, args.fps, args.ceil, args.upper_bound_percentile, args.vis_keep_polarity)
-    
-    L, _, _, H, W = pred_voxel.shape
-    stage2_input = pred_voxel.reshape(L, 2, 10, H, W)
-    stage2_input = torch.from_numpy(stage2_input).cuda()
-    
-    # Initialize the LDATI function
-    ldati = partial(sample_voxel_statistical, fps=args.fps, bidirectional=False, additional_events_strategy='slope')
-
-    event_stream_per_frame = []
-    for i in range(0, stage2_input.shape[0], args.stage2_batch_size):
-        event_stream_per_frame.extend(ldati(stage2_input[i:i+args.stage2_batch_size]))
-
-    # merge 16 event stream into a single one
-    event_stream = []
-    for i in range(L):
-        event_stream_per_frame[i]['timestamp'] += int(i * 1 / args.fps * 1e6)
-        event_stream.append(event_stream_per_frame[i])
-    event_stream = np.concatenate(event_stream)
-    logger.info(f"Generated event stream shape: , {event_stream.shape}")
-    
-    # Dump the event stream (numpy structured array)
-    event_stream_path = op.join(args.out_folder, f'{output_name}-events.npz')
-    np.savez(event_stream_path, event_stream=event_stream)
+    if args.profile is not None:
+        profiler.enable_profiler(sync_device=runtime.device, profile_ops=args.profile_ops)
+    convert(model, runtime, args, image_folder=args.image_folder, input_video_path=args.input_video_path)
+    if args.profile is not None:
+        report = profiler.disable_profiler()
+        report.log_summary()
+        logger.info('Profile written to {} and {}'.format(*report.save(args.profile)))